@@ -24,6 +24,11 @@ setup(
         "console_scripts": [
             "citypeaks=segment.find_cities:entry",
             "citysplit=segment.split_cities:entry",
+            "rastercache=segment.raster_cache:entry",
+            "citybenchmark=segment.benchmark:entry",
+            "citysweep=segment.sweep:entry",
+            "citylookup=segment.lookup:entry",
+            "cityglobal=segment.world:entry",
         ]
     },
     classifiers=[
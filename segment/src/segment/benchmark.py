@@ -0,0 +1,216 @@
+"""
+Times every stage of the pipeline on synthetic rasters at several scales
+and writes the measurements as JSON, so that runs on different commits
+can be compared.
+
+For each stage, this records wall time, CPU time, the peak of memory
+traced by tracemalloc during the stage, which includes NumPy arrays,
+and the process's maximum resident set size so far.
+Tracing memory slows Python-heavy stages, so use ``--no-tracemalloc``
+when only times matter.
+"""
+import json
+import logging
+import platform
+import tracemalloc
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import namedtuple
+from datetime import datetime
+from inspect import getmodule
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+
+import numpy as np
+from osgeo import gdal
+
+from .city_find import largest_within_distance
+from .communities import save_pandas, split_disconnected_graph
+from .flux import (
+    assign_pop_and_pfpr_to_points, calculate_flows, GRAVITY_CUTOFF,
+    GRAVITY_EXPONENT,
+)
+from .input_data import load_lspop, load_pfpr
+from .instrument import max_rss_bytes
+from .synthetic import write_synthetic_rasters
+from .vector import write_points_file
+
+LOGGER = logging.getLogger(__name__)
+Scale = namedtuple("Scale", "x_size y_size city_cnt")
+SCALES = {
+    "tiny": Scale(256, 192, 30),
+    "small": Scale(1024, 768, 200),
+    "medium": Scale(3072, 2048, 1000),
+    "large": Scale(8192, 6144, 5000),
+}
+
+
+def measure(stage, trace_memory, function, *args):
+    """
+    Call a function and measure it.
+
+    Returns:
+        (object, dict): What the function returned, and its measurements.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    wall_start, cpu_start = perf_counter(), process_time()
+    result = function(*args)
+    record = dict(
+        stage=stage,
+        wall_seconds=perf_counter() - wall_start,
+        cpu_seconds=process_time() - cpu_start,
+    )
+    if trace_memory:
+        record["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    record["max_rss_bytes"] = max_rss_bytes()
+    LOGGER.info(f"{stage} took {record['wall_seconds']:.3f}s")
+    return result, record
+
+
+def benchmark_scale(scale, directory, peak_radius, city_radius,
+                    largest_component, distance_method="exact",
+                    trace_memory=True):
+    """
+    Run the pipeline once on synthetic rasters.
+
+    Args:
+        scale (Scale): Raster size and city count.
+        directory (Path): Where to write rasters and outputs.
+        peak_radius (float): Pixels around a peak that must be lower.
+        city_radius (float): Meters around a city to sum population.
+        largest_component (int): Largest group when splitting.
+        distance_method (str): "exact" or "fast".
+        trace_memory (bool): Whether to use tracemalloc.
+
+    Returns:
+        List[dict]: Measurements for each stage, with counts.
+    """
+    lspop_path, pfpr_path = write_synthetic_rasters(
+        directory, scale.x_size, scale.y_size, scale.city_cnt)
+    lspop = load_lspop(lspop_path)
+    pfpr = load_pfpr(pfpr_path)
+    records = list()
+
+    peaks, record = measure(
+        "largest_within_distance", trace_memory, largest_within_distance,
+        lspop.band, peak_radius, None, "array", False,
+    )
+    record["pixels"] = scale.x_size * scale.y_size
+    record["peaks"] = len(peaks)
+    records.append(record)
+
+    cities = np.array(peaks, dtype=np.int64).reshape(-1, 3)[:, 1:3]
+    pop_pfpr, record = measure(
+        "assign_pop_and_pfpr_to_points", trace_memory,
+        assign_pop_and_pfpr_to_points, cities, lspop, pfpr, city_radius,
+    )
+    record["cities"] = len(cities)
+    records.append(record)
+
+    graph, record = measure(
+        "calculate_flows", trace_memory, calculate_flows,
+        pop_pfpr, GRAVITY_CUTOFF, GRAVITY_EXPONENT, distance_method,
+    )
+    record["edges"] = graph.edge_cnt
+    records.append(record)
+
+    (graph, hierarchy), record = measure(
+        "split_disconnected_graph", trace_memory, split_disconnected_graph,
+        graph, largest_component,
+    )
+    record["groups"] = len(hierarchy)
+    records.append(record)
+
+    _, record = measure(
+        "save_pandas", trace_memory, save_pandas,
+        graph, hierarchy, directory / "segmented.h5", largest_component,
+        "min-cut",
+    )
+    record["bytes_written"] = (directory / "segmented.h5").stat().st_size
+    records.append(record)
+
+    _, record = measure(
+        "write_points_file", trace_memory, write_points_file,
+        graph, hierarchy, directory / "groups.gpkg", "GPKG",
+    )
+    records.append(record)
+    return records
+
+
+def parser():
+    parse_obj = ArgumentParser(
+        description=getmodule(parser).__doc__,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parse_obj.add_argument("--scales", nargs="+", choices=list(SCALES),
+                           default=["tiny", "small"],
+                           help="Sizes of synthetic rasters to run")
+    parse_obj.add_argument("--output", type=Path, default="benchmark.json",
+                           help="JSON file of measurements")
+    parse_obj.add_argument("--workdir", type=Path, default=None,
+                           help=("Where to write rasters and outputs. "
+                                 "Default is a temporary directory."))
+    parse_obj.add_argument("--peak-radius", type=float, default=20,
+                           help="Pixels around a peak that must be lower")
+    parse_obj.add_argument("--city-radius", type=float, default=25,
+                           help="Distance in km to sum population")
+    parse_obj.add_argument("--largest-component", type=int, default=10,
+                           help="Largest number of cities in a group")
+    parse_obj.add_argument("--distance", choices=["exact", "fast"],
+                           default="exact",
+                           help="Distance method for flows")
+    parse_obj.add_argument("--no-tracemalloc", action="store_true",
+                           help="Skip tracing memory, for cleaner times")
+    parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
+                           default=0)
+    parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
+                           default=0)
+    return parse_obj
+
+
+def run_benchmarks(args, workdir):
+    results = list()
+    for scale_name in args.scales:
+        scale = SCALES[scale_name]
+        directory = workdir / scale_name
+        directory.mkdir(parents=True, exist_ok=True)
+        LOGGER.info(f"Benchmark {scale_name} {scale}")
+        records = benchmark_scale(
+            scale, directory, args.peak_radius, args.city_radius * 1000,
+            args.largest_component, args.distance, not args.no_tracemalloc,
+        )
+        for record in records:
+            record.update(scale=scale_name, **scale._asdict())
+        results.extend(records)
+    return results
+
+
+def entry():
+    args = parser().parse_args()
+    logging_level = logging.INFO - 10 * args.verbose + 10 * args.quiet
+    logging.basicConfig(level=logging_level)
+    gdal.AllRegister()
+
+    if args.workdir is None:
+        with TemporaryDirectory() as temporary:
+            results = run_benchmarks(args, Path(temporary))
+    else:
+        results = run_benchmarks(args, args.workdir.expanduser())
+    report = dict(
+        when=str(datetime.now()),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        gdal=gdal.__version__,
+        machine=platform.machine(),
+        distance=args.distance,
+        tracemalloc=not args.no_tracemalloc,
+        results=results,
+    )
+    args.output.write_text(json.dumps(report, indent=2))
+    LOGGER.info(f"Wrote {len(results)} measurements to {args.output}")
+
+
+if __name__ == "__main__":
+    entry()
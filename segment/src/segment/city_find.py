@@ -1,18 +1,69 @@
 import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from itertools import product
 from os import linesep
 
+import numpy as np
+from osgeo import gdal
 from progressbar import progressbar
+from scipy.ndimage import maximum_filter
 
-from .raster_access import sub_band_as_numpy
+from .input_data import load_lspop
+from .instrument import add_counts, count, run_counted
+from .raster_access import RowWindowReader
 from .raster_transform import LongLat
 
 LOGGER = logging.getLogger(__name__)
+STRIP_ROWS = 256
+"""How many output rows the array engine handles per raster read."""
+TILE_SIZE = 1024
+"""Width and height, in pixels, of tiles for parallel peak finding."""
 
 
-def largest_within_distance(band, distance, bounding_box_pixels=None):
+def _quiet(iterable):
+    return iterable
+
+
+def largest_within_distance(band, distance, bounding_box_pixels=None,
+                            engine="array", progress=True, prefetch_depth=0):
     """
     Find the largest pixel within the given distance.
+
+    Args:
+        band: GDAL raster band of population.
+        distance (float): Radius, in pixels, within which a peak is largest.
+        bounding_box_pixels (LongLat): Ranges of x and y pixels to search.
+        engine (str): "array" for the NumPy engine, "reference" for the
+            original pixel-by-pixel loop, which is slow but easy to read.
+        progress (bool): Whether to show a progress bar.
+        prefetch_depth (int): Chunks of rows the array engine reads
+            ahead on a thread while it finds peaks.
+
+    Returns:
+        List[Tuple[int,int,int]]: Squared distance to the nearest higher
+        pixel, then x and y of each peak, ordered by y and then x.
+    """
+    if bounding_box_pixels:
+        count("pixels", int(np.diff(bounding_box_pixels.long)[0]
+                            * np.diff(bounding_box_pixels.lat)[0]))
+    else:
+        count("pixels", band.XSize * band.YSize)
+    if engine == "reference":
+        return largest_within_distance_reference(
+            band, distance, bounding_box_pixels, progress)
+    elif engine == "array":
+        return largest_within_distance_array(
+            band, distance, bounding_box_pixels, progress=progress,
+            prefetch_depth=prefetch_depth)
+    else:
+        raise ValueError(f"Unknown peak engine {engine}")
+
+
+def largest_within_distance_reference(band, distance, bounding_box_pixels=None,
+                                      progress=True):
+    """
+    Find the largest pixel within the given distance, one pixel at a time.
     """
     dx2 = distance**2
     value_range = (int(band.GetMinimum()), int(band.GetMaximum()))
@@ -21,19 +72,27 @@ def largest_within_distance(band, distance, bounding_box_pixels=None):
     not_a_peak = 0
     if not bounding_box_pixels:
         bounding_box_pixels = LongLat([0, band.XSize], [0, band.YSize])
-    for j in progressbar(range(*bounding_box_pixels.lat)):
+    halo = int(distance) + 1
+    reader = RowWindowReader(
+        band,
+        (bounding_box_pixels.long[0] - halo, bounding_box_pixels.long[1] + halo),
+        2 * halo + 1,
+    )
+    map_x = reader.x_limits[0]
+    show = progressbar if progress else _quiet
+    for j in show(range(*bounding_box_pixels.lat)):
         y_limits = (int(max(0, j - distance)),
                     int(min(band.YSize, j + distance + 1)))
         map_j = j - y_limits[0]
-        map = sub_band_as_numpy(band, y_limits)
+        map = reader.rows(y_limits)
         for i in range(*bounding_box_pixels.long):
-            if map[i, map_j] < value_range[0] + 1:
+            if map[i - map_x, map_j] < value_range[0] + 1:
                 continue
             x_limits = (int(max(0, i - distance)),
                         int(min(band.XSize, i + distance + 1)))
             minimum_distance = maximum_distance
             for (x, y) in product(range(*x_limits), range(map.shape[1])):
-                if map[x, y] > map[i, map_j]:
+                if map[x - map_x, y] > map[i - map_x, map_j]:
                     minimum_distance = min(minimum_distance, (x - i)**2 + (y - map_j)**2)
             if minimum_distance > dx2:
                 peaks.append((minimum_distance, i, j))
@@ -41,3 +100,401 @@ def largest_within_distance(band, distance, bounding_box_pixels=None):
                 not_a_peak += 1
     LOGGER.info(f"{linesep}Found {len(peaks)} and discarded {not_a_peak}.")
     return peaks
+
+
+def disk_footprint(distance):
+    """
+    Boolean footprint of the pixels within a distance of the center.
+    A pixel with an offset of exactly the distance is inside the disk,
+    matching the reference, which discards a peak when a higher pixel
+    is at a squared distance of at most distance squared.
+    """
+    half_width = int(distance)
+    axis = np.arange(-half_width, half_width + 1)
+    dx, dy = np.meshgrid(axis, axis, indexing="ij")
+    return dx**2 + dy**2 <= distance**2
+
+
+def _lowest_value(dtype):
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).min
+    return -np.inf
+
+
+def peaks_in_window(window, origin, distance, value_floor,
+                    bounding_box_pixels, raster_size):
+    """
+    Find peaks within part of a raster that has been read into memory.
+    A disk-shaped maximum filter picks candidates, and then each candidate
+    gets its exact distance to the nearest higher pixel.
+
+    The window must include every pixel within ``int(distance) + 1`` of the
+    bounding box, unless that pixel is off the edge of the raster.
+
+    Args:
+        window (np.array): Pixel values indexed as [x, y].
+        origin (Tuple[int,int]): Raster x and y of ``window[0, 0]``.
+        distance (float): Radius, in pixels, within which a peak is largest.
+        value_floor (int): Pixels below ``value_floor + 1`` are never peaks.
+        bounding_box_pixels (LongLat): Raster x and y ranges to report.
+        raster_size (Tuple[int,int]): XSize and YSize of the whole raster.
+
+    Returns:
+        (List[Tuple[int,int,int]], int): Peaks as squared distance, x, y,
+        ordered by y then x, and how many populated pixels were not peaks.
+    """
+    x0, y0 = origin
+    dx2 = distance**2
+    maximum_distance = max(raster_size)**2
+    box_x = (bounding_box_pixels.long[0] - x0, bounding_box_pixels.long[1] - x0)
+    box_y = (bounding_box_pixels.lat[0] - y0, bounding_box_pixels.lat[1] - y0)
+
+    neighborhood_max = maximum_filter(
+        window, footprint=disk_footprint(distance),
+        mode="constant", cval=_lowest_value(window.dtype),
+    )
+    box = window[box_x[0]:box_x[1], box_y[0]:box_y[1]]
+    populated = box >= value_floor + 1
+    candidate = populated & (box >= neighborhood_max[box_x[0]:box_x[1], box_y[0]:box_y[1]])
+    candidate_x, candidate_y = np.nonzero(candidate)
+    order = np.lexsort((candidate_x, candidate_y))
+
+    peaks = list()
+    for window_i, window_j in zip(candidate_x[order], candidate_y[order]):
+        i = int(window_i + box_x[0] + x0)
+        j = int(window_j + box_y[0] + y0)
+        # Same clipped square that the reference searches.
+        x_limits = (int(max(0, i - distance)),
+                    int(min(raster_size[0], i + distance + 1)))
+        y_limits = (int(max(0, j - distance)),
+                    int(min(raster_size[1], j + distance + 1)))
+        square = window[x_limits[0] - x0:x_limits[1] - x0,
+                        y_limits[0] - y0:y_limits[1] - y0]
+        higher_x, higher_y = np.nonzero(square > window[i - x0, j - y0])
+        if len(higher_x) > 0:
+            minimum_distance = int(np.min(
+                (higher_x + x_limits[0] - i)**2 + (higher_y + y_limits[0] - j)**2
+            ))
+        else:
+            minimum_distance = maximum_distance
+        if minimum_distance > dx2:
+            peaks.append((minimum_distance, i, j))
+    not_a_peak = int(np.count_nonzero(populated)) - len(peaks)
+    return peaks, not_a_peak
+
+
+def largest_within_distance_array(band, distance, bounding_box_pixels=None,
+                                  strip_rows=STRIP_ROWS, progress=True,
+                                  prefetch_depth=0):
+    """
+    Find the largest pixel within the given distance using NumPy and SciPy.
+    This returns the same peaks as
+    :func:`largest_within_distance_reference`. It reads the bounding box
+    in strips of rows, each with a halo of the peak distance, through a
+    :class:`RowWindowReader` so that rows shared by strips are read once.
+    With a prefetch depth, the next strips are read while this one is
+    searched.
+    """
+    value_floor = int(band.GetMinimum())
+    if not bounding_box_pixels:
+        bounding_box_pixels = LongLat([0, band.XSize], [0, band.YSize])
+    raster_size = (band.XSize, band.YSize)
+    halo = int(distance) + 1
+    reader = RowWindowReader(
+        band,
+        (bounding_box_pixels.long[0] - halo, bounding_box_pixels.long[1] + halo),
+        strip_rows + 2 * halo, prefetch_depth=prefetch_depth,
+        y_stop=bounding_box_pixels.lat[1] + halo,
+    )
+
+    peaks = list()
+    not_a_peak = 0
+    y_begin, y_end = bounding_box_pixels.lat
+    show = progressbar if progress else _quiet
+    with reader:
+        for strip_begin in show(range(y_begin, y_end, strip_rows)):
+            strip_end = min(y_end, strip_begin + strip_rows)
+            y_limits = (max(0, strip_begin - halo),
+                        min(band.YSize, strip_end + halo))
+            window = reader.rows(y_limits)
+            strip = LongLat(bounding_box_pixels.long, [strip_begin, strip_end])
+            strip_peaks, strip_discarded = peaks_in_window(
+                window, (reader.x_limits[0], y_limits[0]), distance,
+                value_floor, strip, raster_size,
+            )
+            peaks.extend(strip_peaks)
+            not_a_peak += strip_discarded
+    LOGGER.info(f"{linesep}Found {len(peaks)} and discarded {not_a_peak}.")
+    return peaks
+
+
+def tile_boxes(bounding_box_pixels, tile_size=TILE_SIZE):
+    """
+    Split a box of pixels into tiles no larger than the tile size on a side.
+
+    Args:
+        bounding_box_pixels (LongLat): Ranges of x and y pixels.
+        tile_size (int): Largest width and height of a tile.
+
+    Returns:
+        List[LongLat]: Tiles, ordered by y and then x.
+    """
+    tiles = list()
+    x_begin, x_end = bounding_box_pixels.long
+    y_begin, y_end = bounding_box_pixels.lat
+    for y in range(y_begin, y_end, tile_size):
+        for x in range(x_begin, x_end, tile_size):
+            tiles.append(LongLat([x, min(x_end, x + tile_size)],
+                                 [y, min(y_end, y + tile_size)]))
+    return tiles
+
+
+def _tile_peaks(task):
+    """Runs in a worker process, so it opens its own dataset."""
+    raster_file, distance, tile, engine, prefetch_depth = task
+    gdal.AllRegister()
+    raster = load_lspop(raster_file)
+    return largest_within_distance(
+        raster.band, distance, tile, engine, progress=False,
+        prefetch_depth=prefetch_depth)
+
+
+def parallel_largest_within_distance(raster_file, distance, bounding_box_pixels,
+                                     workers, tile_size=TILE_SIZE,
+                                     engine="array", prefetch_depth=0):
+    """
+    Find peaks in tiles using a pool of processes. Each tile reads its own
+    halo of the peak distance, so a peak depends only on the raster and
+    not on where tiles are cut. Peaks are merged in the same y-then-x order
+    as a serial run, so the output is identical.
+
+    Args:
+        raster_file (Path): LandScan population raster.
+        distance (float): Radius, in pixels, within which a peak is largest.
+        bounding_box_pixels (LongLat): Ranges of x and y pixels to search.
+        workers (int): Number of processes.
+        tile_size (int): Largest width and height of a tile.
+        engine (str): Which engine each tile uses.
+        prefetch_depth (int): Chunks of rows each tile reads ahead.
+
+    Returns:
+        List[Tuple[int,int,int]]: Squared distance, x, and y of each peak.
+    """
+    tiles = tile_boxes(bounding_box_pixels, tile_size)
+    LOGGER.info(f"Finding peaks in {len(tiles)} tiles with {workers} workers.")
+    tasks = [(raster_file, distance, tile, engine, prefetch_depth)
+             for tile in tiles]
+    peaks = list()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        counted = pool.map(run_counted, [_tile_peaks] * len(tasks), tasks)
+        for tile_peaks in progressbar(map(add_counts, counted),
+                                      max_value=len(tasks)):
+            peaks.extend(tile_peaks)
+    peaks.sort(key=lambda peak: (peak[2], peak[1]))
+    LOGGER.info(f"{linesep}Found {len(peaks)} in all tiles.")
+    return peaks
+
+
+IsolationMap = namedtuple(
+    "IsolationMap", "x y isolation cap floor_radius box raster_size")
+"""
+Squared distance from each pixel to the nearest higher pixel, searching
+a square out to ``cap`` pixels, for the pixels with no higher pixel within
+``floor_radius``. Pixels with no higher pixel in the square get the
+square of the larger raster dimension, as peaks do.
+"""
+
+
+def isolation_in_window(window, origin, cap, floor_radius, value_floor,
+                        bounding_box_pixels, raster_size):
+    """
+    Isolation of the pixels of a box within a window in memory.
+
+    Pixels are checked against offsets in order of increasing distance,
+    and each pixel leaves the search once one offset finds a higher pixel,
+    so most of the work is on the few pixels that are isolated.
+
+    Args:
+        window (np.array): Pixel values indexed as [x, y]. It must include
+            every raster pixel within ``int(cap) + 1`` of the box.
+        origin (Tuple[int,int]): Raster x and y of ``window[0, 0]``.
+        cap (float): Largest radius to search, in pixels.
+        floor_radius (float): Pixels with a higher pixel within this
+            radius are left out.
+        value_floor (int): Pixels below ``value_floor + 1`` are left out.
+        bounding_box_pixels (LongLat): Raster x and y ranges to report.
+        raster_size (Tuple[int,int]): XSize and YSize of the whole raster.
+
+    Returns:
+        (np.array, np.array, np.array): x, y and isolation, ordered by y
+        and then x.
+    """
+    x0, y0 = origin
+    maximum_distance = max(raster_size)**2
+    box_x = (bounding_box_pixels.long[0] - x0, bounding_box_pixels.long[1] - x0)
+    box_y = (bounding_box_pixels.lat[0] - y0, bounding_box_pixels.lat[1] - y0)
+    lowest = _lowest_value(window.dtype)
+
+    neighborhood_max = maximum_filter(
+        window, footprint=disk_footprint(floor_radius),
+        mode="constant", cval=lowest,
+    )
+    box = window[box_x[0]:box_x[1], box_y[0]:box_y[1]]
+    candidate = ((box >= value_floor + 1)
+                 & (box >= neighborhood_max[box_x[0]:box_x[1], box_y[0]:box_y[1]]))
+    candidate_x, candidate_y = np.nonzero(candidate)
+    order = np.lexsort((candidate_x, candidate_y))
+    candidate_x = candidate_x[order] + box_x[0]
+    candidate_y = candidate_y[order] + box_y[0]
+    values = window[candidate_x, candidate_y]
+
+    # Off the raster is lower than anything, like the clipped square
+    # the reference searches.
+    halo = int(cap)
+    padded = np.full((window.shape[0] + 2 * halo, window.shape[1] + 2 * halo),
+                     lowest, dtype=window.dtype)
+    padded[halo:halo + window.shape[0], halo:halo + window.shape[1]] = window
+    axis = np.arange(-halo, halo + 1)
+    offset_x, offset_y = [a.ravel() for a in np.meshgrid(axis, axis, indexing="ij")]
+    offset_d2 = offset_x**2 + offset_y**2
+    farther = offset_d2 > floor_radius**2
+    offset_x, offset_y, offset_d2 = offset_x[farther], offset_y[farther], offset_d2[farther]
+    by_distance = np.argsort(offset_d2, kind="stable")
+    offset_x, offset_y, offset_d2 = (
+        offset_x[by_distance], offset_y[by_distance], offset_d2[by_distance])
+    ring_starts = np.flatnonzero(np.diff(offset_d2, prepend=-1))
+
+    isolation = np.full(len(values), maximum_distance, dtype=np.int64)
+    unresolved = np.arange(len(values))
+    for ring_begin, ring_end in zip(ring_starts, np.append(ring_starts[1:], len(offset_d2))):
+        if len(unresolved) == 0:
+            break
+        px = candidate_x[unresolved] + halo
+        py = candidate_y[unresolved] + halo
+        higher = np.zeros(len(unresolved), dtype=np.bool_)
+        for ox, oy in zip(offset_x[ring_begin:ring_end], offset_y[ring_begin:ring_end]):
+            higher |= padded[px + ox, py + oy] > values[unresolved]
+        isolation[unresolved[higher]] = offset_d2[ring_begin]
+        unresolved = unresolved[~higher]
+    return candidate_x + x0, candidate_y + y0, isolation
+
+
+def isolation_map(band, cap, bounding_box_pixels=None, floor_radius=1,
+                  strip_rows=STRIP_ROWS, progress=True, prefetch_depth=0):
+    """
+    Isolation of every populated pixel in a box, so that peaks for any
+    radius from ``floor_radius`` to ``cap`` come from
+    :func:`peaks_from_isolation` without reading the raster again.
+
+    Args:
+        band: GDAL raster band of population.
+        cap (float): Largest peak radius this map can answer, in pixels.
+        bounding_box_pixels (LongLat): Ranges of x and y pixels to search.
+        floor_radius (float): Smallest peak radius it can answer.
+            Pixels that aren't peaks at this radius aren't stored.
+        strip_rows (int): Rows to handle per read.
+        progress (bool): Whether to show a progress bar.
+        prefetch_depth (int): Chunks of rows to read ahead on a thread.
+
+    Returns:
+        IsolationMap: Pixels that are peaks at the floor radius.
+    """
+    assert 0 < floor_radius <= cap
+    value_floor = int(band.GetMinimum())
+    if not bounding_box_pixels:
+        bounding_box_pixels = LongLat([0, band.XSize], [0, band.YSize])
+    count("pixels", int(np.diff(bounding_box_pixels.long)[0]
+                        * np.diff(bounding_box_pixels.lat)[0]))
+    raster_size = (band.XSize, band.YSize)
+    halo = int(cap) + 1
+    reader = RowWindowReader(
+        band,
+        (bounding_box_pixels.long[0] - halo, bounding_box_pixels.long[1] + halo),
+        strip_rows + 2 * halo, prefetch_depth=prefetch_depth,
+        y_stop=bounding_box_pixels.lat[1] + halo,
+    )
+    found = list()
+    y_begin, y_end = bounding_box_pixels.lat
+    show = progressbar if progress else _quiet
+    with reader:
+        for strip_begin in show(range(y_begin, y_end, strip_rows)):
+            strip_end = min(y_end, strip_begin + strip_rows)
+            y_limits = (max(0, strip_begin - halo),
+                        min(band.YSize, strip_end + halo))
+            strip = LongLat(bounding_box_pixels.long, [strip_begin, strip_end])
+            found.append(isolation_in_window(
+                reader.rows(y_limits), (reader.x_limits[0], y_limits[0]), cap,
+                floor_radius, value_floor, strip, raster_size,
+            ))
+    x, y, isolation = [np.concatenate([f[idx] for f in found])
+                       if found else np.zeros(0, dtype=np.int64)
+                       for idx in range(3)]
+    LOGGER.info(f"{linesep}Isolation map has {len(x)} pixels.")
+    return IsolationMap(
+        x.astype(np.int32), y.astype(np.int32), isolation, cap, floor_radius,
+        LongLat(list(bounding_box_pixels.long), list(bounding_box_pixels.lat)),
+        raster_size,
+    )
+
+
+def peaks_from_isolation(isolation, distance, bounding_box_pixels=None):
+    """
+    Peaks for a radius, by thresholding an isolation map.
+
+    These are the same pixels :func:`largest_within_distance` finds. Its
+    first column is the squared distance to a higher pixel within the square
+    of the peak radius, while this one searches the square of the cap, so
+    for the few peaks whose nearest higher pixel is out past the corner of
+    the smaller square, this reports the nearer distance.
+
+    Args:
+        isolation (IsolationMap): From :func:`isolation_map`.
+        distance (float): Peak radius in pixels.
+        bounding_box_pixels (LongLat): Part of the map to report.
+            Defaults to all of it.
+
+    Returns:
+        List[Tuple[int,int,int]]: Squared distance, x, and y of each peak,
+        ordered by y and then x.
+    """
+    if not isolation.floor_radius <= distance <= isolation.cap:
+        raise ValueError(
+            f"Peak radius {distance} is outside the isolation map's range "
+            f"{isolation.floor_radius} to {isolation.cap}.")
+    keep = isolation.isolation > distance**2
+    if bounding_box_pixels:
+        box = isolation.box
+        if (bounding_box_pixels.long[0] < box.long[0]
+                or bounding_box_pixels.long[1] > box.long[1]
+                or bounding_box_pixels.lat[0] < box.lat[0]
+                or bounding_box_pixels.lat[1] > box.lat[1]):
+            raise ValueError(
+                f"Box {bounding_box_pixels} isn't within the isolation "
+                f"map's box {box}.")
+        keep &= ((isolation.x >= bounding_box_pixels.long[0])
+                 & (isolation.x < bounding_box_pixels.long[1])
+                 & (isolation.y >= bounding_box_pixels.lat[0])
+                 & (isolation.y < bounding_box_pixels.lat[1]))
+    return list(zip(isolation.isolation[keep].tolist(),
+                    isolation.x[keep].tolist(), isolation.y[keep].tolist()))
+
+
+def save_isolation(path, isolation):
+    """Write an isolation map as a compressed ``.npz``."""
+    np.savez_compressed(
+        str(path), x=isolation.x, y=isolation.y, isolation=isolation.isolation,
+        cap=isolation.cap, floor_radius=isolation.floor_radius,
+        box=np.array([isolation.box.long, isolation.box.lat], dtype=np.int64),
+        raster_size=np.array(isolation.raster_size, dtype=np.int64),
+    )
+
+
+def load_isolation(path):
+    """Read a map written by :func:`save_isolation`."""
+    with np.load(str(path)) as saved:
+        box = saved["box"].tolist()
+        return IsolationMap(
+            saved["x"], saved["y"], saved["isolation"], float(saved["cap"]),
+            float(saved["floor_radius"]), LongLat(box[0], box[1]),
+            tuple(saved["raster_size"].tolist()),
+        )
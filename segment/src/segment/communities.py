@@ -1,91 +1,506 @@
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx as nx
-from networkx.algorithms.flow import shortest_augmenting_path
+import numpy as np
+import pandas as pd
+
+from .flow_graph import FlowGraph, as_flow_graph, copy_groups_to_networkx
+from .instrument import add_counts, count, run_counted
+from .partition import PARTITIONS
 
 LOGGER = logging.getLogger(__name__)
+HDF_COMPRESSION = dict(complevel=5, complib="zlib")
+
 
+def _split_components(flow_graph, components, maximum_node_count,
+                      group_cnt, belonging_tree, partition="min-cut"):
+    """
+    Splits each component until all pieces are small enough, setting
+    groups on the flow graph and adding groups to the belonging tree.
+    Returns the next unused group id.
+    """
+    cut_pieces = PARTITIONS[partition]
+    work = list()
+    for parent_component in components:
+        belonging_tree.add_node(group_cnt)
+        flow_graph.group[parent_component] = group_cnt
+        work.append([parent_component, group_cnt])
+        group_cnt += 1
+    if len(work) > 1:
+        LOGGER.info(f"There are {len(work)} connected components at the start.")
 
-def _set_group(graph, nodes, parent_id):
-    for n in nodes:
-        graph.nodes[n]["group"] = parent_id
+    while work:
+        parent_component, parent_id = work.pop()
+        count("cuts")
+        for child_component in cut_pieces(flow_graph, parent_component):
+            flow_graph.group[child_component] = group_cnt
+            belonging_tree.add_edge(group_cnt, parent_id)
+            if len(child_component) > maximum_node_count:
+                work.append([child_component, group_cnt])
+            group_cnt += 1
+    return group_cnt
 
 
-def split_graph(flow_graph, maximum_node_count, group_cnt):
+def split_graph(flow_graph, maximum_node_count, group_cnt, partition="min-cut"):
     """
     Given a graph, splits it hierarchically until every piece
     is smaller than the given maximum node count.
-    This uses an algorithm from networkx called "minimum edge cut."
+    By default, this uses an algorithm from networkx called
+    "minimum edge cut." The "spectral" partition instead bisects along
+    the Fiedler vector of the capacity-weighted Laplacian.
     It uses a depth-first search for subgraphs.
 
     Args:
-        flow_graph (nx.Graph): Has flows on edges.
+        flow_graph (FlowGraph|nx.Graph): Has flows on edges.
         maximum_node_count (int): No subgraph should be larger than this.
+        group_cnt (int): First group id to assign.
+        partition (str): A key of :data:`segment.partition.PARTITIONS`.
 
     Returns:
-        (nx.Graph, nx.DiGraph, int):
+        (FlowGraph|nx.Graph, nx.DiGraph, int):
             The original graph, marking which nodes belong
             to which subgraphs, and a tree of which
             subgraphs have which parents.
 
     """
-    work = list()
+    graph = as_flow_graph(flow_graph)
     belonging_tree = nx.DiGraph()
-    for parent_component in nx.connected_components(flow_graph):
-        belonging_tree.add_node(group_cnt)
-        _set_group(flow_graph, parent_component, group_cnt)
-        work.append([parent_component, group_cnt])
-        group_cnt += 1
-    if len(work) > 1:
-        LOGGER.info(f"There are {len(work)} connected components at the start.")
+    group_cnt = _split_components(
+        graph, graph.components(), maximum_node_count, group_cnt,
+        belonging_tree, partition,
+    )
+    if not isinstance(flow_graph, FlowGraph):
+        copy_groups_to_networkx(graph, flow_graph)
+    return flow_graph, belonging_tree, group_cnt
 
-    while work:
-        parent_component, parent_id = work.pop()
-        parent_graph = nx.Graph(flow_graph.subgraph(parent_component))
-        remove_edges = nx.minimum_edge_cut(
-            parent_graph,
-            flow_func=shortest_augmenting_path,
+
+def _subtree_job(capacity, maximum_node_count, partition):
+    """
+    Runs in a worker process. Splits one component alone, numbering
+    the component 0 and its descendants from 1, in the order a serial
+    split would number them.
+
+    Returns:
+        (np.array, List[Tuple[int,int]], int): Relative group of each
+        node, hierarchy edges from child to parent, and how many
+        group ids were used.
+    """
+    local = FlowGraph(capacity, np.zeros((capacity.shape[0], 2)))
+    tree = nx.DiGraph()
+    group_cnt = _split_components(
+        local, [np.arange(capacity.shape[0])], maximum_node_count, 0, tree,
+        partition,
+    )
+    return local.group, list(tree.edges), group_cnt
+
+
+def _parallel_subtree(pool, flow_graph, component, maximum_node_count,
+                      partition, expand_size):
+    """
+    Start splitting a component in the pool. A component larger than
+    ``expand_size`` is cut here first, so that its pieces run in
+    parallel. Returns a function that waits for the result, in the
+    format of :func:`_subtree_job`.
+
+    A serial split finishes all descendants of a piece before going on
+    to the piece pushed before it, so each piece's descendants get a
+    contiguous block of ids. That lets pieces be numbered after the fact.
+    """
+    if len(component) <= expand_size:
+        future = pool.submit(
+            run_counted, _subtree_job, flow_graph.sub_capacity(component),
+            maximum_node_count, partition,
         )
-        parent_graph.remove_edges_from(remove_edges)
+        return lambda: add_counts(future.result())
 
-        for child_component in nx.connected_components(parent_graph):
-            _set_group(flow_graph, child_component, group_cnt)
-            belonging_tree.add_edge(group_cnt, parent_id)
-            if len(child_component) > maximum_node_count:
-                work.append([child_component, group_cnt])
-            group_cnt += 1
-    return flow_graph, belonging_tree, group_cnt
+    children = PARTITIONS[partition](flow_graph, component)
+    count("cuts")
+    pending = list()
+    for child in children:
+        if len(child) > maximum_node_count:
+            pending.append(_parallel_subtree(
+                pool, flow_graph, child, maximum_node_count, partition,
+                expand_size,
+            ))
+        else:
+            pending.append(None)
+
+    def resolve():
+        labels = np.zeros(len(component), dtype=np.int64)
+        edges = list()
+        positions = [np.searchsorted(component, child) for child in children]
+        for child_idx, position in enumerate(positions):
+            labels[position] = child_idx + 1
+            edges.append((child_idx + 1, 0))
+        next_id = len(children) + 1
+        # The work list is a stack, so the last piece is split first.
+        for child_idx in reversed(range(len(children))):
+            if pending[child_idx] is None:
+                continue
+            child_id = child_idx + 1
+            sub_labels, sub_edges, sub_cnt = pending[child_idx]()
+            labels[positions[child_idx]] = np.where(
+                sub_labels == 0, child_id, next_id + sub_labels - 1)
+            edges.extend(
+                (next_id + a - 1, child_id if b == 0 else next_id + b - 1)
+                for (a, b) in sub_edges
+            )
+            next_id += sub_cnt - 1
+        return labels, edges, next_id
+
+    return resolve
+
+
+def split_disconnected_graph(flow_graph, maximum_node_count, partition="min-cut",
+                             workers=1, previous=None):
+    """
+    Assigns a group to every city. Cities with no flows are group 1.
+    Connected components that are small enough are one group each,
+    and larger ones are split by :func:`split_graph`.
+
+    With more than one worker, large components, and large pieces of
+    them, are split in a pool of processes. Group ids are assigned
+    afterwards in serial order, so groups and hierarchy are identical
+    to a serial run.
+
+    Given a previous split of a graph with the same node keys, such as
+    one from :func:`load_segmented`, a large component whose nodes and
+    capacities haven't changed keeps its previous groups instead of
+    being split again. The previous split must have used the same
+    maximum node count and partition, which :func:`load_previous`
+    checks.
+
+    Args:
+        flow_graph (FlowGraph|nx.Graph): Has flows on edges.
+        maximum_node_count (int): No group should be larger than this.
+        partition (str): How to cut large components.
+        workers (int): Number of processes.
+        previous (FlowGraph, nx.DiGraph): A graph with groups, and
+            its hierarchy.
+
+    Returns:
+        (FlowGraph|nx.Graph, nx.DiGraph): The same graph with groups set,
+        and the tree of groups, where edges point from child to parent.
+    """
+    graph = as_flow_graph(flow_graph)
+    components = graph.components()
+    if previous is not None:
+        split = _unchanged_splits(
+            graph, components, maximum_node_count, *previous)
+    else:
+        split = dict()
+    if workers > 1:
+        large_total = sum(
+            len(c) for (component_idx, c) in enumerate(components)
+            if len(c) > maximum_node_count and component_idx not in split
+        )
+        expand_size = max(maximum_node_count, large_total // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for component_idx, reduced in enumerate(components):
+                if (len(reduced) > maximum_node_count
+                        and component_idx not in split):
+                    split[component_idx] = _parallel_subtree(
+                        pool, graph, reduced, maximum_node_count, partition,
+                        expand_size,
+                    )
+            hierarchy = _assign_groups(
+                graph, components, maximum_node_count, partition, split)
+    else:
+        hierarchy = _assign_groups(
+            graph, components, maximum_node_count, partition, split)
+
+    if not isinstance(flow_graph, FlowGraph):
+        copy_groups_to_networkx(graph, flow_graph)
+    return flow_graph, hierarchy
+
+
+def _unchanged_splits(graph, components, maximum_node_count, previous_graph,
+                      previous_hierarchy):
+    """
+    Find large components that are the same as a component of the
+    previous graph, with the same node keys and capacities.
+
+    A component's groups are a contiguous block of ids that starts with
+    its top group, so each is returned in the format of
+    :func:`_subtree_job`, ready for :func:`_assign_groups` to renumber.
 
+    Returns:
+        Dict[int,function]: For each unchanged component index, a function
+        that returns relative groups, hierarchy edges, and group count.
+    """
+    previous_graph = as_flow_graph(previous_graph)
+    order = np.argsort(previous_graph.nodes, kind="stable")
+    previous_keys = previous_graph.nodes[order]
+    parents = {child: parent for (child, parent) in previous_hierarchy.edges}
+    levels = group_levels(previous_hierarchy)
+    group_sizes = np.bincount(previous_graph.group)
+    reused = dict()
+    for component_idx, reduced in enumerate(components):
+        if len(reduced) <= maximum_node_count:
+            continue
+        position = np.searchsorted(previous_keys, graph.nodes[reduced])
+        position = np.minimum(position, len(previous_keys) - 1)
+        unchanged = (len(previous_keys) > 0
+                     and np.array_equal(previous_keys[position],
+                                        graph.nodes[reduced]))
+        if unchanged:
+            before = order[position]
+            groups = previous_graph.group[before]
+            top = int(groups.min())
+            while top in parents:
+                top = parents[top]
+            used_cnt = levels.get(top, 0) + 1
+            unchanged = (
+                groups.max() < top + used_cnt
+                and group_sizes[top:top + used_cnt].sum() == len(reduced)
+                and (graph.sub_capacity(reduced)
+                     != previous_graph.sub_capacity(before)).nnz == 0
+            )
+        if unchanged:
+            count("reused_components")
+            edges = [(child - top, parents[child] - top)
+                     for child in range(top + 1, top + used_cnt)]
+            reused[component_idx] = (
+                lambda result=(groups - top, edges, used_cnt): result)
+        else:
+            count("changed_components")
+    LOGGER.info(f"Reusing groups of {len(reused)} unchanged components")
+    return reused
 
-def split_disconnected_graph(flow_graph, maximum_node_count):
+
+def _assign_groups(graph, components, maximum_node_count, partition, split):
+    """
+    Numbers groups in component order. Components in ``split`` have
+    been split already, and the rest are split here.
+    """
     group_cnt = 2
     hierarchy = nx.DiGraph()
     hierarchy.add_node(1)  # The loners
-    for reduced in nx.connected_components(flow_graph):
-        # Each reduced is a set of node keys.
-        reduced_graph = flow_graph.subgraph(reduced)
-        if len(reduced) > maximum_node_count:
+    for component_idx, reduced in enumerate(components):
+        # Each reduced is an array of node indices.
+        if component_idx in split:
+            labels, edges, used_cnt = split[component_idx]()
+            graph.group[reduced] = group_cnt + labels
+            hierarchy.add_node(group_cnt)
+            hierarchy.add_edges_from(
+                (group_cnt + a, group_cnt + b) for (a, b) in edges)
+            group_cnt += used_cnt
+        elif len(reduced) > maximum_node_count:
             LOGGER.debug(f"Connected component size {len(reduced)}")
-            segmented, sub_hierarchy, group_cnt = split_graph(
-                reduced_graph, maximum_node_count, group_cnt
+            group_cnt = _split_components(
+                graph, [reduced], maximum_node_count, group_cnt, hierarchy,
+                partition,
             )
-            hierarchy = nx.union(hierarchy, sub_hierarchy)
-            for n in segmented.nodes:
-                flow_graph.nodes[n]["group"] = segmented.nodes[n]["group"]
         elif len(reduced) > 1:
             LOGGER.debug(f"Already small component size {len(reduced)}")
-            _set_group(flow_graph, reduced, group_cnt)
+            graph.group[reduced] = group_cnt
             hierarchy.add_node(group_cnt)
             group_cnt += 1
         else:
-            _set_group(flow_graph, reduced, 1)
+            graph.group[reduced] = 1
+    return hierarchy
 
-    return flow_graph, hierarchy
 
+def group_levels(hierarchy):
+    """
+    How many groups are inside each group, at any depth. Hierarchy edges
+    point from child to parent, so this is ``len(nx.ancestors(hierarchy,
+    group))``, computed for all groups in one pass from the leaves up.
+
+    Returns:
+        Dict[int,int]: Level of each group in the hierarchy.
+    """
+    levels = dict.fromkeys(hierarchy.nodes, 0)
+    for child in nx.topological_sort(hierarchy):
+        for parent in hierarchy.successors(child):
+            levels[parent] += levels[child] + 1
+    return levels
+
+
+def save_pandas(graph, hierarchy, output_file, maximum_node_count=None,
+                partition=None):
+    """
+    Write cities, flows and groups as compressed HDF5 tables.
 
-def save_pandas(graph, hierarchy, output_file):
+    * ``nodes``, indexed by node, has ``long``, ``lat``, ``group``
+      and ``level``, the level of the node's group.
+    * ``edges`` has each edge once, as ``first``, ``second``, and ``capacity``,
+      with the groups of its two ends, ``first_group`` and ``second_group``.
+    * ``hierarchy``, indexed by group, has ``parent``, which is 0 for a
+      top-level group, and ``level``.
+
+    Group columns are indexed, so :func:`load_group` reads only the rows
+    of the groups it asks for. The maximum node count and partition of
+    the split are attributes of ``hierarchy``, for :func:`load_previous`.
+
+    Args:
+        graph (FlowGraph|nx.Graph): Groups set by :func:`split_disconnected_graph`.
+        hierarchy (nx.DiGraph): Edges from child group to parent group.
+        output_file (Path): HDF5 file, which is replaced.
+        maximum_node_count (int): Largest group size given to the split.
+        partition (str): How the split cut large components.
+
+    Raises:
+        ValueError: If node keys aren't integers. Relabel a networkx graph
+            with ``nx.convert_node_labels_to_integers`` first.
+    """
+    flow_graph = as_flow_graph(graph)
+    keys = _integer_keys(flow_graph.nodes)
+    levels = group_levels(hierarchy)
+    unique_groups, group_index = np.unique(flow_graph.group, return_inverse=True)
+    group_level = np.array([levels.get(g, 0) for g in unique_groups.tolist()],
+                           dtype=np.int64)
+    nodes = pd.DataFrame(
+        dict(long=flow_graph.longlat[:, 0], lat=flow_graph.longlat[:, 1],
+             group=flow_graph.group, level=group_level[group_index]),
+        index=pd.Index(keys, name="node"),
+    )
+    first, second, capacity = flow_graph.edges()
+    edges = pd.DataFrame(dict(
+        first=keys[first], second=keys[second], capacity=capacity,
+        first_group=flow_graph.group[first],
+        second_group=flow_graph.group[second],
+    ))
+    parents = {child: parent for (child, parent) in hierarchy.edges}
+    groups = sorted(hierarchy.nodes)
+    tree = pd.DataFrame(
+        dict(parent=np.array([parents.get(g, 0) for g in groups], dtype=np.int64),
+             level=np.array([levels[g] for g in groups], dtype=np.int64)),
+        index=pd.Index(np.array(groups, dtype=np.int64), name="group"),
+    )
+    with pd.HDFStore(str(output_file), mode="w", **HDF_COMPRESSION) as store:
+        store.put("nodes", nodes, format="table", data_columns=["group"])
+        store.put("edges", edges, format="table",
+                  data_columns=["first_group", "second_group"])
+        store.put("hierarchy", tree, format="table")
+        attributes = store.get_storer("hierarchy").attrs
+        attributes.maximum_node_count = maximum_node_count
+        attributes.partition = partition
+
+
+def _integer_keys(nodes):
+    """Node keys as int64, which is what the ``node`` index holds."""
+    if nodes.dtype.kind in "iu":
+        return nodes.astype(np.int64)
+    not_integer = [key for key in nodes.tolist()
+                   if isinstance(key, bool) or not isinstance(key, (int, np.integer))]
+    if not_integer:
+        raise ValueError(
+            f"Node keys must be integers to save, but {len(not_integer)} "
+            f"are not, such as {not_integer[0]!r}.")
+    return nodes.astype(np.int64)
+
+
+def load_hierarchy(input_file):
+    """The tree of groups written by :func:`save_pandas`."""
+    tree = pd.read_hdf(str(input_file), "hierarchy")
+    hierarchy = nx.DiGraph()
+    hierarchy.add_nodes_from(tree.index.tolist())
+    hierarchy.add_edges_from(
+        (group, parent) for (group, parent)
+        in zip(tree.index.tolist(), tree["parent"].tolist()) if parent != 0
+    )
+    return hierarchy
+
+
+def _frames_to_flow_graph(nodes, edges):
+    position = nodes.index.get_indexer
+    flow_graph = FlowGraph.from_edges(
+        len(nodes), position(edges["first"].values),
+        position(edges["second"].values), edges["capacity"].values,
+        nodes[["long", "lat"]].values, nodes=nodes.index.values,
+    )
+    flow_graph.group = nodes["group"].values.astype(np.int64)
+    return flow_graph
+
+
+def load_flow_graph(input_file):
+    """
+    Read the ``nodes`` and ``edges`` tables of a file in the format of
+    :func:`save_pandas`, which needn't have a hierarchy yet.
 
-    df = nx.to_pandas_adjacency(graph)
-    df.to_hdf(str(output_file), "graph", mode="a", format="fixed")
-    tree = nx.to_pandas_adjacency(hierarchy)
-    tree.to_hdf(str(output_file), "belonging", mode="a", format="fixed")
+    Returns:
+        FlowGraph: Keyed by the node index of the file.
+    """
+    with pd.HDFStore(str(input_file), mode="r") as store:
+        return _frames_to_flow_graph(store["nodes"], store["edges"])
+
+
+def load_segmented(input_file):
+    """
+    Read all of a file written by :func:`save_pandas`.
+
+    Returns:
+        (FlowGraph, nx.DiGraph): Graph with groups, and the group hierarchy.
+    """
+    return load_flow_graph(input_file), load_hierarchy(input_file)
+
+
+def load_split_parameters(input_file):
+    """
+    The maximum node count and partition that :func:`save_pandas`
+    recorded, each None if it wasn't recorded.
+    """
+    with pd.HDFStore(str(input_file), mode="r") as store:
+        attributes = store.get_storer("hierarchy").attrs
+        return (getattr(attributes, "maximum_node_count", None),
+                getattr(attributes, "partition", None))
+
+
+def load_previous(input_file, maximum_node_count, partition):
+    """
+    Read a previous split to give to :func:`split_disconnected_graph`.
+    Its groups are only right for a split with the same maximum node
+    count and partition.
+
+    Args:
+        input_file (Path): Written by :func:`save_pandas`.
+        maximum_node_count (int): Largest group size of the new split.
+        partition (str): How the new split cuts large components.
+
+    Returns:
+        (FlowGraph, nx.DiGraph): As from :func:`load_segmented`.
+
+    Raises:
+        ValueError: If the file was split with another maximum node count
+            or partition, or doesn't record them.
+    """
+    recorded = load_split_parameters(input_file)
+    if recorded != (maximum_node_count, partition):
+        raise ValueError(
+            f"{input_file} was split with largest component {recorded[0]} "
+            f"and partition {recorded[1]}, not {maximum_node_count} "
+            f"and {partition}, so its groups can't be reused.")
+    return load_segmented(input_file)
+
+
+def load_group(input_file, group):
+    """
+    Read one group and the groups inside it, without reading the rest
+    of the nodes and edges. Nodes belong to groups that aren't split,
+    and the split numbers the groups inside a group as one block of ids
+    that starts with its first child, so this selects a range of group
+    ids, which PyTables answers from the index however large the block.
+
+    Args:
+        input_file (Path): Written by :func:`save_pandas`.
+        group (int): Which group.
+
+    Returns:
+        FlowGraph: Nodes of the group, keyed by their node ids in the file,
+        with the edges among them.
+    """
+    hierarchy = load_hierarchy(input_file)
+    first = min(hierarchy.predecessors(group), default=group)
+    last = first + max(group_levels(hierarchy)[group] - 1, 0)
+    with pd.HDFStore(str(input_file), mode="r") as store:
+        nodes = store.select(
+            "nodes", where=f"group >= {first} & group <= {last}")
+        edges = store.select(
+            "edges",
+            where=(f"first_group >= {first} & first_group <= {last}"
+                   f" & second_group >= {first} & second_group <= {last}"),
+        )
+    LOGGER.debug(f"Group {group} has {len(nodes)} nodes and {len(edges)} edges")
+    return _frames_to_flow_graph(nodes, edges)
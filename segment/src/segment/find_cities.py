@@ -5,8 +5,10 @@ specified bounding box of longitude and latitude.
 Some longitudes and latitudes of interest:
 Africa bounding box: Longitude -20, 55. Latitude -40, 40.
 
-If you want to see which records.txt entry corresponds to a CSV,
-run sha256sum on the file, and its hash will show up in records.txt.
+Peaks are written as a NumPy .npy of records, or as CSV if the
+output file ends in .csv. If you want to see which records.txt entry
+corresponds to a peaks file, run sha256sum on the file, and its hash
+will show up in records.txt.
 The records.txt file is in TOML format.
 """
 import csv
@@ -18,23 +20,52 @@ from hashlib import sha256
 from pathlib import Path
 from secrets import token_hex
 
+import numpy as np
 from osgeo import gdal
 
-from .input_data import load_lspop
+from .input_data import load_lspop, PEAK_DTYPE
+from .instrument import StageRecorder
 from .raster_transform import LongLat, pixel_corners_of_longlat_box
-from .city_find import largest_within_distance
+from .stage_cache import StageCache
+from .city_find import (
+    largest_within_distance, parallel_largest_within_distance, TILE_SIZE,
+    isolation_map, load_isolation, peaks_from_isolation, save_isolation,
+)
 
 LOGGER = logging.getLogger(__name__)
 
 
+class HashingWriter:
+    """Writes to a binary file and hashes the bytes on the way."""
+    def __init__(self, out):
+        self.out = out
+        self.digest = sha256()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.digest.update(data)
+        return self.out.write(data)
+
+
 def write_peaks(city_peaks, output_file):
-    with output_file.open("w") as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(["squared distance", "x", "y"])
-        for dx, x, y in city_peaks:
-            writer.writerow([str(dx), str(x), str(y)])
-    m = sha256(output_file.open("rb").read())
-    return m.hexdigest()
+    """
+    Write peaks as a ``.npy`` of :data:`PEAK_DTYPE` records, or as CSV
+    when the file ends in ``.csv``.
+
+    Returns:
+        str: The sha256 of the file, computed while writing it.
+    """
+    with output_file.open("wb") as out:
+        hashing = HashingWriter(out)
+        if output_file.suffix == ".csv":
+            writer = csv.writer(hashing, quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(["squared distance", "x", "y"])
+            writer.writerows(city_peaks)
+        else:
+            peaks = np.array(list(city_peaks), dtype=PEAK_DTYPE)
+            np.lib.format.write_array(hashing, peaks, allow_pickle=False)
+    return hashing.digest.hexdigest()
 
 
 def parser():
@@ -51,18 +82,50 @@ def parser():
     parse_obj.add_argument("--lspop", type=Path, default=landscan_file,
                            help=("Path to directory containing LandSat "
                                  "population raster"))
-    parse_obj.add_argument("--peaks", type=Path, default="city_peaks.csv",
-                           help=("Path to output csv file of peak radius, "
-                                 "peak x, peak y."))
+    parse_obj.add_argument("--peaks", type=Path, default="city_peaks.npy",
+                           help=("Path to output file of squared peak "
+                                 "distance, peak x, peak y. Either .npy "
+                                 "or .csv."))
     parse_obj.add_argument("--peak-radius", type=float, default=20,
                            help=("How many LandSat pixels around a peak must "
                                  "be less than that peak"))
+    parse_obj.add_argument("--engine", choices=["array", "reference"],
+                           default="array",
+                           help=("Array engine is fast. Reference engine is "
+                                 "slow and there to check the array engine."))
+    parse_obj.add_argument("--workers", type=int, default=1,
+                           help=("Number of processes. More than one splits "
+                                 "the bounding box into tiles."))
+    parse_obj.add_argument("--tile-size", type=int, default=TILE_SIZE,
+                           help="Width and height of a tile in pixels")
+    parse_obj.add_argument("--prefetch-depth", type=int, default=2,
+                           help=("Chunks of rows to read ahead on a thread "
+                                 "while peaks are found. Zero reads in turn. "
+                                 "Stalls in record.jsonl show whether reads "
+                                 "keep up."))
+    parse_obj.add_argument("--isolation-map", type=Path, default=None,
+                           help=("An .npz of each pixel's distance to the "
+                                 "nearest higher pixel. If it exists, peaks "
+                                 "come from it for any radius up to its cap, "
+                                 "without reading the raster. Otherwise it "
+                                 "is made and saved."))
+    parse_obj.add_argument("--isolation-cap", type=float, default=None,
+                           help=("Largest peak radius a new isolation map "
+                                 "answers. Defaults to the peak radius."))
+    parse_obj.add_argument("--cache-dir", type=Path, default=None,
+                           help=("Directory that keeps peaks, keyed by the "
+                                 "population file's hash and parameters."))
+    parse_obj.add_argument("--cache-size", type=float, default=20,
+                           help="Largest size of the cache directory in GB.")
     parse_obj.add_argument("--long", type=float, nargs="+",
                            default=[kampala.long, moroto.long],
                            help="Min and max longitude")
     parse_obj.add_argument("--lat", type=float, nargs="+",
                            default=[kampala.lat, moroto.lat],
                            help="Min and max latitude")
+    parse_obj.add_argument("--profile-stage", nargs="+", default=[],
+                           choices=["load", "peaks", "write"],
+                           help="Stages to run under cProfile")
     parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
                            default=0)
     parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
@@ -70,9 +133,10 @@ def parser():
     return parse_obj
 
 
-def write_args(out_path, args, additional):
+def write_args(out_path, args, additional, token=None):
+    token = token if token else token_hex(8)
     with out_path.open("a") as out:
-        print(f"[{token_hex(8)}]", file=out)
+        print(f"[{token}]", file=out)
         print(f"when={datetime.now()}", file=out)
         for arg in ["lspop", "peaks", "long", "lat"]:
             value = getattr(args, arg)
@@ -89,14 +153,19 @@ def entry():
     logging.basicConfig(level=logging_level)
 
     assert args.peak_radius > 0
+    assert args.workers > 0
     if not args.peaks.parent.exists():
         LOGGER.error("Parent directory for output peaks csv doesn't exist.")
     assert args.lspop.exists()
     assert len(args.long) == 2, "Give a min and max longitude"
     assert len(args.lat) == 2, "Give a min and max latitude"
+    if args.isolation_map is not None:
+        assert args.isolation_map.suffix == ".npz", "Isolation map is an .npz"
 
     gdal.AllRegister()  # Initializes drivers to read files.
-    lspop = load_lspop(args.lspop)
+    recorder = StageRecorder(profile=args.profile_stage)
+    with recorder.stage("load"):
+        lspop = load_lspop(args.lspop)
 
     bounding_box = [LongLat(args.long[i], args.lat[i]) for i in [0, 1]]
     geo_transform = lspop.dataset.GetGeoTransform()
@@ -106,9 +175,67 @@ def entry():
         f"pixels {uganda_pixel_range} from band x={lspop.band.XSize} "
         f"y={lspop.band.YSize}."
     )
-    city_peaks = largest_within_distance(lspop.band, args.peak_radius, uganda_pixel_range)
-    peaks_hash = write_peaks(city_peaks, args.peaks)
-    write_args(Path("record.txt"), args, {"peaks-hash": peaks_hash})
+    city_peaks = None
+    additional = dict()
+    if args.cache_dir is not None:
+        cache = StageCache(args.cache_dir, int(args.cache_size * 2**30))
+        inputs = dict(lspop=args.lspop)
+        parameters = dict(pixels=uganda_pixel_range,
+                          peak_radius=args.peak_radius,
+                          from_isolation=args.isolation_map is not None)
+        if args.isolation_map is not None:
+            # Squared distances of peaks come from the map's cap.
+            if args.isolation_map.exists():
+                inputs["isolation_map"] = args.isolation_map
+            else:
+                parameters["isolation_cap"] = isolation_cap(args)
+        peaks_key = cache.key("peaks", inputs, parameters)
+        additional["cache-key"] = peaks_key
+        city_peaks = cache.load(peaks_key)
+    if city_peaks is None:
+        with recorder.stage("peaks") as counts:
+            city_peaks = find_peaks(args, lspop, uganda_pixel_range)
+            counts["peaks"] = len(city_peaks)
+        if args.cache_dir is not None:
+            cache.store(peaks_key, city_peaks)
+    with recorder.stage("write"):
+        peaks_hash = write_peaks(city_peaks, args.peaks)
+    additional["peaks-hash"] = peaks_hash
+    write_args(Path("record.txt"), args, additional, recorder.token)
+    recorder.write(Path("record.jsonl"), "citypeaks")
+
+
+def isolation_cap(args):
+    """Cap of a new isolation map, which defaults to the peak radius."""
+    return args.isolation_cap if args.isolation_cap else args.peak_radius
+
+
+def find_peaks(args, lspop, pixel_range):
+    if args.isolation_map is not None:
+        if args.isolation_map.exists():
+            LOGGER.info(f"Thresholding isolation map {args.isolation_map}")
+            isolation = load_isolation(args.isolation_map)
+            raster_size = (lspop.band.XSize, lspop.band.YSize)
+            if tuple(isolation.raster_size) != raster_size:
+                raise ValueError(
+                    f"Isolation map {args.isolation_map} is for a raster of "
+                    f"{isolation.raster_size} pixels, not {raster_size}.")
+        else:
+            isolation = isolation_map(lspop.band, isolation_cap(args),
+                                      pixel_range,
+                                      prefetch_depth=args.prefetch_depth)
+            save_isolation(args.isolation_map, isolation)
+        return peaks_from_isolation(isolation, args.peak_radius, pixel_range)
+    elif args.workers > 1:
+        return parallel_largest_within_distance(
+            args.lspop, args.peak_radius, pixel_range, args.workers,
+            args.tile_size, args.engine, args.prefetch_depth,
+        )
+    else:
+        return largest_within_distance(
+            lspop.band, args.peak_radius, pixel_range, args.engine,
+            prefetch_depth=args.prefetch_depth,
+        )
 
 
 if __name__ == "__main__":
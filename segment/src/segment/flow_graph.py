@@ -0,0 +1,168 @@
+"""
+A compact graph of cities and the flows among them, kept as arrays.
+Capacities are a symmetric SciPy CSR matrix, and coordinates and group
+ids are NumPy arrays indexed by node, so a graph of 100k cities takes
+megabytes instead of gigabytes of Python dicts. Subsets of nodes are
+index arrays into the same graph rather than copies of it.
+"""
+import logging
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, triu
+from scipy.sparse.csgraph import connected_components
+
+LOGGER = logging.getLogger(__name__)
+
+
+def components_of(adjacency):
+    """
+    Connected components of a symmetric sparse matrix.
+
+    Args:
+        adjacency (scipy.sparse matrix): Nonzero entries are edges.
+
+    Returns:
+        List[np.array]: Sorted node indices of each component, with
+        components ordered by their smallest node, which is the order
+        networkx would find them.
+    """
+    if adjacency.shape[0] == 0:
+        return list()
+    count, labels = connected_components(adjacency, directed=False)
+    order = np.argsort(labels, kind="stable")
+    pieces = np.split(order, np.cumsum(np.bincount(labels, minlength=count))[:-1])
+    pieces.sort(key=lambda piece: piece[0])
+    return pieces
+
+
+class FlowGraph:
+    """
+    Cities with flows between them.
+
+    Args:
+        capacity (scipy.sparse matrix): Symmetric, shape (nodes, nodes),
+            where a nonzero entry is an edge with that capacity.
+        longlat (np.array): Shape (nodes, 2) of longitude and latitude.
+        group (np.array): Group id of each node. Defaults to zeros.
+        nodes (np.array): Key of each node when it is a networkx graph.
+            Defaults to 0, 1, 2, ...
+    """
+    def __init__(self, capacity, longlat, group=None, nodes=None):
+        node_cnt = capacity.shape[0]
+        self.capacity = csr_matrix(capacity)
+        self.longlat = np.asarray(longlat, dtype=np.float64).reshape(node_cnt, 2)
+        if group is None:
+            group = np.zeros(node_cnt, dtype=np.int64)
+        self.group = np.asarray(group, dtype=np.int64)
+        if nodes is None:
+            nodes = np.arange(node_cnt)
+        self.nodes = np.asarray(nodes)
+
+    @classmethod
+    def from_edges(cls, node_cnt, first, second, capacity, longlat, nodes=None):
+        """
+        Build from arrays of edges, each given once in either direction.
+        """
+        rows = np.concatenate([first, second])
+        columns = np.concatenate([second, first])
+        values = np.concatenate([capacity, capacity])
+        matrix = coo_matrix((values, (rows, columns)), shape=(node_cnt, node_cnt))
+        return cls(matrix.tocsr(), longlat, nodes=nodes)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+        Convert a networkx graph whose nodes may have ``longlat`` and ``group``
+        attributes and whose edges may have a ``capacity``, which defaults to 1.
+        """
+        nodes = list(graph.nodes)
+        index = {node: idx for (idx, node) in enumerate(nodes)}
+        longlat = np.full((len(nodes), 2), np.nan, dtype=np.float64)
+        group = np.zeros(len(nodes), dtype=np.int64)
+        for idx, node in enumerate(nodes):
+            attributes = graph.nodes[node]
+            if "longlat" in attributes:
+                longlat[idx] = attributes["longlat"]
+            group[idx] = attributes.get("group", 0)
+        edges = list(graph.edges(data="capacity", default=1.0))
+        first = np.array([index[a] for (a, _, _) in edges], dtype=np.int64)
+        second = np.array([index[b] for (_, b, _) in edges], dtype=np.int64)
+        capacity = np.array([c for (_, _, c) in edges], dtype=np.float64)
+        flow_graph = cls.from_edges(
+            len(nodes), first, second, capacity, longlat)
+        flow_graph.group = group
+        key_array = np.empty(len(nodes), dtype=object)
+        key_array[:] = nodes
+        flow_graph.nodes = key_array
+        return flow_graph
+
+    def to_networkx(self):
+        """A networkx graph with ``longlat``, ``group`` and ``capacity``."""
+        graph = nx.Graph()
+        keys = self.nodes.tolist()
+        graph.add_nodes_from(
+            (key, {"longlat": long_lat, "group": group})
+            for (key, long_lat, group)
+            in zip(keys, self.longlat.tolist(), self.group.tolist())
+        )
+        first, second, capacity = self.edges()
+        graph.add_weighted_edges_from(
+            ((keys[a], keys[b], c) for (a, b, c)
+             in zip(first.tolist(), second.tolist(), capacity.tolist())),
+            weight="capacity",
+        )
+        return graph
+
+    def __len__(self):
+        return self.capacity.shape[0]
+
+    @property
+    def edge_cnt(self):
+        return triu(self.capacity, k=1).nnz
+
+    def edges(self, indices=None):
+        """
+        Each edge once, as first node, second node, and capacity,
+        with first < second, sorted by first and then second.
+
+        Args:
+            indices (np.array): If given, edges among only these nodes,
+                numbered by position in ``indices``.
+        """
+        capacity = self.capacity if indices is None else self.sub_capacity(indices)
+        upper = triu(capacity, k=1, format="csr")
+        upper.sort_indices()
+        upper = upper.tocoo()
+        return upper.row.astype(np.int64), upper.col.astype(np.int64), upper.data
+
+    def sub_capacity(self, indices):
+        """Capacities among a subset of nodes, numbered by position."""
+        return self.capacity[indices][:, indices]
+
+    def components(self, indices=None):
+        """
+        Connected components, as arrays of node indices.
+
+        Args:
+            indices (np.array): If given, components of the subgraph
+                on these nodes.
+        """
+        if indices is None:
+            return components_of(self.capacity)
+        indices = np.asarray(indices)
+        return [indices[piece]
+                for piece in components_of(self.sub_capacity(indices))]
+
+
+def as_flow_graph(graph):
+    """Accept either a networkx graph or a FlowGraph."""
+    if isinstance(graph, FlowGraph):
+        return graph
+    return FlowGraph.from_networkx(graph)
+
+
+def copy_groups_to_networkx(flow_graph, graph):
+    """Write group ids from a FlowGraph onto the networkx graph it came from."""
+    for key, group in zip(flow_graph.nodes.tolist(), flow_graph.group.tolist()):
+        graph.nodes[key]["group"] = group
@@ -1,16 +1,32 @@
 import logging
+from collections import namedtuple
 
-import networkx as nx
 import numpy as np
 from osgeo import gdal
+from scipy.sparse import coo_matrix
 from scipy.spatial import cKDTree
 
-from .raster_access import band_as_numpy
+from .flow_graph import FlowGraph, components_of
+from .instrument import count
+from .raster_access import window_as_numpy, INT32, FLOAT64
 from .raster_transform import (
-    pixel_coord, pixels_range_near_point, distance, long_lat_to_xyz
+    chord_radius, LongLat, pixel_coord, pixels_range_near_point, distances,
+    xyz_tree,
 )
 
 LOGGER = logging.getLogger(__name__)
+GRAVITY_CUTOFF = 200_000
+"""No flow between cities farther apart than this, in meters."""
+GRAVITY_EXPONENT = 1.0
+PFPR_WEIGHTINGS = ["box-mean", "population"]
+"""How a city's pfpr comes from the pixels around it."""
+Regridded = namedtuple("Regridded", "values x_limits y_limits factor")
+"""
+PfPR on cells of ``factor`` by ``factor`` LandScan pixels, indexed as
+[x, y] from the pixel ``(x_limits[0], y_limits[0])``, with NaN where
+there is no PfPR. The limits are LandScan pixels and are multiples of
+the factor, except where clipped to the raster.
+"""
 
 
 def sum_within_box(arr_np, bounds):
@@ -24,42 +40,402 @@ def average_within_box(arr_np, bounds):
     return sub_array[sub_array >= 0].mean()
 
 
-def assign_pop_and_pfpr_to_points(cities, lspop, pfpr, radius):
+def integral_image(arr_np, dtype):
+    """
+    Summed-area table with a leading row and column of zeros, so that
+    the sum over ``arr_np[x0:x1, y0:y1]`` is
+    ``sat[x1, y1] - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]``.
+    """
+    sat = np.zeros((arr_np.shape[0] + 1, arr_np.shape[1] + 1), dtype=dtype)
+    np.cumsum(arr_np, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def slice_bounds(bounds, shape):
+    """
+    Convert boxes given as ``[[x0, x1], [y0, y1]]`` into the start and stop
+    that Python slicing would use on an array of this shape, so negative
+    starts count from the end and everything is clipped to the array.
+
+    Args:
+        bounds (np.array): Integer array of shape (boxes, 2, 2).
+        shape (Tuple[int,int]): Shape of the array being sliced.
+
+    Returns:
+        np.array: Same shape as bounds, with 0 <= start <= stop <= size.
+    """
+    normalized = np.array(bounds, dtype=np.int64)
+    for axis, size in enumerate(shape):
+        ends = normalized[:, axis]
+        ends[ends < 0] += size
+        np.clip(ends, 0, size, out=ends)
+        ends[:, 1] = np.maximum(ends[:, 0], ends[:, 1])
+    return normalized
+
+
+def sum_within_boxes(sat, bounds):
+    """
+    Sums for many boxes at once from a summed-area table.
+
+    Args:
+        sat (np.array): From :func:`integral_image`.
+        bounds (np.array): Boxes from :func:`slice_bounds`.
+
+    Returns:
+        np.array: One sum per box.
+    """
+    x0, x1 = bounds[:, 0, 0], bounds[:, 0, 1]
+    y0, y1 = bounds[:, 1, 0], bounds[:, 1, 1]
+    return sat[x1, y1] - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]
+
+
+def pop_within_boxes(lspop_np, bounds):
+    """Vectorized :func:`sum_within_box` for many boxes."""
+    positive = np.where(lspop_np > 0, lspop_np, 0)
+    sat = integral_image(positive, positive.dtype
+                         if np.issubdtype(positive.dtype, np.floating)
+                         else np.int64)
+    return sum_within_boxes(sat, slice_bounds(bounds, lspop_np.shape))
+
+
+def pfpr_within_boxes(pfpr_np, bounds):
+    """
+    Vectorized :func:`average_within_box` for many boxes. A box with
+    no valid pixels has a mean of NaN, as it does for the single box.
+    """
+    valid = pfpr_np >= 0
+    pfpr_sat = integral_image(np.where(valid, pfpr_np, 0), np.float64)
+    count_sat = integral_image(valid, np.int64)
+    normalized = slice_bounds(bounds, pfpr_np.shape)
+    total = sum_within_boxes(pfpr_sat, normalized)
+    count = sum_within_boxes(count_sat, normalized)
+    mean = np.full(total.shape, np.nan, dtype=np.float64)
+    np.divide(total, count, out=mean, where=count > 0)
+    return mean
+
+
+def pop_and_pfpr_within_boxes(lspop_np, pfpr_np, bounds):
+    """
+    Population and population-weighted pfpr for many boxes at once, where
+    ``pfpr_np`` is pfpr on the same pixels as ``lspop_np``, as from
+    :func:`regridded_window`. A box whose population is all where pfpr
+    is missing gets the plain mean of its pfpr, and NaN if it has none.
+
+    Returns:
+        np.array: Shape (boxes, 2) of population and pfpr.
+    """
+    normalized = slice_bounds(bounds, lspop_np.shape)
+    population = np.where(lspop_np > 0, lspop_np, 0).astype(np.int64)
+    valid = np.isfinite(pfpr_np)
+    pfpr_valid = np.where(valid, pfpr_np, 0)
+    weighted_pop = np.where(valid, population, 0)
+    sums = [
+        sum_within_boxes(integral_image(values, dtype), normalized)
+        for values, dtype in [
+            (population, np.int64), (pfpr_valid * weighted_pop, np.float64),
+            (weighted_pop, np.int64), (pfpr_valid, np.float64),
+            (valid, np.int64),
+        ]
+    ]
+    total, weighted, weight, pfpr_total, pfpr_count = sums
+    result = np.full((len(bounds), 2), np.nan, dtype=np.float64)
+    result[:, 0] = total
+    np.divide(pfpr_total, pfpr_count, out=result[:, 1], where=pfpr_count > 0)
+    np.divide(weighted, weight, out=result[:, 1], where=weight > 0)
+    return result
+
+
+def city_boxes(long_lats, radius, geo_transform):
+    """
+    Pixel boxes around every city, as ``[[x0, x1], [y0, y1]]``,
+    from :func:`pixels_range_near_point`.
+    """
+    bounds = np.zeros((len(long_lats), 2, 2), dtype=np.int64)
+    for idx, long_lat in enumerate(long_lats):
+        bounds[idx] = pixels_range_near_point(long_lat, radius, geo_transform)
+    return bounds
+
+
+def window_clusters(bounds, gap):
+    """
+    Group boxes so that each group can be read as one window.
+    Boxes join a group when they are within ``gap`` pixels of a box
+    in that group, measured with generous square neighborhoods.
+
+    Args:
+        bounds (np.array): Boxes from :func:`slice_bounds`.
+        gap (int|None): None puts every box into one window.
+
+    Returns:
+        List[np.array]: Indices of boxes in each group.
+    """
+    if gap is None or len(bounds) < 2:
+        return [np.arange(len(bounds))]
+    centers = 0.5 * (bounds[:, :, 0] + bounds[:, :, 1])
+    widest = (bounds[:, :, 1] - bounds[:, :, 0]).max()
+    tree = cKDTree(centers)
+    pairs = tree.query_pairs(widest + gap, p=np.inf, output_type="ndarray")
+    adjacency = coo_matrix(
+        (np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+        shape=(len(bounds), len(bounds)),
+    )
+    return components_of(adjacency)
+
+
+def aggregate_within_windows(band, bounds, data_type, within_boxes, gap=None,
+                             with_window=False):
+    """
+    Apply a vectorized box aggregation, such as :func:`pop_within_boxes`,
+    reading only the part of the raster that the boxes cover.
+
+    Args:
+        band: GDAL raster band.
+        bounds (np.array): Boxes in pixels of the band, shape (boxes, 2, 2).
+        data_type (BandType): How to read the band.
+        within_boxes (function): Takes an array and boxes into that array.
+        gap (int|None): If given, read a separate window for each cluster
+            of boxes that are farther than this many pixels apart.
+        with_window (bool): Also pass the window's x and y limits in the
+            band to ``within_boxes``.
+
+    Returns:
+        np.array: One value per box, or one row per box if
+        ``within_boxes`` returns rows.
+    """
+    normalized = slice_bounds(bounds, (band.XSize, band.YSize))
+    nonempty = np.all(normalized[:, :, 1] > normalized[:, :, 0], axis=1)
+    # Empty boxes point at an empty slice of whichever window they are in.
+    normalized[~nonempty] = 0
+    result = None
+    count("boxes", len(bounds))
+    for members in window_clusters(normalized, gap):
+        count("windows")
+        reading = members[nonempty[members]]
+        if len(reading) > 0:
+            x_limits = (int(normalized[reading, 0, 0].min()),
+                        int(normalized[reading, 0, 1].max()))
+            y_limits = (int(normalized[reading, 1, 0].min()),
+                        int(normalized[reading, 1, 1].max()))
+        else:
+            x_limits, y_limits = (0, 0), (0, 0)
+        LOGGER.debug(f"Aggregating {len(members)} boxes in window "
+                     f"x {x_limits} y {y_limits}")
+        window = window_as_numpy(band, x_limits, y_limits, data_type)
+        offset = normalized[members].copy()
+        offset[nonempty[members]] -= np.array(
+            [[x_limits[0], x_limits[0]], [y_limits[0], y_limits[0]]])
+        if with_window:
+            values = within_boxes(window, offset, x_limits, y_limits)
+        else:
+            values = within_boxes(window, offset)
+        if result is None:
+            result = np.zeros((len(bounds),) + values.shape[1:],
+                              dtype=np.float64)
+        result[members] = values
+    return result
+
+
+def assign_pop_and_pfpr_to_points(cities, lspop, pfpr, radius, window_gap=None):
     """
     Given city locations, make approximate assignments of population
     and pfpr to those cities.
 
     For population, add all the population within a distance r.
-    For pfpr, multiply pfpr by the population within the distance r.
+    For pfpr, take the mean of pfpr pixels within the distance r.
+    :func:`assign_pop_and_weighted_pfpr` weights pfpr by population.
 
     Args:
         cities:
         lspop_np: A namespace with a dataset and a band.
         pfpr_np: A namespace with a dataset and a band.
         radius (float): Distance of influence for that city.
+        window_gap (float|None): Degrees between clusters of cities
+            beyond which each cluster reads its own raster window.
+            None reads one window around all cities.
 
     Returns:
         np.array: With shape (cities, 4) for pop, pfpr, longitude, latitude.
+        These match :func:`sum_within_box` and :func:`average_within_box`.
     """
     assert cities.shape[1] == 2
 
-    lspop_np = band_as_numpy(lspop.band)
     pop_geo = lspop.dataset.GetGeoTransform()
-    pfpr_np = band_as_numpy(pfpr.band)
+
+    pop_pfpr = np.zeros((len(cities), 4), dtype=np.float64)
+    pop_pfpr[:, 2:4] = city_long_lats(cities, pop_geo)
+    long_lats = pop_pfpr[:, 2:4]
+    # Only read the parts of each raster under the cities, and use
+    # summed-area tables to answer every city's box at once.
+    pop_pfpr[:, 0] = aggregate_within_windows(
+        lspop.band, city_boxes(long_lats, radius, pop_geo), INT32,
+        pop_within_boxes, _gap_in_pixels(window_gap, pop_geo),
+    )
+    pop_pfpr[:, 1] = _pfpr_near_points(long_lats, pfpr, radius, window_gap)
+    return pop_pfpr
+
+
+def replace_pfpr(pop_pfpr, pfpr, radius, window_gap=None):
+    """
+    A copy of a city table with only the pfpr column aggregated again,
+    from another pfpr raster, so population isn't read again.
+
+    Args:
+        pop_pfpr (np.array): From :func:`assign_pop_and_pfpr_to_points`.
+        pfpr: A namespace with a dataset and a band.
+        radius (float): Distance of influence for that city.
+        window_gap (float|None): As for :func:`assign_pop_and_pfpr_to_points`.
+
+    Returns:
+        np.array: Same shape as ``pop_pfpr``.
+    """
+    assert str(gdal.GetDataTypeName(pfpr.band.DataType)) == "Float64"
+    replaced = pop_pfpr.copy()
+    replaced[:, 1] = _pfpr_near_points(
+        replaced[:, 2:4], pfpr, radius, window_gap)
+    return replaced
+
+
+def _pfpr_near_points(long_lats, pfpr, radius, window_gap):
     pfpr_geo = pfpr.dataset.GetGeoTransform()
+    return aggregate_within_windows(
+        pfpr.band, city_boxes(long_lats, radius, pfpr_geo), FLOAT64,
+        pfpr_within_boxes, _gap_in_pixels(window_gap, pfpr_geo),
+    )
+
 
-    pop_pfpr = np.zeros((len(cities), 4), dtype=np.float)
+def city_long_lats(cities, geo_transform):
+    """Longitude and latitude of the corner of each city's pixel."""
+    long_lats = np.zeros((len(cities), 2), dtype=np.float64)
     for idx, city_coordinate_in_pop_raster in enumerate(cities):
-        long_lat = pixel_coord(city_coordinate_in_pop_raster, pop_geo)
-        pop_corners = pixels_range_near_point(long_lat, radius, pop_geo)
-        pop = sum_within_box(lspop_np, pop_corners)
-        pfpr_corners = pixels_range_near_point(long_lat, radius, pfpr_geo)
-        pfpr = average_within_box(pfpr_np, pfpr_corners)
-        pop_pfpr[idx, 0:4] = [pop, pfpr, long_lat[0], long_lat[1]]
+        long_lats[idx] = pixel_coord(city_coordinate_in_pop_raster, geo_transform)
+    return long_lats
+
+
+def pfpr_region(long_lats, radius, lspop):
+    """
+    LandScan pixels that the boxes around these points cover, so that
+    :func:`regrid_pfpr` only resamples the part that is needed.
+
+    Returns:
+        LongLat: Ranges of x and y pixels, clipped to the raster.
+    """
+    band = lspop.band
+    normalized = slice_bounds(
+        city_boxes(long_lats, radius, lspop.dataset.GetGeoTransform()),
+        (band.XSize, band.YSize),
+    )
+    normalized = normalized[
+        np.all(normalized[:, :, 1] > normalized[:, :, 0], axis=1)]
+    if len(normalized) == 0:
+        return LongLat([0, 0], [0, 0])
+    return LongLat(
+        [int(normalized[:, 0, 0].min()), int(normalized[:, 0, 1].max())],
+        [int(normalized[:, 1, 0].min()), int(normalized[:, 1, 1].max())],
+    )
+
+
+def regrid_pfpr(lspop, pfpr, region, factor=1):
+    """
+    Resample pfpr onto the LandScan grid, or onto cells of ``factor``
+    by ``factor`` LandScan pixels, so it lines up with population.
+    Each cell takes the pfpr pixel under its center, which is exact
+    when the pfpr grid is a multiple of the cells. PfPR is about five
+    LandScan pixels across, so a factor of five keeps its detail.
 
+    Args:
+        lspop: LandScan dataset and band.
+        pfpr: PfPR dataset and band.
+        region (LongLat): Ranges of LandScan x and y pixels to cover,
+            as from :func:`pfpr_region`.
+        factor (int): LandScan pixels on a side of each cell.
+
+    Returns:
+        Regridded: Covers the region, widened to whole cells.
+    """
+    pop_geo = lspop.dataset.GetGeoTransform()
+    pfpr_geo = pfpr.dataset.GetGeoTransform()
+    assert pop_geo[2] == pop_geo[4] == pfpr_geo[2] == pfpr_geo[4] == 0
+    limits = list()
+    centers = list()
+    for axis, size in [(0, lspop.band.XSize), (1, lspop.band.YSize)]:
+        begin = (region[axis][0] // factor) * factor
+        end = min(size, -(-region[axis][1] // factor) * factor)
+        limits.append((begin, max(begin, end)))
+        cell_begin = np.arange(begin, max(begin, end), factor)
+        centers.append(
+            0.5 * (cell_begin + np.minimum(cell_begin + factor, size)))
+    # The geotransform is separable, so columns depend only on longitude.
+    pfpr_x = np.floor(
+        (pop_geo[0] + centers[0] * pop_geo[1] - pfpr_geo[0]) / pfpr_geo[1]
+    ).astype(np.int64)
+    pfpr_y = np.floor(
+        (pop_geo[3] + centers[1] * pop_geo[5] - pfpr_geo[3]) / pfpr_geo[5]
+    ).astype(np.int64)
+    inside_x = (pfpr_x >= 0) & (pfpr_x < pfpr.band.XSize)
+    inside_y = (pfpr_y >= 0) & (pfpr_y < pfpr.band.YSize)
+    values = np.full((len(pfpr_x), len(pfpr_y)), np.nan, dtype=np.float64)
+    if inside_x.any() and inside_y.any():
+        x_limits = (int(pfpr_x[inside_x].min()), int(pfpr_x[inside_x].max()) + 1)
+        y_limits = (int(pfpr_y[inside_y].min()), int(pfpr_y[inside_y].max()) + 1)
+        window = window_as_numpy(pfpr.band, x_limits, y_limits, FLOAT64)
+        sampled = window[np.ix_(pfpr_x[inside_x] - x_limits[0],
+                                pfpr_y[inside_y] - y_limits[0])]
+        values[np.ix_(inside_x, inside_y)] = np.where(
+            sampled >= 0, sampled, np.nan)
+    count("regridded_cells", values.size)
+    LOGGER.info(f"Regridded pfpr to {values.shape} cells of {factor} pixels")
+    return Regridded(values, limits[0], limits[1], factor)
+
+
+def regridded_window(regridded, x_limits, y_limits):
+    """Pfpr for each LandScan pixel in a window inside the regridded region."""
+    x_cell = (np.arange(*x_limits) - regridded.x_limits[0]) // regridded.factor
+    y_cell = (np.arange(*y_limits) - regridded.y_limits[0]) // regridded.factor
+    return regridded.values[np.ix_(x_cell, y_cell)]
+
+
+def assign_pop_and_weighted_pfpr(cities, lspop, regridded, radius,
+                                 window_gap=None):
+    """
+    Like :func:`assign_pop_and_pfpr_to_points`, but pfpr is the mean
+    weighted by population within the distance r. Both come from one
+    read of the LandScan window and the regridded pfpr under it, so
+    there are no separate boxes on the pfpr grid.
+
+    Args:
+        cities (np.array): Pixels of the LandScan raster, shape (cities, 2).
+        lspop: LandScan dataset and band.
+        regridded (Regridded): From :func:`regrid_pfpr`, covering
+            :func:`pfpr_region` of these cities.
+        radius (float): Distance of influence for that city.
+        window_gap (float|None): As for :func:`assign_pop_and_pfpr_to_points`.
+
+    Returns:
+        np.array: With shape (cities, 4) for pop, pfpr, longitude, latitude.
+    """
+    assert cities.shape[1] == 2
+    pop_geo = lspop.dataset.GetGeoTransform()
+    pop_pfpr = np.zeros((len(cities), 4), dtype=np.float64)
+    pop_pfpr[:, 2:4] = city_long_lats(cities, pop_geo)
+
+    def within_boxes(window, bounds, x_limits, y_limits):
+        return pop_and_pfpr_within_boxes(
+            window, regridded_window(regridded, x_limits, y_limits), bounds)
+
+    pop_pfpr[:, 0:2] = aggregate_within_windows(
+        lspop.band, city_boxes(pop_pfpr[:, 2:4], radius, pop_geo), INT32,
+        within_boxes, _gap_in_pixels(window_gap, pop_geo), with_window=True,
+    )
     return pop_pfpr
 
 
+def _gap_in_pixels(gap_degrees, geo_transform):
+    if gap_degrees is None:
+        return None
+    return int(np.ceil(gap_degrees / abs(geo_transform[1])))
+
+
 def calculate_gravity_constant(cutoff, exponent, plaquette_size):
     plaquette_r = int(cutoff / plaquette_size)
     axis = np.arange(-plaquette_r, plaquette_r + 1)
@@ -70,49 +446,197 @@ def calculate_gravity_constant(cutoff, exponent, plaquette_size):
     return 1 / np.sum(np.power(distance, 1 / exponent))
 
 
-def calculate_flows(pop_pfpr, cutoff, exponent):
-    input_city_cnt = pop_pfpr.shape[0]
-    pop_pfpr = pop_pfpr[pop_pfpr[:, 1] > 1e-3]
-    without_zero_pfpr = pop_pfpr.shape[0]
-    LOGGER.info(f"Total cities {input_city_cnt} nonzero "
-                f"pfpr {without_zero_pfpr}")
+def candidate_pairs(long_lat, cutoff, distance_method="exact"):
+    """
+    Every pair of cities closer than the cutoff, found with one kd-tree
+    query and measured with one call to :func:`distances`.
+
+    Args:
+        long_lat (np.array): Shape (cities, 2) of longitude and latitude.
+        cutoff (float): Distance in meters.
+        distance_method (str): "exact" or "fast".
+
+    Returns:
+        (np.array, np.array, np.array): First city, second city, and
+        distance in meters, with first < second, sorted by first and
+        then second.
+    """
+    # Every pair within the geodesic cutoff is within its chord radius.
+    kdtree = xyz_tree(long_lat)
+    pairs = kdtree.query_pairs(chord_radius(cutoff), output_type="ndarray")
+    pairs = pairs.reshape(-1, 2)
+    pairs.sort(axis=1)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    first, second = pairs[:, 0], pairs[:, 1]
+    r = distances(long_lat[first], long_lat[second], distance_method)
+    within = r < cutoff
+    count("candidate_pairs", len(first))
+    count("pairs_within_cutoff", int(within.sum()))
+    return first[within], second[within], r[within]
+
+
+def candidate_pairs_from(long_lat, sources, cutoff, distance_method="exact",
+                         keys=None):
+    """
+    Pairs closer than the cutoff that have a city of ``sources`` first,
+    like :func:`candidate_pairs` but searching only around the sources.
+    A pair of two sources appears once each way, unless keys are given.
+
+    Args:
+        long_lat (np.array): Shape (cities, 2) of longitude and latitude.
+        sources (np.array): Indices of cities to search around.
+        cutoff (float): Distance in meters.
+        distance_method (str): "exact" or "fast".
+        keys (np.array|None): A key for each city. If given, only pairs
+            whose source has the smaller key are measured.
+
+    Returns:
+        (np.array, np.array, np.array): Source city, other city, and
+        distance in meters, sorted by source and then other city.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    near = xyz_tree(long_lat[sources]).sparse_distance_matrix(
+        xyz_tree(long_lat), chord_radius(cutoff), output_type="ndarray")
+    first, second = sources[near["i"]], near["j"].astype(np.int64)
+    if keys is None:
+        keep = first != second
+    else:
+        keep = keys[first] < keys[second]
+    first, second = first[keep], second[keep]
+    order = np.lexsort((second, first))
+    first, second = first[order], second[order]
+    r = distances(long_lat[first], long_lat[second], distance_method)
+    within = r < cutoff
+    count("candidate_pairs", len(first))
+    count("pairs_within_cutoff", int(within.sum()))
+    return first[within], second[within], r[within]
+
+
+def pair_flux(pop_pfpr, first, second, r, cutoff, exponent):
+    """
+    Gravity-model flux for each pair of cities.
+
+    Args:
+        pop_pfpr (np.array): From :func:`assign_pop_and_pfpr_to_points`.
+        first (np.array): Index of one city in each pair.
+        second (np.array): Index of the other city in each pair.
+        r (np.array): Distance in meters between the two.
+        cutoff (float): Largest distance in meters, for the constant.
+        exponent (float): Power of distance in the denominator.
+
+    Returns:
+        np.array: Flux for each pair.
+    """
     lspop_scale = 1000  # a kilometer
     k = calculate_gravity_constant(cutoff, exponent, lspop_scale)
-    cities = nx.Graph()
-    for city_idx in range(pop_pfpr.shape[0]):
-        lon, lat = pop_pfpr[city_idx, 2:4]
-        cities.add_node(city_idx, longlat=[lon, lat])
-        LOGGER.debug(f"City {city_idx} lon {lon} lat {lat}")
-    assert len(cities.nodes) == pop_pfpr.shape[0]
-
-    # x-y-z kd-tree so we can use meters.
-    xyz = long_lat_to_xyz(pop_pfpr[:, 2:4])
-    kdtree = cKDTree(data=xyz)
-    for city_idx in range(pop_pfpr.shape[0]):
-        near = kdtree.query_ball_point(xyz[city_idx], 1.3 * cutoff)
-        for n in near:
-            if n == city_idx or (n, city_idx) in cities.edges:
-                continue
-            r_ij = distance(pop_pfpr[city_idx, 2:4], pop_pfpr[n, 2:4])
-            pfpr_avg = 0.5 * (pop_pfpr[city_idx, 1] + pop_pfpr[n, 1])
-            product_pop = pop_pfpr[city_idx, 0] * pop_pfpr[n, 0]
-            flux = pfpr_avg * product_pop * k / r_ij**exponent
-            if flux > 0 and r_ij < cutoff:
-                cities.add_edge(city_idx, n, capacity=flux)
-            # else no edge if no pfpr for either city.
-    return cities
-
-
-def create_city_flows(cities, lspop, pfpr, radius):
-    assert cities.shape[1] == 3
-    # First column is distance to another city.
-    # Next two are x and y into the pop band.
+    pfpr_avg = 0.5 * (pop_pfpr[first, 1] + pop_pfpr[second, 1])
+    product_pop = pop_pfpr[first, 0] * pop_pfpr[second, 0]
+    return pfpr_avg * product_pop * k / r**exponent
+
+
+def flows_from_pairs(pop_pfpr, first, second, r, cutoff, exponent):
+    """
+    Gravity-model flows among cities that have pfpr, from a table of
+    pairs found at this cutoff or a larger one. Pairs at or beyond the
+    cutoff, and cities without pfpr, are dropped.
+
+    Args:
+        pop_pfpr (np.array): From :func:`assign_pop_and_pfpr_to_points`.
+        first (np.array): From :func:`candidate_pairs`.
+        second (np.array): From :func:`candidate_pairs`.
+        r (np.array): From :func:`candidate_pairs`.
+        cutoff (float): No flow between cities farther apart, in meters.
+        exponent (float): Power of distance in the denominator.
+
+    Returns:
+        FlowGraph: Nodes are cities with nonzero pfpr, in order,
+        keyed by their row in ``pop_pfpr``.
+    """
+    has_pfpr = pop_pfpr[:, 1] > 1e-3
+    kept = np.flatnonzero(has_pfpr)
+    LOGGER.info(f"Total cities {len(pop_pfpr)} nonzero pfpr {len(kept)}")
+    node_index = np.full(len(pop_pfpr), -1, dtype=np.int64)
+    node_index[kept] = np.arange(len(kept))
+    within = (r < cutoff) & has_pfpr[first] & has_pfpr[second]
+    first, second, r = first[within], second[within], r[within]
+    flux = pair_flux(pop_pfpr, first, second, r, cutoff, exponent)
+    # No edge if no pfpr for either city.
+    keep = flux > 0
+    count("edges", int(keep.sum()))
+    LOGGER.info(f"Candidate pairs {len(first)} with flux {keep.sum()}")
+    return FlowGraph.from_edges(
+        len(kept), node_index[first[keep]], node_index[second[keep]],
+        flux[keep], pop_pfpr[kept, 2:4], nodes=kept,
+    )
+
+
+def calculate_flows(pop_pfpr, cutoff, exponent, distance_method="exact"):
+    """
+    Gravity-model flows among cities that have pfpr.
+
+    Args:
+        pop_pfpr (np.array): From :func:`assign_pop_and_pfpr_to_points`.
+        cutoff (float): No flow between cities farther apart, in meters.
+        exponent (float): Power of distance in the denominator.
+        distance_method (str): "exact" or "fast".
+
+    Returns:
+        FlowGraph: Nodes are cities with nonzero pfpr, in order,
+        keyed by their row in ``pop_pfpr``.
+    """
+    kept = np.flatnonzero(pop_pfpr[:, 1] > 1e-3)
+    first, second, r = candidate_pairs(pop_pfpr[kept, 2:4], cutoff, distance_method)
+    return flows_from_pairs(
+        pop_pfpr, kept[first], kept[second], r, cutoff, exponent)
+
+
+def peak_pixels(cities):
+    """The x and y of peak records, which are pixels of the pop band."""
+    return np.stack([cities["x"], cities["y"]], axis=1)
+
+
+def city_pop_pfpr(cities, lspop, pfpr, radius, window_gap=None,
+                  weighting="box-mean", regridded=None, factor=1):
+    """
+    Population and pfpr for each city in a peaks table.
+
+    Args:
+        cities (np.array): Peak records from :func:`load_cities`.
+        lspop: LandScan dataset and band.
+        pfpr: PfPR dataset and band.
+        radius (float): Distance of influence for a city, in meters.
+        window_gap (float|None): See :func:`assign_pop_and_pfpr_to_points`.
+        weighting (str): "box-mean" for the mean of pfpr pixels in a box,
+            or "population" to weight pfpr by the population under it.
+        regridded (Regridded|None): For population weighting, pfpr
+            already from :func:`regrid_pfpr`. Otherwise it's made here.
+        factor (int): Cell size for regridding, in LandScan pixels.
+
+    Returns:
+        np.array: With shape (cities, 4) for pop, pfpr, longitude, latitude.
+    """
+    pixels = peak_pixels(cities)
 
     assert str(gdal.GetDataTypeName(lspop.band.DataType)) == "Int32"
     assert str(gdal.GetDataTypeName(pfpr.band.DataType)) == "Float64"
 
-    pop_pfpr = assign_pop_and_pfpr_to_points(cities[:, 1:3], lspop, pfpr, radius)
-    gravity_cutoff = 200_000
-    exponent = 1.0
-    city_graph = calculate_flows(pop_pfpr, gravity_cutoff, exponent)
+    if weighting == "box-mean":
+        return assign_pop_and_pfpr_to_points(
+            pixels, lspop, pfpr, radius, window_gap)
+    elif weighting == "population":
+        if regridded is None:
+            long_lats = city_long_lats(pixels, lspop.dataset.GetGeoTransform())
+            regridded = regrid_pfpr(
+                lspop, pfpr, pfpr_region(long_lats, radius, lspop), factor)
+        return assign_pop_and_weighted_pfpr(
+            pixels, lspop, regridded, radius, window_gap)
+    else:
+        raise ValueError(f"Unknown pfpr weighting {weighting}")
+
+
+def create_city_flows(cities, lspop, pfpr, radius, window_gap=None,
+                      distance_method="exact"):
+    pop_pfpr = city_pop_pfpr(cities, lspop, pfpr, radius, window_gap)
+    city_graph = calculate_flows(
+        pop_pfpr, GRAVITY_CUTOFF, GRAVITY_EXPONENT, distance_method)
     return city_graph
@@ -4,20 +4,35 @@ from collections import namedtuple
 import numpy as np
 from osgeo import gdal
 
+from .raster_cache import is_raster_cache, open_raster_cache
+
 LOGGER = logging.getLogger(__name__)
 
 
 Raster = namedtuple("Raster", "dataset band")
+PEAK_DTYPE = np.dtype([
+    ("squared_distance", np.int64), ("x", np.int32), ("y", np.int32)])
+"""One record per peak, as written to a peaks ``.npy``."""
+
+
+def open_raster(raster_file):
+    """
+    Open a raster with GDAL, or a directory written by
+    :mod:`segment.raster_cache` as memory maps.
+    """
+    if is_raster_cache(raster_file):
+        LOGGER.info(f"Opening raster cache {raster_file}")
+        return Raster(*open_raster_cache(raster_file))
+    dataset = gdal.Open(str(raster_file), gdal.GA_ReadOnly)
+    if not dataset:
+        LOGGER.error(f"Could not open {raster_file}.")
+    return Raster(dataset, dataset.GetRasterBand(1))
 
 
 def load_lspop(landscan_file):
     if not landscan_file.exists():
         LOGGER.error(f"The given file doesn't exist: {landscan_file}")
-    dataset = gdal.Open(str(landscan_file), gdal.GA_ReadOnly)
-    if not dataset:
-        LOGGER.error(f"Could not open {landscan_file}.")
-
-    band = dataset.GetRasterBand(1)
+    dataset, band = open_raster(landscan_file)
     # If these change, then check how the band is used later.
     assert str(gdal.GetDataTypeName(band.DataType)) == "Int32"
     projection = dataset.GetProjection()
@@ -27,15 +42,25 @@ def load_lspop(landscan_file):
 
 def load_cities(peaks_path):
     """
+    Read peaks from citypeaks. A ``.npy`` file is memory-mapped,
+    so it opens at once however many peaks it holds.
 
     Args:
-        peaks_path (Path): The city_peaks.csv file.
+        peaks_path (Path): The city_peaks.npy or city_peaks.csv file.
 
     Returns:
-        Numpy list of peaks.
+        np.array: Records of :data:`PEAK_DTYPE`.
     """
-    floats = np.loadtxt(str(peaks_path), skiprows=1, delimiter=",")
-    return floats.astype(np.int32)
+    if peaks_path.suffix == ".npy":
+        peaks = np.load(str(peaks_path), mmap_mode="r")
+        if peaks.dtype != PEAK_DTYPE:
+            raise RuntimeError(f"Peaks in {peaks_path} have type {peaks.dtype}")
+        return peaks
+    floats = np.loadtxt(str(peaks_path), skiprows=1, delimiter=",", ndmin=2)
+    peaks = np.zeros(len(floats), dtype=PEAK_DTYPE)
+    for column, name in enumerate(PEAK_DTYPE.names):
+        peaks[name] = floats[:, column]
+    return peaks
 
 
 def load_pfpr(pfpr_file):
@@ -49,11 +74,7 @@ def load_pfpr(pfpr_file):
     """
     if not pfpr_file.exists():
         LOGGER.error(f"The given file doesn't exist: {pfpr_file}")
-    dataset = gdal.Open(str(pfpr_file), gdal.GA_ReadOnly)
-    if not dataset:
-        LOGGER.error(f"Could not open {pfpr_file}.")
-
-    band = dataset.GetRasterBand(1)
+    dataset, band = open_raster(pfpr_file)
     # If these change, then check how the band is used later.
     data_type = str(gdal.GetDataTypeName(band.DataType))
     if data_type != "Float64":
@@ -0,0 +1,160 @@
+"""
+Per-stage measurements for the command-line programs.
+
+Wrap each stage of a run in :meth:`StageRecorder.stage`, and library code
+adds item counts, such as pixels scanned or cuts made, with :func:`count`,
+which costs nothing when no stage is recording. When the run is done,
+:meth:`StageRecorder.write` appends one JSON line to ``record.jsonl``
+with the same token as the run's entry in ``record.txt``.
+
+Code that runs in worker processes calls :func:`run_counted` there and
+:func:`add_counts` on its results, so that counts and raster reads from
+workers add to the parent's stages. Each stage records the largest
+resident set size of any finished worker next to its own.
+"""
+import cProfile
+import json
+import logging
+import resource
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from secrets import token_hex
+from time import perf_counter, process_time
+
+from osgeo import gdal
+
+from .raster_access import RASTER_READS
+
+LOGGER = logging.getLogger(__name__)
+_ACTIVE = list()
+"""Counters of the stages that are running now, innermost last."""
+
+
+def count(name, amount=1):
+    """Add to a count in every stage that is running."""
+    for counts in _ACTIVE:
+        counts[name] += amount
+
+
+def run_counted(function, *args):
+    """
+    Runs in a worker process. Call the function, and return what it
+    returns with the counts and raster reads it made, for :func:`add_counts`.
+    """
+    counts = Counter()
+    reads_before = RASTER_READS.copy()
+    # A forked worker has copies of the parent's stages, which nobody reads.
+    active = list(_ACTIVE)
+    _ACTIVE[:] = [counts]
+    try:
+        result = function(*args)
+    finally:
+        _ACTIVE[:] = active
+    return result, counts, RASTER_READS - reads_before
+
+
+def add_counts(counted):
+    """Add what :func:`run_counted` found to this process, and return the result."""
+    result, counts, reads = counted
+    for name, amount in counts.items():
+        count(name, amount)
+    RASTER_READS.update(reads)
+    return result
+
+
+def max_rss_bytes(who=resource.RUSAGE_SELF):
+    """
+    Largest resident set size of this process so far, or with
+    ``resource.RUSAGE_CHILDREN``, of the largest child that has finished.
+    """
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes.
+    return max_rss if sys.platform == "darwin" else 1024 * max_rss
+
+
+class StageRecorder:
+    """
+    Records wall time, CPU time, peak RSS, raster reads, waits on
+    prefetched rows, GDAL block cache use, and item counts for each
+    stage of one run.
+
+    GDAL doesn't report cache hits, so this records how much of its
+    block cache was in use before and after each stage, next to the
+    bytes this package asked it for.
+
+    Args:
+        token (str): Identifies the run, as in ``record.txt``.
+        profile (List[str]): Stages to run under cProfile.
+        profile_dir (Path): Where to write ``<token>-<stage>.prof`` files.
+    """
+    def __init__(self, token=None, profile=None, profile_dir=None):
+        self.token = token if token else token_hex(8)
+        self.profile = set(profile) if profile else set()
+        self.profile_dir = Path(profile_dir) if profile_dir else Path(".")
+        self.stages = list()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure the code in a ``with`` block. It yields a Counter, so
+        the caller can add counts that the library doesn't.
+        """
+        counts = Counter()
+        reads_before = RASTER_READS.copy()
+        cache_before = gdal.GetCacheUsed()
+        profiler = cProfile.Profile() if name in self.profile else None
+        _ACTIVE.append(counts)
+        wall_start, cpu_start = perf_counter(), process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield counts
+        finally:
+            if profiler:
+                profiler.disable()
+            wall = perf_counter() - wall_start
+            cpu = process_time() - cpu_start
+            _ACTIVE.remove(counts)
+            reads = RASTER_READS - reads_before
+            record = dict(
+                stage=name,
+                wall_seconds=wall,
+                cpu_seconds=cpu,
+                max_rss_bytes=max_rss_bytes(),
+                children_max_rss_bytes=max_rss_bytes(resource.RUSAGE_CHILDREN),
+                raster_reads=reads["reads"],
+                raster_bytes=reads["bytes"],
+                mapped_bytes=reads["mapped_bytes"],
+                raster_stalls=reads["stalls"],
+                raster_stall_seconds=reads["stall_seconds"],
+                gdal_cache_before=cache_before,
+                gdal_cache_after=gdal.GetCacheUsed(),
+                gdal_cache_max=gdal.GetCacheMax(),
+                counts=dict(counts),
+            )
+            if profiler:
+                profile_path = self.profile_dir / f"{self.token}-{name}.prof"
+                profiler.dump_stats(str(profile_path))
+                record["profile"] = str(profile_path)
+            self.stages.append(record)
+            LOGGER.info(f"Stage {name} wall {wall:.2f}s cpu {cpu:.2f}s "
+                        f"counts {dict(counts)}")
+
+    def write(self, out_path, program, additional=None):
+        """
+        Append this run as one line of JSON.
+
+        Args:
+            out_path (Path): Usually ``record.jsonl``.
+            program (str): Which command ran.
+            additional (dict): More values to save with the run.
+        """
+        entry = dict(token=self.token, program=program,
+                     when=str(datetime.now()), stages=self.stages)
+        if additional:
+            entry.update(additional)
+        with out_path.open("a") as out:
+            print(json.dumps(entry, default=str), file=out)
@@ -0,0 +1,286 @@
+"""
+Answers which group, and which level of the group hierarchy, a
+longitude and latitude belongs to, from the output of ``citysplit``.
+
+A point belongs to the group of its nearest city. Cities are held in a
+kd-tree on Earth-centered coordinates from
+:func:`segment.raster_transform.xyz_tree`, so a batch of points
+is one tree query. Give ``--points`` to answer a CSV of points, or
+``--serve`` to answer over HTTP on this machine::
+
+    GET  /point?long=32.58&lat=0.35
+    GET  /box?west=32&south=0&east=33&north=1
+    POST /points  {"long": [32.58, 30.06], "lat": [0.35, -1.95]}
+
+Responses are JSON with ``node``, ``group``, ``level`` and, for points,
+``distance`` in meters to the city. A point farther than
+``--max-distance`` from every city has node, group and level of -1.
+"""
+import json
+import logging
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from inspect import getmodule
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from .raster_transform import (
+    chord_radius, distances, long_lat_to_xyz, xyz_tree,
+)
+
+LOGGER = logging.getLogger(__name__)
+MISSING = -1
+"""Node, group and level of a point that has no city near enough."""
+Assignment = namedtuple("Assignment", "node group level distance")
+"""Arrays with one entry per point. Node is the city's key in the file."""
+
+
+class CommunityIndex:
+    """
+    Spatial index of cities with their groups and group levels.
+
+    Args:
+        long_lat (np.array): Shape (cities, 2) of longitude and latitude.
+        group (np.array): Group of each city.
+        level (np.array): Level of each city's group.
+        nodes (np.array): Key of each city. Defaults to 0, 1, 2, ...
+    """
+    def __init__(self, long_lat, group, level, nodes=None):
+        self.long_lat = np.asarray(long_lat, dtype=np.float64).reshape(-1, 2)
+        self.group = np.asarray(group, dtype=np.int64)
+        self.level = np.asarray(level, dtype=np.int64)
+        if nodes is None:
+            nodes = np.arange(len(self.long_lat))
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.tree = xyz_tree(self.long_lat)
+        # Boxes search a span of cities sorted by longitude.
+        self.by_long = np.argsort(self.long_lat[:, 0], kind="stable")
+        self.sorted_long = self.long_lat[self.by_long, 0]
+
+    @classmethod
+    def from_file(cls, input_file):
+        """
+        Read the ``nodes`` table written by
+        :func:`segment.communities.save_pandas`, which already has the
+        level of each city's group, so edges aren't read at all.
+        """
+        nodes = pd.read_hdf(str(input_file), "nodes",
+                            columns=["long", "lat", "group", "level"])
+        LOGGER.info(f"Indexing {len(nodes)} cities from {input_file}")
+        return cls(nodes[["long", "lat"]].values, nodes["group"].values,
+                   nodes["level"].values, nodes.index.values)
+
+    def __len__(self):
+        return len(self.long_lat)
+
+    def query(self, long_lat, max_distance=None):
+        """
+        Nearest city to each point.
+
+        Args:
+            long_lat (np.array): Shape (points, 2) of longitude and latitude.
+            max_distance (float|None): Meters beyond which a point has no
+                city. None assigns every point.
+
+        Returns:
+            Assignment: Distances are geodesic, in meters.
+        """
+        long_lat = np.asarray(long_lat, dtype=np.float64).reshape(-1, 2)
+        if len(long_lat) == 0 or len(self) == 0:
+            return self._assign(np.full(len(long_lat), MISSING, dtype=np.int64),
+                                np.full(len(long_lat), np.nan))
+        xyz = long_lat_to_xyz(long_lat)
+        if max_distance is None:
+            _, nearest = self.tree.query(xyz)
+        else:
+            # The tree marks points with no city in range with len(self).
+            _, nearest = self.tree.query(
+                xyz, distance_upper_bound=chord_radius(max_distance))
+            nearest[nearest == len(self)] = MISSING
+        found = nearest != MISSING
+        distance = np.full(len(long_lat), np.nan)
+        distance[found] = distances(
+            long_lat[found], self.long_lat[nearest[found]], "fast")
+        if max_distance is not None:
+            nearest = np.where(distance <= max_distance, nearest, MISSING)
+        return self._assign(nearest, distance)
+
+    def query_box(self, west, south, east, north):
+        """
+        Cities within a box of longitude and latitude, edges included.
+        A box with west greater than east crosses the antimeridian.
+
+        Returns:
+            Assignment: One entry per city, in order of longitude,
+            with a distance of zero.
+        """
+        if west <= east:
+            spans = [(west, east)]
+        else:
+            spans = [(west, np.inf), (-np.inf, east)]
+        inside = list()
+        for low, high in spans:
+            start = np.searchsorted(self.sorted_long, low, "left")
+            stop = np.searchsorted(self.sorted_long, high, "right")
+            candidates = self.by_long[start:stop]
+            lat = self.long_lat[candidates, 1]
+            inside.append(candidates[(lat >= south) & (lat <= north)])
+        found = np.concatenate(inside)
+        return self._assign(found, np.zeros(len(found), dtype=np.float64))
+
+    def _assign(self, index, distance):
+        """Look up arrays by city index, where -1 is no city."""
+        missing = index == MISSING
+        if len(self) == 0:
+            empty = np.full(len(index), MISSING, dtype=np.int64)
+            return Assignment(empty, empty, empty, np.full(len(index), np.nan))
+        safe = np.where(missing, 0, index)
+        return Assignment(
+            np.where(missing, MISSING, self.nodes[safe]),
+            np.where(missing, MISSING, self.group[safe]),
+            np.where(missing, MISSING, self.level[safe]),
+            np.where(missing, np.nan, distance),
+        )
+
+
+def assignment_as_json(assignment):
+    """Lists for JSON, where a missing distance is null."""
+    return dict(
+        node=assignment.node.tolist(),
+        group=assignment.group.tolist(),
+        level=assignment.level.tolist(),
+        distance=[None if np.isnan(d) else d
+                  for d in assignment.distance.tolist()],
+    )
+
+
+def lookup_handler(index, max_distance=None):
+    """A request handler class that answers from this index."""
+    class LookupHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            try:
+                if url.path == "/point":
+                    long_lat = np.stack([
+                        np.array(query["long"], dtype=np.float64),
+                        np.array(query["lat"], dtype=np.float64),
+                    ], axis=1)
+                    self._reply(index.query(long_lat, max_distance))
+                elif url.path == "/box":
+                    box = [float(query[side][0])
+                           for side in ["west", "south", "east", "north"]]
+                    self._reply(index.query_box(*box))
+                else:
+                    self.send_error(404, f"No such path {url.path}")
+            except (KeyError, ValueError) as bad:
+                self.send_error(400, f"Bad query: {bad}")
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/points":
+                self.send_error(404, f"No such path {self.path}")
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length))
+                long_lat = np.stack([
+                    np.array(body["long"], dtype=np.float64),
+                    np.array(body["lat"], dtype=np.float64),
+                ], axis=1)
+            except (KeyError, TypeError, ValueError) as bad:
+                self.send_error(400, f"Bad request: {bad}")
+                return
+            self._reply(index.query(long_lat, max_distance))
+
+        def _reply(self, assignment):
+            content = json.dumps(assignment_as_json(assignment)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            LOGGER.debug(f"{self.address_string()} {format % args}")
+
+    return LookupHandler
+
+
+def serve(index, host="127.0.0.1", port=8765, max_distance=None):
+    """Answer lookups over HTTP until interrupted."""
+    server = ThreadingHTTPServer((host, port),
+                                 lookup_handler(index, max_distance))
+    LOGGER.info(f"Answering lookups at http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info("Stopping lookup server")
+    finally:
+        server.server_close()
+
+
+def lookup_csv(index, in_path, out_path, max_distance=None):
+    """
+    Assign each row of a CSV with ``long`` and ``lat`` columns and write
+    the rows with ``node``, ``group``, ``level`` and ``distance`` added.
+    """
+    points = pd.read_csv(in_path)
+    assignment = index.query(points[["long", "lat"]].values, max_distance)
+    for column, values in assignment._asdict().items():
+        points[column] = values
+    points.to_csv(out_path, index=False)
+    LOGGER.info(f"Wrote {len(points)} assignments to {out_path}")
+
+
+def parser():
+    parse_obj = ArgumentParser(
+        description=getmodule(parser).__doc__,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parse_obj.add_argument("--segmented", type=Path, default="segmented.h5",
+                           help="Output of citysplit")
+    parse_obj.add_argument("--points", type=Path, default=None,
+                           help="CSV with long and lat columns to assign")
+    parse_obj.add_argument("--output", type=Path, default="assigned.csv",
+                           help="Where to write assignments for --points")
+    parse_obj.add_argument("--max-distance", type=float, default=None,
+                           help=("Distance in km beyond which a point "
+                                 "has no city. Default assigns every point."))
+    parse_obj.add_argument("--serve", action="store_true",
+                           help="Answer lookups over HTTP")
+    parse_obj.add_argument("--host", default="127.0.0.1",
+                           help="Address for --serve")
+    parse_obj.add_argument("--port", type=int, default=8765,
+                           help="Port for --serve")
+    parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
+                           default=0)
+    parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
+                           default=0)
+    return parse_obj
+
+
+def entry():
+    args = parser().parse_args()
+    logging_level = logging.INFO - 10 * args.verbose + 10 * args.quiet
+    logging.basicConfig(level=logging_level)
+
+    if not args.segmented.exists():
+        LOGGER.error(f"Segmented file not found: {args.segmented}")
+        exit(1)
+    if args.points is None and not args.serve:
+        LOGGER.error("Give --points, --serve, or both.")
+        exit(1)
+    max_distance = None if args.max_distance is None else 1000 * args.max_distance
+    index = CommunityIndex.from_file(args.segmented)
+    if args.points is not None:
+        lookup_csv(index, args.points, args.output, max_distance)
+    if args.serve:
+        serve(index, args.host, args.port, max_distance)
+
+
+if __name__ == "__main__":
+    entry()
@@ -0,0 +1,145 @@
+"""
+Ways to cut one connected component of the flow graph into pieces.
+Each backend takes a :class:`FlowGraph` and an array of node indices
+of a connected component, and returns the connected pieces left after
+its cut, as arrays of node indices ordered by their smallest node.
+"""
+import logging
+import re
+import warnings
+
+import networkx as nx
+import numpy as np
+from networkx.algorithms.flow import shortest_augmenting_path
+from scipy.sparse import diags, triu
+from scipy.sparse.linalg import lobpcg
+
+from .flow_graph import components_of
+
+LOGGER = logging.getLogger(__name__)
+DENSE_SPECTRAL_SIZE = 256
+"""Below this many nodes, solve for the Fiedler vector with dense LAPACK."""
+NOT_CONVERGED = r"(?s).*not reaching the requested tolerance"
+"""How LOBPCG's warnings say it stopped before converging."""
+
+
+def min_cut_pieces(flow_graph, parent_component):
+    """
+    Remove a minimum edge cut, ignoring capacities, using networkx
+    max-flow. This often removes a single node.
+    """
+    first, second, _ = flow_graph.edges(parent_component)
+    parent_graph = nx.Graph()
+    parent_graph.add_nodes_from(range(len(parent_component)))
+    parent_graph.add_edges_from(zip(first.tolist(), second.tolist()))
+    remove_edges = nx.minimum_edge_cut(
+        parent_graph,
+        flow_func=shortest_augmenting_path,
+    )
+    parent_graph.remove_edges_from(remove_edges)
+    pieces = [np.array(sorted(child), dtype=np.int64)
+              for child in nx.connected_components(parent_graph)]
+    pieces.sort(key=lambda piece: piece[0])
+    return [parent_component[piece] for piece in pieces]
+
+
+def fiedler_vector(capacity):
+    """
+    Eigenvector of the second-smallest eigenvalue of the
+    capacity-weighted graph Laplacian of a connected graph.
+
+    Large graphs use LOBPCG, constrained to be orthogonal to the
+    constant vector, with a Jacobi preconditioner and a fixed seed,
+    so results are repeatable.
+
+    Args:
+        capacity (scipy.sparse matrix): Symmetric capacities.
+
+    Returns:
+        np.array: One value per node.
+    """
+    node_cnt = capacity.shape[0]
+    weights = capacity / abs(capacity).max()
+    degree = np.asarray(weights.sum(axis=1)).ravel()
+    laplacian = diags(degree) - weights
+    if node_cnt < DENSE_SPECTRAL_SIZE:
+        _, vectors = np.linalg.eigh(laplacian.toarray())
+        return vectors[:, 1]
+    rng = np.random.RandomState(node_cnt)
+    guess = rng.uniform(-1, 1, size=(node_cnt, 1))
+    constant = np.ones((node_cnt, 1))
+    preconditioner = diags(1 / np.maximum(degree, 1e-12))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.filterwarnings("always", NOT_CONVERGED, UserWarning)
+        _, vectors = lobpcg(
+            laplacian.tocsr(), guess, M=preconditioner, Y=constant,
+            tol=1e-5, maxiter=500, largest=False,
+        )
+    not_converged = False
+    for warning in caught:
+        if re.match(NOT_CONVERGED, str(warning.message)):
+            not_converged = True
+        else:
+            warnings.warn_explicit(warning.message, warning.category,
+                                   warning.filename, warning.lineno)
+    if not_converged:
+        # The sweep cut still works from the best ordering found.
+        LOGGER.warning(f"LOBPCG did not converge for {node_cnt} nodes, "
+                       f"so the cut may be less balanced")
+    return vectors[:, 0]
+
+
+def sweep_cut(capacity, ordering):
+    """
+    Cut nodes into a prefix and suffix of the ordering, choosing the
+    split that minimizes cut capacity divided by the size of the
+    smaller side, which favors balanced pieces.
+
+    Args:
+        capacity (scipy.sparse matrix): Symmetric capacities.
+        ordering (np.array): Value per node to sort by.
+
+    Returns:
+        np.array: Boolean, true for nodes in the prefix.
+    """
+    node_cnt = capacity.shape[0]
+    order = np.argsort(ordering, kind="stable")
+    rank = np.empty(node_cnt, dtype=np.int64)
+    rank[order] = np.arange(node_cnt)
+    upper = triu(capacity, k=1, format="coo")
+    low = np.minimum(rank[upper.row], rank[upper.col])
+    high = np.maximum(rank[upper.row], rank[upper.col])
+    # An edge crosses the cut after position k when low <= k < high.
+    delta = np.zeros(node_cnt + 1, dtype=np.float64)
+    np.add.at(delta, low, upper.data)
+    np.add.at(delta, high, -upper.data)
+    cut = np.cumsum(delta)[:node_cnt - 1]
+    prefix = np.arange(1, node_cnt)
+    score = cut / np.minimum(prefix, node_cnt - prefix)
+    split = int(np.argmin(score))
+    in_prefix = np.zeros(node_cnt, dtype=np.bool_)
+    in_prefix[order[:split + 1]] = True
+    return in_prefix
+
+
+def spectral_pieces(flow_graph, parent_component):
+    """
+    Capacity-weighted spectral bisection with a sweep cut along the
+    Fiedler vector. Each side may fall apart into several pieces.
+    """
+    capacity = flow_graph.sub_capacity(parent_component)
+    in_prefix = sweep_cut(capacity, fiedler_vector(capacity))
+    pieces = list()
+    for side in [np.flatnonzero(in_prefix), np.flatnonzero(~in_prefix)]:
+        side_capacity = capacity[side][:, side]
+        pieces.extend(side[piece] for piece in components_of(side_capacity))
+    pieces.sort(key=lambda piece: piece[0])
+    LOGGER.debug(f"Spectral cut of {len(parent_component)} into "
+                 f"{[len(piece) for piece in pieces]}")
+    return [parent_component[piece] for piece in pieces]
+
+
+PARTITIONS = {
+    "min-cut": min_cut_pieces,
+    "spectral": spectral_pieces,
+}
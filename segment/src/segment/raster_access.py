@@ -1,5 +1,8 @@
 import logging
-from collections import namedtuple
+from collections import Counter, namedtuple
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import perf_counter
 
 import numpy as np
 from osgeo import gdal
@@ -8,16 +11,47 @@ LOGGER = logging.getLogger(__name__)
 BandType = namedtuple("BandType", "gdal numpy")
 INT32 = BandType(gdal.GDT_Int32, np.int32)
 FLOAT64 = BandType(gdal.GDT_Float64, np.double)
+RASTER_READS = Counter()
+"""
+Reads and bytes requested from GDAL, bytes served from memory maps, and
+how often, and for how many seconds, readers waited on prefetched rows.
+"""
+PREFETCH_ROWS = 64
+"""Fewest rows a prefetching reader asks GDAL for at once."""
+
+
+def mapped_window(band, x_limits, y_limits, data_type):
+    """
+    A window of a band from :mod:`segment.raster_cache`, as an [x, y]
+    view of its memory map, or None for a GDAL band. The view is only
+    copied when ``data_type`` differs from the stored type.
+    """
+    mapped = getattr(band, "mapped", None)
+    if mapped is None:
+        return None
+    window = mapped[y_limits[0]:y_limits[1], x_limits[0]:x_limits[1]].T
+    RASTER_READS["mapped_bytes"] += window.nbytes
+    return window.astype(data_type.numpy, copy=False)
+
+
+def _count_read(buffer):
+    RASTER_READS["reads"] += 1
+    RASTER_READS["bytes"] += len(buffer)
 
 
 def band_as_numpy(band, data_type=None):
     data_type = data_type if data_type else INT32
+    mapped = mapped_window(band, (0, band.XSize), (0, band.YSize), data_type)
+    if mapped is not None:
+        return mapped
     scanline_buffer = band.ReadRaster(
         xoff=0, yoff=0, xsize=band.XSize, ysize=band.YSize,
         buf_xsize=band.XSize, buf_ysize=band.YSize, buf_type=data_type.gdal,
     )
+    _count_read(scanline_buffer)
     scanline = np.frombuffer(scanline_buffer, dtype=data_type.numpy)
-    return np.reshape(scanline, (band.XSize, band.YSize))
+    # GDAL returns rows of x, so reshape as [y, x] and transpose to [x, y].
+    return np.reshape(scanline, (band.YSize, band.XSize)).T
 
 
 def sub_band_as_numpy(band, y_limits, data_type=None):
@@ -25,6 +59,9 @@ def sub_band_as_numpy(band, y_limits, data_type=None):
     in memory. It seems wasteful to reread parts, but GDAL keeps its own cache.
     """
     data_type = data_type if data_type else INT32
+    mapped = mapped_window(band, (0, band.XSize), y_limits, data_type)
+    if mapped is not None:
+        return mapped
     y_size = y_limits[1] - y_limits[0]
     LOGGER.debug(f"sub_band y_size={y_size} y_limits {y_limits[0]}")
     scanline_buffer = band.ReadRaster(
@@ -36,5 +73,287 @@ def sub_band_as_numpy(band, y_limits, data_type=None):
         buf_ysize=y_size,
         buf_type=data_type.gdal,
     )
+    _count_read(scanline_buffer)
     scanline = np.frombuffer(scanline_buffer, dtype=data_type.numpy)
-    return np.reshape(scanline, (band.XSize, y_size))
+    return np.reshape(scanline, (y_size, band.XSize)).T
+
+
+def window_as_numpy(band, x_limits, y_limits, data_type=None):
+    """Read a rectangle of the band, indexed as [x, y] like the other readers.
+
+    Args:
+        band: A GDAL raster band.
+        x_limits (Tuple[int,int]): First and one-past-last column.
+        y_limits (Tuple[int,int]): First and one-past-last row.
+        data_type (BandType): Type of the returned array.
+
+    Returns:
+        np.array: With shape (x size, y size).
+    """
+    data_type = data_type if data_type else INT32
+    mapped = mapped_window(band, x_limits, y_limits, data_type)
+    if mapped is not None:
+        return mapped
+    x_size = x_limits[1] - x_limits[0]
+    y_size = y_limits[1] - y_limits[0]
+    LOGGER.debug(f"window x_limits {x_limits} y_limits {y_limits}")
+    window_buffer = band.ReadRaster(
+        xoff=x_limits[0],
+        yoff=y_limits[0],
+        xsize=x_size,
+        ysize=y_size,
+        buf_xsize=x_size,
+        buf_ysize=y_size,
+        buf_type=data_type.gdal,
+    )
+    _count_read(window_buffer)
+    window = np.frombuffer(window_buffer, dtype=data_type.numpy)
+    return np.reshape(window, (y_size, x_size)).T
+
+
+class RowPrefetcher:
+    """
+    Reads rows of a band in order on a background thread, so that the
+    next rows are decoded while the caller works on the current ones.
+    GDAL releases the GIL while it reads.
+
+    The thread stays at most ``depth`` chunks ahead of the caller.
+    Each time the caller has to wait for a chunk, that is a stall, and
+    its wait is added to ``stall_seconds``. Stalls with a deeper queue
+    mean reads are slower than the work; no stalls with a shallow queue
+    means a deeper queue won't help.
+
+    Only the thread uses the band until the last row is read or
+    :meth:`close` is called.
+
+    Args:
+        band: A GDAL raster band.
+        x_limits (Tuple[int,int]): First and one-past-last column.
+        y_limits (Tuple[int,int]): First and one-past-last row to read.
+        data_type (BandType): Type of the returned arrays.
+        chunk_rows (int): Rows per read.
+        depth (int): Most chunks to hold that the caller hasn't taken.
+    """
+    def __init__(self, band, x_limits, y_limits, data_type, chunk_rows,
+                 depth):
+        self.band = band
+        self.x_limits = x_limits
+        self.y_limits = (int(y_limits[0]), int(y_limits[1]))
+        self.data_type = data_type
+        self.chunk_rows = chunk_rows
+        self.next_row = self.y_limits[0]
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self._queue = Queue(maxsize=max(1, depth))
+        self._stop = Event()
+        self._pending = None
+        self._thread = Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _offer(self, item):
+        """Wait for room in the queue unless asked to stop."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            y_begin, y_end = self.y_limits
+            for chunk_begin in range(y_begin, y_end, self.chunk_rows):
+                chunk_end = min(y_end, chunk_begin + self.chunk_rows)
+                chunk = window_as_numpy(
+                    self.band, self.x_limits, (chunk_begin, chunk_end),
+                    self.data_type,
+                )
+                if not self._offer((chunk_begin, chunk)):
+                    return
+        except Exception as error:
+            self._offer((None, error))
+
+    def _take(self):
+        try:
+            item = self._queue.get_nowait()
+        except Empty:
+            began = perf_counter()
+            item = self._queue.get()
+            waited = perf_counter() - began
+            self.stalls += 1
+            self.stall_seconds += waited
+            RASTER_READS["stalls"] += 1
+            RASTER_READS["stall_seconds"] += waited
+        if item[0] is None:
+            raise item[1]
+        return item
+
+    def read(self, y_begin, y_end):
+        """
+        The next rows, indexed as [x, y - y_begin]. Calls must ask for
+        consecutive runs of rows, starting at the first row.
+        """
+        if y_begin != self.next_row or y_end > self.y_limits[1]:
+            raise ValueError(
+                f"Asked for rows {y_begin}-{y_end} from a prefetcher at "
+                f"row {self.next_row} that ends at {self.y_limits[1]}.")
+        pieces = list()
+        row = y_begin
+        while row < y_end:
+            if self._pending is None:
+                self._pending = self._take()
+            chunk_begin, chunk = self._pending
+            offset = row - chunk_begin
+            used = min(chunk.shape[1] - offset, y_end - row)
+            pieces.append(chunk[:, offset:offset + used])
+            row += used
+            if offset + used == chunk.shape[1]:
+                self._pending = None
+        self.next_row = y_end
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces, axis=1)
+
+    def close(self):
+        """Stop the thread and wait for it, so the band is free."""
+        self._stop.set()
+        self._thread.join()
+
+
+class RowWindowReader:
+    """
+    Reads a band in order of increasing rows, keeping recent rows in a
+    ring buffer so that each row is read from the file once.
+
+    Reads are clipped to the requested columns and line up with the
+    band's block rows, so a scan from top to bottom asks GDAL for each block
+    exactly once. Every row is stored twice in a buffer of twice the
+    capacity, so any run of rows in the buffer is a contiguous slice.
+    A band from :mod:`segment.raster_cache` is already in memory, so
+    its rows are returned as views without a buffer.
+
+    With a prefetch depth, a :class:`RowPrefetcher` reads the rows
+    below the last request while the caller works, until ``y_stop``.
+    Use the reader in a ``with`` block, or call :meth:`close`, so the
+    thread lets go of the band.
+
+    Args:
+        band: A GDAL raster band.
+        x_limits (Tuple[int,int]): First and one-past-last column to read.
+            These are clipped to the band.
+        window_rows (int): The most rows that any one request will ask for.
+        data_type (BandType): Type of the returned arrays.
+        prefetch_depth (int): Chunks of rows to read ahead. Zero reads
+            only when asked.
+        y_stop (int): The last row any request will need, plus one.
+            Defaults to the bottom of the band.
+    """
+    def __init__(self, band, x_limits, window_rows, data_type=None,
+                 prefetch_depth=0, y_stop=None):
+        self.band = band
+        self.data_type = data_type if data_type else INT32
+        self.x_limits = (int(max(0, x_limits[0])),
+                         int(min(band.XSize, x_limits[1])))
+        self.block_rows = max(1, band.GetBlockSize()[1])
+        self.window_rows = window_rows
+        self.capacity = window_rows + self.block_rows
+        width = self.x_limits[1] - self.x_limits[0]
+        self._mapped = getattr(band, "mapped", None) is not None
+        buffer_rows = 0 if self._mapped else 2 * self.capacity
+        self._buffer = np.empty((width, buffer_rows),
+                                dtype=self.data_type.numpy)
+        self._first_row = None
+        self._next_row = None
+        self.reads = 0
+        self.bytes_read = 0
+        self.prefetch_depth = 0 if self._mapped else prefetch_depth
+        self.y_stop = band.YSize if y_stop is None else min(band.YSize, y_stop)
+        self._prefetcher = None
+        self._stalls = 0
+        self._stall_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def rows(self, y_limits):
+        """
+        The rows in ``y_limits``, indexed as [x - x_limits[0], y - y_limits[0]].
+        The returned array is a view into the ring buffer, so it is only
+        valid until the next call.
+        """
+        y_begin, y_end = int(y_limits[0]), int(y_limits[1])
+        if y_end - y_begin > self.window_rows:
+            raise ValueError(
+                f"Asked for {y_end - y_begin} rows from a reader "
+                f"that holds {self.window_rows}.")
+        if self._mapped:
+            return mapped_window(
+                self.band, self.x_limits, (y_begin, y_end), self.data_type)
+        restart = (self._next_row is None or y_begin < self._first_row
+                   or y_begin > self._next_row)
+        if restart:
+            self._next_row = (y_begin // self.block_rows) * self.block_rows
+            if self.prefetch_depth > 0:
+                self._start_prefetch(self._next_row)
+        if self._next_row < y_end:
+            block_end = -(-y_end // self.block_rows) * self.block_rows
+            self._read(self._next_row, min(self.band.YSize, block_end))
+        self._first_row = y_begin
+        start = y_begin % self.capacity
+        return self._buffer[:, start:start + y_end - y_begin]
+
+    def _start_prefetch(self, y_begin):
+        self._stop_prefetch()
+        chunk_rows = -(-PREFETCH_ROWS // self.block_rows) * self.block_rows
+        y_end = -(-self.y_stop // self.block_rows) * self.block_rows
+        y_end = max(y_begin, min(self.band.YSize, y_end))
+        self._prefetcher = RowPrefetcher(
+            self.band, self.x_limits, (y_begin, y_end), self.data_type,
+            chunk_rows, self.prefetch_depth,
+        )
+
+    def _stop_prefetch(self):
+        """Stop the thread and keep its stalls, without moving the buffer."""
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._stalls += self._prefetcher.stalls
+            self._stall_seconds += self._prefetcher.stall_seconds
+            self._prefetcher = None
+
+    def close(self):
+        """Stop reading ahead. Reading again starts another prefetcher."""
+        if self._prefetcher is not None:
+            self._stop_prefetch()
+            self._next_row = None
+
+    @property
+    def stalls(self):
+        """Times the caller waited for prefetched rows, and for how long."""
+        if self._prefetcher is None:
+            return self._stalls, self._stall_seconds
+        return (self._stalls + self._prefetcher.stalls,
+                self._stall_seconds + self._prefetcher.stall_seconds)
+
+    def _read(self, y_begin, y_end):
+        LOGGER.debug(f"RowWindowReader rows {y_begin}-{y_end}")
+        if (self._prefetcher is not None
+                and y_end > self._prefetcher.y_limits[1]):
+            # Past y_stop, so the band is read here and not by the thread.
+            self._stop_prefetch()
+        if self._prefetcher is not None:
+            chunk = self._prefetcher.read(y_begin, y_end)
+        else:
+            chunk = window_as_numpy(
+                self.band, self.x_limits, (y_begin, y_end), self.data_type)
+        self.reads += 1
+        self.bytes_read += chunk.nbytes
+        # Only the last rows fit when a read restarts below a block boundary.
+        keep = max(y_begin, y_end - self.capacity)
+        ring_index = np.arange(keep, y_end) % self.capacity
+        self._buffer[:, ring_index] = chunk[:, keep - y_begin:]
+        self._buffer[:, ring_index + self.capacity] = chunk[:, keep - y_begin:]
+        self._next_row = y_end
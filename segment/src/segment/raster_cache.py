@@ -0,0 +1,314 @@
+"""
+Converts a raster, such as the LandScan directory or a PfPR GeoTIFF,
+into a cache directory that later runs open in milliseconds.
+
+The cache is a directory holding ``header.json``, with the geotransform,
+projection, data type and nodata value, and one ``.npy`` file per level
+of a pyramid. Level 0 is the raster itself. Each later level halves the
+width and height, summing population or averaging rates, until the
+raster is small. Arrays are stored row-major, as [y, x], so any block
+of rows is a contiguous chunk of the file. They are opened as
+read-only memory maps, so reads are views of the OS page cache, and
+processes reading the same raster share pages.
+
+Use :func:`segment.input_data.load_lspop` or
+:func:`segment.input_data.load_pfpr` on the cache directory in place of
+the original raster.
+"""
+import json
+import logging
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from inspect import getmodule
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal
+
+from .raster_access import FLOAT64, INT32, sub_band_as_numpy
+
+LOGGER = logging.getLogger(__name__)
+HEADER = "header.json"
+FORMAT_VERSION = 1
+CHUNK_ROWS = 1024
+"""Rows converted at a time, and the block size reported to readers."""
+SMALLEST_LEVEL = 256
+"""Stop the pyramid once a level is this wide and tall or less."""
+GDAL_TYPES = {
+    "int32": gdal.GDT_Int32,
+    "int64": getattr(gdal, "GDT_Int64", gdal.GDT_Unknown),
+    "float64": gdal.GDT_Float64,
+}
+
+
+def is_raster_cache(path):
+    return (Path(path) / HEADER).exists()
+
+
+class CachedBand:
+    """
+    One level of a cached raster. It answers the parts of the GDAL band
+    interface that this package uses, and ``mapped`` is the memory-mapped
+    array, indexed as [y, x] like GDAL's buffers.
+    """
+    def __init__(self, mapped, nodata, minimum, maximum, overviews=None):
+        self.mapped = mapped
+        self.YSize, self.XSize = mapped.shape
+        self.DataType = GDAL_TYPES[mapped.dtype.name]
+        self._nodata = nodata
+        self._minimum = minimum
+        self._maximum = maximum
+        self._overviews = overviews if overviews else list()
+
+    def GetNoDataValue(self):
+        return self._nodata
+
+    def GetMinimum(self):
+        return self._minimum
+
+    def GetMaximum(self):
+        return self._maximum
+
+    def GetBlockSize(self):
+        return [self.XSize, CHUNK_ROWS]
+
+    def GetOverviewCount(self):
+        return len(self._overviews)
+
+    def GetOverview(self, index):
+        return self._overviews[index]
+
+    def ReadRaster(self, xoff, yoff, xsize, ysize, buf_xsize=None,
+                   buf_ysize=None, buf_type=None):
+        """Bytes of a window, for code written against GDAL bands."""
+        assert buf_xsize in (None, xsize) and buf_ysize in (None, ysize)
+        window = self.mapped[yoff:yoff + ysize, xoff:xoff + xsize]
+        numpy_type = {v: k for (k, v) in GDAL_TYPES.items()}[buf_type]
+        return window.astype(numpy_type, copy=False).tobytes()
+
+
+class CachedDataset:
+    """The dataset side of a cached raster, with one band."""
+    def __init__(self, header, band):
+        self.header = header
+        self.band = band
+        self.RasterXSize = band.XSize
+        self.RasterYSize = band.YSize
+
+    def GetGeoTransform(self):
+        return tuple(self.header["geotransform"])
+
+    def GetProjection(self):
+        return self.header["projection"]
+
+    def GetRasterBand(self, index):
+        assert index == 1
+        return self.band
+
+
+def open_raster_cache(directory):
+    """
+    Open a cache directory made by :func:`write_raster_cache`.
+
+    Args:
+        directory (Path): The directory with ``header.json``.
+
+    Returns:
+        (CachedDataset, CachedBand): Level 0 of the pyramid. Its band's
+        ``GetOverview(i)`` is level ``i + 1``.
+    """
+    directory = Path(directory)
+    header = json.loads((directory / HEADER).read_text())
+    if header["version"] != FORMAT_VERSION:
+        raise RuntimeError(
+            f"Raster cache {directory} has version {header['version']} "
+            f"but this reads version {FORMAT_VERSION}.")
+    bands = [
+        CachedBand(
+            np.load(str(directory / level["file"]), mmap_mode="r"),
+            level["nodata"], level["minimum"], level["maximum"],
+        )
+        for level in header["levels"]
+    ]
+    bands[0]._overviews = bands[1:]
+    return CachedDataset(header, bands[0]), bands[0]
+
+
+def _statistics(values, nodata):
+    valid = values[values != nodata] if nodata is not None else values.ravel()
+    if np.issubdtype(valid.dtype, np.floating):
+        valid = valid[np.isfinite(valid)]
+    if valid.size == 0:
+        return None
+    return valid.min().item(), valid.max().item()
+
+
+def _merge_statistics(total, found):
+    if found is None:
+        return total
+    if total is None:
+        return found
+    return min(total[0], found[0]), max(total[1], found[1])
+
+
+def _halve(rows, aggregate, nodata):
+    """
+    Combine each 2x2 block of a [y, x] array. Missing pixels past an odd
+    edge and nodata pixels count as zero for sums and are left out of means.
+    """
+    y_size, x_size = rows.shape
+    present = np.ones(rows.shape, dtype=np.bool_)
+    if nodata is not None:
+        present &= rows != nodata
+    if np.issubdtype(rows.dtype, np.floating):
+        present &= np.isfinite(rows)
+    padded_shape = (y_size + y_size % 2, x_size + x_size % 2)
+    half_shape = (padded_shape[0] // 2, 2, padded_shape[1] // 2, 2)
+    value_type = np.int64 if aggregate == "sum" else np.float64
+    values = np.zeros(padded_shape, dtype=value_type)
+    values[:y_size, :x_size] = np.where(present, rows, 0)
+    total = values.reshape(half_shape).sum(axis=(1, 3))
+    if aggregate == "sum":
+        return total
+    valid = np.zeros(padded_shape, dtype=np.int64)
+    valid[:y_size, :x_size] = present
+    count = valid.reshape(half_shape).sum(axis=(1, 3))
+    mean = np.full(total.shape, np.nan if nodata is None else nodata)
+    np.divide(total, count, out=mean, where=count > 0)
+    return mean
+
+
+def write_raster_cache(band, dataset, directory, aggregate="sum",
+                       chunk_rows=CHUNK_ROWS, smallest=SMALLEST_LEVEL):
+    """
+    Copy a GDAL band into a cache directory, with its pyramid.
+
+    Args:
+        band: A GDAL raster band, either Int32 or Float64.
+        dataset: The GDAL dataset of the band.
+        directory (Path): Created if it doesn't exist.
+        aggregate (str): "sum" for counts, such as population, which
+            are stored as int64 above level 0. "mean" for rates,
+            such as PfPR, which are float64.
+        chunk_rows (int): How many rows to read at a time.
+        smallest (int): Stop when a level fits in this many pixels
+            on a side.
+
+    Returns:
+        dict: The header that was written.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    type_name = gdal.GetDataTypeName(band.DataType)
+    data_type = {"Int32": INT32, "Float64": FLOAT64}[type_name]
+    nodata = band.GetNoDataValue()
+    if nodata is not None and data_type.numpy == np.int32:
+        nodata = int(nodata)
+
+    levels = list()
+    source = None
+    size = (band.XSize, band.YSize)
+    level_nodata = nodata
+    while True:
+        level_idx = len(levels)
+        if level_idx == 0:
+            level_type = data_type.numpy
+        elif aggregate == "sum":
+            level_type, level_nodata = np.int64, None
+        else:
+            level_type = np.float64
+        level_file = f"level{level_idx}.npy"
+        LOGGER.info(f"Writing {level_file} with x={size[0]} y={size[1]}")
+        target = np.lib.format.open_memmap(
+            str(directory / level_file), mode="w+", dtype=level_type,
+            shape=(size[1], size[0]),
+        )
+        statistics = None
+        # Chunks hold an even number of rows so that halving lines up.
+        step = chunk_rows + chunk_rows % 2
+        for y_begin in range(0, size[1], step):
+            y_end = min(size[1], y_begin + step)
+            if source is None:
+                rows = sub_band_as_numpy(band, (y_begin, y_end), data_type).T
+            else:
+                rows = _halve(source[2 * y_begin:2 * y_end], aggregate,
+                              levels[-1]["nodata"])
+            target[y_begin:y_end] = rows
+            statistics = _merge_statistics(
+                statistics, _statistics(rows, level_nodata))
+        target.flush()
+        minimum, maximum = statistics if statistics else (None, None)
+        levels.append(dict(
+            file=level_file, factor=2**level_idx, x_size=size[0],
+            y_size=size[1], nodata=level_nodata, minimum=minimum,
+            maximum=maximum,
+        ))
+        if max(size) <= smallest:
+            break
+        source = target
+        size = ((size[0] + 1) // 2, (size[1] + 1) // 2)
+
+    header = dict(
+        version=FORMAT_VERSION,
+        geotransform=list(dataset.GetGeoTransform()),
+        projection=dataset.GetProjection(),
+        dtype=np.dtype(data_type.numpy).name,
+        nodata=nodata,
+        aggregate=aggregate,
+        levels=levels,
+    )
+    # The header goes last, so a directory with a header is complete.
+    (directory / HEADER).write_text(json.dumps(header, indent=2))
+    return header
+
+
+def overview_geotransform(geotransform, factor):
+    """Geotransform of a pyramid level whose pixels are ``factor`` wide."""
+    x0, dx, rx, y0, ry, dy = geotransform
+    return (x0, dx * factor, rx * factor, y0, ry * factor, dy * factor)
+
+
+def parser():
+    parse_obj = ArgumentParser(
+        description=getmodule(parser).__doc__,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parse_obj.add_argument("raster", type=Path,
+                           help="Raster file or directory that GDAL can open")
+    parse_obj.add_argument("cache", type=Path,
+                           help="Directory to write")
+    parse_obj.add_argument("--aggregate", choices=["sum", "mean"],
+                           default="sum",
+                           help=("Sum for population counts, "
+                                 "mean for rates such as PfPR"))
+    parse_obj.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS,
+                           help="Rows to convert at a time")
+    parse_obj.add_argument("--smallest", type=int, default=SMALLEST_LEVEL,
+                           help="Size in pixels of the last pyramid level")
+    parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
+                           default=0)
+    parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
+                           default=0)
+    return parse_obj
+
+
+def entry():
+    args = parser().parse_args()
+    logging_level = logging.INFO - 10 * args.verbose + 10 * args.quiet
+    logging.basicConfig(level=logging_level)
+
+    raster_path = args.raster.expanduser()
+    assert raster_path.exists(), f"Cannot find {raster_path}"
+    assert args.chunk_rows > 0
+    gdal.AllRegister()
+    dataset = gdal.Open(str(raster_path), gdal.GA_ReadOnly)
+    if not dataset:
+        LOGGER.error(f"Could not open {raster_path}.")
+        exit(1)
+    write_raster_cache(
+        dataset.GetRasterBand(1), dataset, args.cache.expanduser(),
+        args.aggregate, args.chunk_rows, args.smallest,
+    )
+
+
+if __name__ == "__main__":
+    entry()
@@ -4,11 +4,15 @@ from math import floor
 
 import numpy as np
 from geographiclib import geodesic
+from scipy.spatial import cKDTree
 
 WGS84 = geodesic.Geodesic(
     geodesic.Constants.WGS84_a, geodesic.Constants.WGS84_f)
 LongLat = namedtuple("LongLat", "long lat")
 """Longitude and latitude always get reversed, so use this to help."""
+CHORD_SLACK = 1e-5
+"""Relative slack on a chord radius, larger than the 2e-6 error of
+:func:`lambert_distances`."""
 
 
 class Direction(Enum):
@@ -58,7 +62,7 @@ def pixels_range_near_point(point, radius_in_meters, geo_transform):
         Range of long-lats to search.
     """
     # lat, then long
-    longlat = np.zeros((4, 2), dtype=np.int)
+    longlat = np.zeros((4, 2), dtype=np.int64)
     for idx, direction in enumerate(Direction):
         geo_dict = WGS84.Direct(
             point[1], point[0], direction.value, radius_in_meters
@@ -108,14 +112,185 @@ def pixel_corners_of_longlat_box(corners, geo_transform):
 
 
 def long_lat_to_xyz(long_lat):
-    earth_radius = 6378_000
+    """
+    Earth-centered, Earth-fixed coordinates of points on the WGS84
+    ellipsoid, in meters.
+
+    Args:
+        long_lat (np.array): Shape (points, 2) of longitude and latitude
+            in degrees.
 
-    lon = long_lat[:, 0] / 360.0
-    lat = long_lat[:, 1] / 360.0
+    Returns:
+        np.array: Shape (points, 3) of x, y and z.
+    """
+    long_lat = np.asarray(long_lat, dtype=np.float64).reshape(-1, 2)
+    a = geodesic.Constants.WGS84_a
+    f = geodesic.Constants.WGS84_f
+    e2 = f * (2 - f)
+    lon = np.radians(long_lat[:, 0])
+    lat = np.radians(long_lat[:, 1])
+    sin_lat = np.sin(lat)
     cos_lat = np.cos(lat)
-    return earth_radius * np.stack([
-        cos_lat * np.cos(lon),
-        cos_lat * np.sin(lon),
-        np.sin(lat),
+    # Radius of curvature in the prime vertical.
+    n = a / np.sqrt(1 - e2 * sin_lat**2)
+    return np.stack([
+        n * cos_lat * np.cos(lon),
+        n * cos_lat * np.sin(lon),
+        n * (1 - e2) * sin_lat,
     ], axis=1)
 
+
+def chord_radius(geodesic_distance):
+    """
+    Straight-line distance, through the Earth, that holds every pair of
+    points closer than this geodesic distance.
+
+    A chord is the shortest path between its ends, so it is never longer
+    than the geodesic. The slack covers rounding in
+    :func:`long_lat_to_xyz` and the error of the "fast" distances.
+    """
+    return geodesic_distance * (1 + CHORD_SLACK)
+
+
+def xyz_tree(long_lat):
+    """
+    A kd-tree of points in meters from :func:`long_lat_to_xyz`. Search it
+    with :func:`chord_radius` of a geodesic distance, and no point closer
+    than that distance is missed.
+    """
+    return cKDTree(long_lat_to_xyz(long_lat))
+
+
+def distances(a_longlat, b_longlat, method="exact"):
+    """
+    Geodesic distances, in meters, between many pairs of points.
+
+    Args:
+        a_longlat (np.array): Shape (pairs, 2) of longitude and latitude.
+        b_longlat (np.array): Shape (pairs, 2) of longitude and latitude.
+        method (str): "exact" uses :func:`vincenty_distances` and solves
+            the few pairs it can't, nearly antipodal ones, with
+            geographiclib. "fast" uses :func:`lambert_distances`.
+
+    Returns:
+        np.array: Distance for each pair.
+    """
+    a_longlat = np.asarray(a_longlat, dtype=np.float64)
+    b_longlat = np.asarray(b_longlat, dtype=np.float64)
+    if method == "exact":
+        result = vincenty_distances(a_longlat, b_longlat)
+        inverse = WGS84.Inverse
+        distance_only = geodesic.Geodesic.DISTANCE
+        for idx in np.flatnonzero(np.isnan(result)).tolist():
+            a, b = a_longlat[idx], b_longlat[idx]
+            result[idx] = inverse(a[1], a[0], b[1], b[0], distance_only)["s12"]
+        return result
+    elif method == "fast":
+        return lambert_distances(a_longlat, b_longlat)
+    else:
+        raise ValueError(f"Unknown distance method {method}")
+
+
+def vincenty_distances(a_longlat, b_longlat, tolerance=1e-12,
+                       iterations=100):
+    """
+    Vincenty's inverse formula on the WGS84 ellipsoid, vectorized.
+    It agrees with geographiclib to well under a millimeter, but its
+    iteration doesn't converge for some nearly antipodal points.
+
+    Args:
+        a_longlat (np.array): Shape (pairs, 2) of longitude and latitude.
+        b_longlat (np.array): Shape (pairs, 2) of longitude and latitude.
+        tolerance (float): Change in longitude on the auxiliary sphere,
+            in radians, at which a pair has converged.
+        iterations (int): Most iterations before giving up on a pair.
+
+    Returns:
+        np.array: Distance for each pair in meters, NaN where the
+        iteration didn't converge.
+    """
+    a = geodesic.Constants.WGS84_a
+    f = geodesic.Constants.WGS84_f
+    b = a * (1 - f)
+    d_long = np.radians(b_longlat[:, 0] - a_longlat[:, 0])
+    d_long = np.remainder(d_long + np.pi, 2 * np.pi) - np.pi
+    u_a = np.arctan((1 - f) * np.tan(np.radians(a_longlat[:, 1])))
+    u_b = np.arctan((1 - f) * np.tan(np.radians(b_longlat[:, 1])))
+    sin_a, cos_a = np.sin(u_a), np.cos(u_a)
+    sin_b, cos_b = np.sin(u_b), np.cos(u_b)
+
+    result = np.full(len(d_long), np.nan)
+    active = np.arange(len(d_long))
+    lam = d_long.copy()
+    for _ in range(iterations):
+        if len(active) == 0:
+            break
+        long_diff, lam_active = d_long[active], lam[active]
+        sa, ca, sb, cb = sin_a[active], cos_a[active], sin_b[active], cos_b[active]
+        sin_lam, cos_lam = np.sin(lam_active), np.cos(lam_active)
+        sin_sigma = np.hypot(cb * sin_lam, ca * sb - sa * cb * cos_lam)
+        cos_sigma = sa * sb + ca * cb * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Coincident points have no azimuth, and an equatorial line
+            # has no midpoint latitude.
+            sin_alpha = np.where(
+                sin_sigma > 0, ca * cb * sin_lam / sin_sigma, 0)
+            cos2_alpha = 1 - sin_alpha**2
+            cos_2sigma_m = np.where(
+                cos2_alpha > 0, cos_sigma - 2 * sa * sb / cos2_alpha, 0)
+        c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lam_next = long_diff + (1 - c) * f * sin_alpha * (
+            sigma + c * sin_sigma * (
+                cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+        lam[active] = lam_next
+        done = np.abs(lam_next - lam_active) < tolerance
+        u2 = cos2_alpha[done] * (a**2 - b**2) / b**2
+        big_a = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        big_b = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        s_sigma, c_sigma, c2m = sin_sigma[done], cos_sigma[done], cos_2sigma_m[done]
+        delta_sigma = big_b * s_sigma * (c2m + big_b / 4 * (
+            c_sigma * (-1 + 2 * c2m**2)
+            - big_b / 6 * c2m * (-3 + 4 * s_sigma**2) * (-3 + 4 * c2m**2)))
+        result[active[done]] = b * big_a * (sigma[done] - delta_sigma)
+        active = active[~done]
+    return result
+
+
+def lambert_distances(a_longlat, b_longlat):
+    """
+    Lambert's formula for distance on the WGS84 ellipsoid, vectorized.
+    It corrects a great-circle distance between reduced latitudes
+    to first order in the flattening. Compared with the geodesic, the
+    relative error stays below 2e-6 for pairs up to a few thousand
+    kilometers apart, which is under half a meter at a 200 km cutoff.
+    It is not meant for nearly antipodal points.
+
+    Args:
+        a_longlat (np.array): Shape (pairs, 2) of longitude and latitude.
+        b_longlat (np.array): Shape (pairs, 2) of longitude and latitude.
+
+    Returns:
+        np.array: Distance for each pair in meters.
+    """
+    a = geodesic.Constants.WGS84_a
+    f = geodesic.Constants.WGS84_f
+    beta_a = np.arctan((1 - f) * np.tan(np.radians(a_longlat[:, 1])))
+    beta_b = np.arctan((1 - f) * np.tan(np.radians(b_longlat[:, 1])))
+    d_long = np.radians(b_longlat[:, 0] - a_longlat[:, 0])
+    # Haversine central angle between reduced latitudes.
+    h = (np.sin(0.5 * (beta_b - beta_a))**2
+         + np.cos(beta_a) * np.cos(beta_b) * np.sin(0.5 * d_long)**2)
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    p = 0.5 * (beta_a + beta_b)
+    q = 0.5 * (beta_b - beta_a)
+    sin_half_sigma_2 = np.sin(0.5 * sigma)**2
+    cos_half_sigma_2 = 1 - sin_half_sigma_2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = ((sigma - np.sin(sigma)) * np.sin(p)**2 * np.cos(q)**2
+             / cos_half_sigma_2)
+        y = ((sigma + np.sin(sigma)) * np.cos(p)**2 * np.sin(q)**2
+             / sin_half_sigma_2)
+    x = np.where(cos_half_sigma_2 > 0, x, 0)
+    y = np.where(sin_half_sigma_2 > 0, y, 0)
+    return a * (sigma - 0.5 * f * (x + y))
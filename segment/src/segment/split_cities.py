@@ -1,21 +1,38 @@
 """
 Reads a file with city peaks. Assigns a flow graph to it.
 Partitions that flow graph into smaller parts.
+
+With a cache directory, city populations and the pairs of cities within
+the cutoff are kept apart from pfpr, so a run with only a new PfPR
+raster aggregates pfpr alone. Population-weighted pfpr regrids PfPR
+onto the LandScan grid once and keeps it, keyed by both rasters. Give
+the previous run's output with ``--previous`` to keep the groups of
+components whose flows didn't change.
 """
 import logging
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import namedtuple
 from inspect import getfile, getmodule
 from pathlib import Path
 from pickle import dump, load
 
 from osgeo import gdal
 
-from .communities import save_pandas, split_disconnected_graph
-from .flux import create_city_flows
+from .communities import load_previous, save_pandas, split_disconnected_graph
+from .flux import (
+    calculate_flows, candidate_pairs, city_long_lats, city_pop_pfpr,
+    flows_from_pairs, GRAVITY_CUTOFF, GRAVITY_EXPONENT, peak_pixels,
+    pfpr_region, PFPR_WEIGHTINGS, regrid_pfpr, replace_pfpr,
+)
 from .input_data import load_lspop, load_cities, load_pfpr
-from .vector import write_points_file
+from .instrument import StageRecorder
+from .partition import PARTITIONS
+from .stage_cache import stage_key, StageCache
+from .vector import write_points_file, VECTOR_FORMATS
 
 LOGGER = logging.getLogger(__name__)
+CityGraphKeys = namedtuple("CityGraphKeys", "population table pairs graph")
+"""Stage cache keys for the parts of a city graph."""
 
 
 def parser():
@@ -33,9 +50,9 @@ def parser():
     parse_obj.add_argument("--lspop", type=Path, default=landscan_file,
                            help=("Path to directory containing LandSat "
                                  "population raster"))
-    parse_obj.add_argument("--peaks", type=Path, default="city_peaks.csv",
-                           help=("Path to output csv file of peak radius, "
-                                 "peak x, peak y."))
+    parse_obj.add_argument("--peaks", type=Path, default="city_peaks.npy",
+                           help=("Path to peaks from citypeaks, "
+                                 "either .npy or .csv."))
     parse_obj.add_argument("--pfpr", type=Path, default=pfpr_file,
                            help=("Path to PfPR data from MAP project."))
     parse_obj.add_argument("--segmented", type=Path, default=output_path,
@@ -45,11 +62,58 @@ def parser():
     parse_obj.add_argument("--largest-component", type=int, default=10,
                            help=("The largest number of cities that could "
                                  "be together in a single component."))
+    parse_obj.add_argument("--window-gap", type=float, default=None,
+                           help=("Degrees between clusters of cities beyond "
+                                 "which each cluster reads its own window of "
+                                 "the rasters. Default reads one window."))
+    parse_obj.add_argument("--pfpr-weighting", choices=PFPR_WEIGHTINGS,
+                           default="box-mean",
+                           help=("Box-mean averages PfPR pixels near a city. "
+                                 "Population weights PfPR by the population "
+                                 "under it, on PfPR regridded to LandScan."))
+    parse_obj.add_argument("--regrid-factor", type=int, default=1,
+                           help=("LandScan pixels on a side of each cell of "
+                                 "regridded PfPR. Five matches PfPR's "
+                                 "resolution in a 25th of the memory."))
+    parse_obj.add_argument("--distance", choices=["exact", "fast"],
+                           default="exact",
+                           help=("Exact geodesics or Lambert's ellipsoidal "
+                                 "approximation for distances between cities."))
+    parse_obj.add_argument("--partition", choices=sorted(PARTITIONS.keys()),
+                           default="min-cut",
+                           help=("How to split large components. Spectral "
+                                 "makes balanced capacity-weighted cuts."))
+    parse_obj.add_argument("--workers", type=int, default=1,
+                           help=("Number of processes for splitting "
+                                 "components."))
     parse_obj.add_argument("--city-graph", type=Path, default=None,
-                           help=("A city graph pickle file."))
+                           help=("A city graph pickle file. It is used "
+                                 "when it was made from the same inputs and "
+                                 "parameters, and made again otherwise."))
+    parse_obj.add_argument("--cache-dir", type=Path, default=None,
+                           help=("Directory that keeps city tables and flow "
+                                 "graphs, keyed by input file hashes and "
+                                 "parameters."))
+    parse_obj.add_argument("--cache-size", type=float, default=20,
+                           help="Largest size of the cache directory in GB.")
+    parse_obj.add_argument("--previous", type=Path, default=None,
+                           help=("Output of an earlier run with the same "
+                                 "peaks, population, largest component and "
+                                 "partition. Components whose flows are the "
+                                 "same keep their groups."))
     parse_obj.add_argument("--groups-shapefile", type=Path, default="groups",
                             help=("Path to a shapefile to store cities as "
                                   "points with a layer for the group id."))
+    parse_obj.add_argument("--groups-format", choices=sorted(VECTOR_FORMATS),
+                           default="shapefile",
+                           help=("Vector format for groups and flows. "
+                                 "GeoPackage holds both layers in one file."))
+    parse_obj.add_argument("--no-flows", action="store_true",
+                           help="Leave the flows layer out of the groups file.")
+    parse_obj.add_argument("--profile-stage", nargs="+", default=[],
+                           choices=["regrid", "aggregate", "flows", "split",
+                                    "save", "vector"],
+                           help="Stages to run under cProfile")
     parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
                            default=0)
     parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
@@ -62,38 +126,218 @@ def entry():
     logging_level = logging.INFO - 10 * args.verbose + 10 * args.quiet
     logging.basicConfig(level=logging_level)
     gdal.AllRegister()  # Initializes drivers to read files.
+    recorder = StageRecorder(profile=args.profile_stage)
 
-    make_city_graph = args.city_graph is None or not args.city_graph.exists()
+    if args.cache_dir is not None:
+        cache = StageCache(args.cache_dir, int(args.cache_size * 2**30))
+    else:
+        cache = None
 
-    if make_city_graph:
+    city_graph_with_flows = None
+    if args.city_graph is not None:
+        check_inputs(args)
+        graph_key = city_graph_keys(
+            args, cache.key if cache is not None else stage_key).graph
+        city_graph_with_flows = load_city_graph(args.city_graph, graph_key)
+    if city_graph_with_flows is None:
         LOGGER.info("Making a new city graph")
-        city_graph_with_flows = create_city_graph(args)
+        city_graph_with_flows = create_city_graph(args, cache, recorder)
         if args.city_graph is not None:
-            dump(city_graph_with_flows, args.city_graph.open("wb"))
-    else:
-        LOGGER.info(f"Reading a city graph from {args.city_graph}")
-        city_graph_with_flows = load(args.city_graph.open("rb"))
+            with args.city_graph.open("wb") as out:
+                dump(dict(key=graph_key, graph=city_graph_with_flows), out)
+
+    previous = None
+    if args.previous is not None:
+        LOGGER.info(f"Reading previous groups from {args.previous}")
+        try:
+            previous = load_previous(
+                args.previous, args.largest_component, args.partition)
+        except ValueError as error:
+            LOGGER.error(error)
+            exit(1)
+    with recorder.stage("split") as counts:
+        graph, hierarchy = split_disconnected_graph(
+            city_graph_with_flows,  args.largest_component, args.partition,
+            args.workers, previous,
+        )
+        counts["groups"] = len(hierarchy)
+    with recorder.stage("save"):
+        save_pandas(graph, hierarchy, args.segmented,
+                    args.largest_component, args.partition)
+    with recorder.stage("vector"):
+        write_points_file(
+            graph, hierarchy, args.groups_shapefile,
+            VECTOR_FORMATS[args.groups_format], not args.no_flows,
+        )
+    recorder.write(Path("record.jsonl"), "citysplit", dict(
+        peaks=args.peaks, partition=args.partition, workers=args.workers,
+        largest_component=args.largest_component, distance=args.distance,
+        previous=args.previous, pfpr_weighting=args.pfpr_weighting,
+    ))
 
-    graph, hierarchy = split_disconnected_graph(
-        city_graph_with_flows,  args.largest_component
-    )
-    save_pandas(graph, hierarchy, args.segmented)
-    write_points_file(graph, hierarchy, args.groups_shapefile)
 
+def create_city_graph(args, cache=None, recorder=None):
+    """
+    Make the flow graph, reusing the city table and flow graph from
+    the stage cache when their inputs and parameters haven't changed.
 
-def create_city_graph(args):
+    The cache keeps city populations and the pairs of cities within
+    the cutoff under keys that don't depend on pfpr. When only the pfpr
+    raster changes, this reads pfpr alone and computes capacities for
+    the cached pairs. Population-weighted pfpr needs population again,
+    so it reads both rasters, but keeps the regridded pfpr.
+    """
+    recorder = recorder if recorder else StageRecorder()
+    check_inputs(args)
+    radius = args.peak_radius * 1000  # Convert to meters.
+    weighted = args.pfpr_weighting == "population"
+
+    pop_pfpr = None
+    population = None
+    if cache is not None:
+        population_key, table_key, pairs_key, graph_key = city_graph_keys(
+            args, cache.key)
+        city_graph_with_flows = cache.load(graph_key)
+        if city_graph_with_flows is not None:
+            return city_graph_with_flows
+        pop_pfpr = cache.load(table_key)
+        if pop_pfpr is None and not weighted:
+            population = cache.load(population_key)
+
+    if pop_pfpr is None:
+        pfpr = load_pfpr(args.pfpr)
+        regridded = None
+        if weighted:
+            with recorder.stage("regrid"):
+                cities = load_cities(args.peaks)
+                lspop = load_lspop(args.lspop)
+                regridded = regridded_pfpr(
+                    args, cache, cities, lspop, pfpr, radius)
+        with recorder.stage("aggregate") as counts:
+            if population is None or weighted:
+                if not weighted:
+                    cities = load_cities(args.peaks)
+                    lspop = load_lspop(args.lspop)
+                pop_pfpr = city_pop_pfpr(
+                    cities, lspop, pfpr, radius, args.window_gap,
+                    args.pfpr_weighting, regridded,
+                )
+            else:
+                LOGGER.info("Aggregating only pfpr for cached populations")
+                pop_pfpr = replace_pfpr(
+                    population, pfpr, radius, args.window_gap)
+            counts["cities"] = len(pop_pfpr)
+        if cache is not None:
+            if population is None and population_key not in cache:
+                cache.store(population_key, pop_pfpr)
+            cache.store(table_key, pop_pfpr)
+    with recorder.stage("flows"):
+        if cache is None:
+            city_graph_with_flows = calculate_flows(
+                pop_pfpr, GRAVITY_CUTOFF, GRAVITY_EXPONENT, args.distance)
+        else:
+            # Pairs among all cities, so they hold for any pfpr.
+            pairs = cache.load(pairs_key)
+            if pairs is None:
+                pairs = candidate_pairs(
+                    pop_pfpr[:, 2:4], GRAVITY_CUTOFF, args.distance)
+                cache.store(pairs_key, pairs)
+            city_graph_with_flows = flows_from_pairs(
+                pop_pfpr, *pairs, GRAVITY_CUTOFF, GRAVITY_EXPONENT)
+    if cache is not None:
+        cache.store(graph_key, city_graph_with_flows)
+    return city_graph_with_flows
+
+
+def check_inputs(args):
+    """Expand the input paths in args, and exit if one is missing."""
     for expand in ["peaks", "lspop", "pfpr"]:
         arg_path = getattr(args, expand).expanduser()
         if not arg_path.exists():
             LOGGER.error(f"Path to {expand} not found: {arg_path}")
             exit(1)
         setattr(args, expand, arg_path)
-    cities = load_cities(args.peaks)
-    lspop = load_lspop(args.lspop)
-    pfpr = load_pfpr(args.pfpr)
-    radius = args.peak_radius * 1000  # Convert to meters.
-    city_graph_with_flows = create_city_flows(cities, lspop, pfpr, radius)
-    return city_graph_with_flows
+
+
+def city_graph_keys(args, key):
+    """
+    Keys for the city table, pairs and flow graph.
+
+    Args:
+        args (Namespace): Parsed arguments, with paths from :func:`check_inputs`.
+        key (function): :meth:`StageCache.key`, or :func:`stage_key`
+            when there is no cache.
+
+    Returns:
+        CityGraphKeys: The graph key changes with any input or parameter.
+    """
+    radius = args.peak_radius * 1000
+    table_parameters = dict(radius=radius)
+    if args.pfpr_weighting == "population":
+        table_parameters.update(
+            weighting=args.pfpr_weighting, factor=args.regrid_factor)
+    population_key = key(
+        "city-population",
+        dict(peaks=args.peaks, lspop=args.lspop),
+        dict(radius=radius),
+    )
+    table_key = key(
+        "city-table",
+        dict(population=population_key, pfpr=args.pfpr),
+        table_parameters,
+    )
+    pairs_key = key(
+        "city-pairs",
+        dict(population=population_key),
+        dict(cutoff=GRAVITY_CUTOFF, distance=args.distance),
+    )
+    graph_key = key(
+        "flow-graph",
+        dict(table=table_key),
+        dict(cutoff=GRAVITY_CUTOFF, exponent=GRAVITY_EXPONENT,
+             distance=args.distance),
+    )
+    return CityGraphKeys(population_key, table_key, pairs_key, graph_key)
+
+
+def load_city_graph(path, graph_key):
+    """
+    The graph in a ``--city-graph`` pickle, or None if there is no file
+    or it was made from other inputs or parameters.
+    """
+    if not path.exists():
+        return None
+    LOGGER.info(f"Reading a city graph from {path}")
+    with path.open("rb") as source:
+        saved = load(source)
+    if not isinstance(saved, dict) or saved.get("key") != graph_key:
+        LOGGER.warning(f"{path} was made from other inputs or parameters, "
+                       f"so the city graph is made again")
+        return None
+    return saved["graph"]
+
+
+def regridded_pfpr(args, cache, cities, lspop, pfpr, radius):
+    """
+    PfPR on the LandScan grid under the cities, from the cache when
+    both rasters, the region, and the factor are the same.
+    """
+    long_lats = city_long_lats(
+        peak_pixels(cities), lspop.dataset.GetGeoTransform())
+    region = pfpr_region(long_lats, radius, lspop)
+    if cache is not None:
+        regrid_key = cache.key(
+            "pfpr-regrid",
+            dict(lspop=args.lspop, pfpr=args.pfpr),
+            dict(region=region, factor=args.regrid_factor),
+        )
+        regridded = cache.load(regrid_key)
+        if regridded is not None:
+            return regridded
+    regridded = regrid_pfpr(lspop, pfpr, region, args.regrid_factor)
+    if cache is not None:
+        cache.store(regrid_key, regridded)
+    return regridded
 
 
 if __name__ == "__main__":
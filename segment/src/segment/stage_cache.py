@@ -0,0 +1,184 @@
+"""
+A cache of stage outputs, such as peaks, city populations and flow graphs,
+addressed by a hash of the stage's input files and parameters.
+Changing any input file or parameter changes the key, so stale results
+are never reused. The least recently used entries are deleted when the
+cache grows past its size limit.
+
+File hashes are sha256 of contents, the same as the hashes recorded in
+record.txt. Hashing the LandScan directory takes a while, so each file's
+hash is remembered with its size and modification time.
+"""
+import json
+import logging
+import os
+from hashlib import sha256
+from pathlib import Path
+from pickle import dump, load
+from secrets import token_hex
+from time import time
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_MAXIMUM_BYTES = 20 * 2**30
+HASH_BLOCK = 2**20
+PARTIAL_SECONDS = 3600
+"""A partial entry older than this was left by a run that stopped."""
+
+
+def file_sha256(path):
+    """Hash of a file's contents, read in blocks."""
+    digest = sha256()
+    with path.open("rb") as source:
+        for block in iter(lambda: source.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def path_sha256(path, file_hash=file_sha256):
+    """
+    Hash of a file, or of every file in a directory with its relative
+    name, using ``file_hash`` for each file.
+    """
+    path = Path(path).expanduser().resolve()
+    if path.is_dir():
+        digest = sha256()
+        for child in sorted(p for p in path.rglob("*") if p.is_file()):
+            digest.update(str(child.relative_to(path)).encode())
+            digest.update(file_hash(child).encode())
+        return digest.hexdigest()
+    return file_hash(path)
+
+
+def stage_key(stage, inputs, parameters, input_hash=path_sha256):
+    """
+    Key for a stage from its inputs and parameters.
+
+    Args:
+        stage (str): Name of the stage, such as "peaks".
+        inputs (Dict[str,Path|str]): Input files, or keys of earlier
+            stages, which are used as they are.
+        parameters (Dict): Anything that changes the result and
+            can be written as JSON.
+        input_hash (function): Hashes a path.
+
+    Returns:
+        str: A hex key that starts with the stage name.
+    """
+    hashes = dict()
+    for name, value in inputs.items():
+        if isinstance(value, Path):
+            hashes[name] = input_hash(value)
+        else:
+            hashes[name] = str(value)
+    description = json.dumps(
+        dict(stage=stage, inputs=hashes, parameters=parameters),
+        sort_keys=True, default=str,
+    )
+    return f"{stage}-{sha256(description.encode()).hexdigest()}"
+
+
+class StageCache:
+    """
+    Stage outputs stored as pickles in a directory.
+
+    Args:
+        directory (Path): Where to keep entries. Created if missing.
+        maximum_bytes (int): Evict least recently used entries above this.
+    """
+    def __init__(self, directory, maximum_bytes=DEFAULT_MAXIMUM_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.maximum_bytes = maximum_bytes
+        self._hash_file = self.directory / "hashes.json"
+        if self._hash_file.exists():
+            self._known_hashes = json.loads(self._hash_file.read_text())
+        else:
+            self._known_hashes = dict()
+
+    def input_hash(self, path):
+        """
+        Hash of a file, or of every file in a directory with its relative
+        name, remembered by path, size, and modification time.
+        """
+        return path_sha256(path, self._one_file_hash)
+
+    def _one_file_hash(self, path):
+        status = path.stat()
+        known = self._known_hashes.get(str(path))
+        if known and known["size"] == status.st_size and known["mtime_ns"] == status.st_mtime_ns:
+            return known["sha256"]
+        LOGGER.info(f"Hashing {path}")
+        hexdigest = file_sha256(path)
+        self._known_hashes[str(path)] = dict(
+            size=status.st_size, mtime_ns=status.st_mtime_ns, sha256=hexdigest)
+        self._write_atomic(
+            self._hash_file, json.dumps(self._known_hashes, indent=1).encode())
+        return hexdigest
+
+    def key(self, stage, inputs, parameters):
+        """:func:`stage_key` with file hashes remembered in the cache."""
+        return stage_key(stage, inputs, parameters, self.input_hash)
+
+    def _entry(self, key):
+        return self.directory / f"{key}.pickle"
+
+    def __contains__(self, key):
+        return self._entry(key).exists()
+
+    def load(self, key):
+        """The stored value, or None if there is none."""
+        entry = self._entry(key)
+        if not entry.exists():
+            LOGGER.info(f"Stage cache miss {key[:24]}")
+            return None
+        LOGGER.info(f"Stage cache hit {key[:24]}")
+        os.utime(entry)  # Marks it as recently used.
+        with entry.open("rb") as source:
+            return load(source)
+
+    def store(self, key, value):
+        """Save a value and evict old entries if the cache is too large."""
+        entry = self._entry(key)
+        partial = entry.with_name(f"{entry.name}.{token_hex(4)}.partial")
+        with partial.open("wb") as out:
+            dump(value, out)
+        partial.replace(entry)
+        self.evict(keep=entry)
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used entries until under the size limit.
+        Partial entries left by runs that stopped are deleted, and newer
+        ones, which may still be written, count toward the size.
+
+        Args:
+            keep (Path): An entry not to delete, such as one just stored.
+        """
+        total = 0
+        for partial in self.directory.glob("*.partial"):
+            status = partial.stat()
+            if time() - status.st_mtime > PARTIAL_SECONDS:
+                LOGGER.info(f"Deleting {partial.name} from the stage cache")
+                partial.unlink()
+            else:
+                total += status.st_size
+        entries = [(p.stat().st_mtime, p.stat().st_size, p)
+                   for p in self.directory.glob("*.pickle")]
+        total += sum(size for (_, size, _) in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maximum_bytes:
+                break
+            if path == keep:
+                continue
+            LOGGER.info(f"Evicting {path.name} from the stage cache")
+            path.unlink()
+            total -= size
+        if total > self.maximum_bytes:
+            LOGGER.warning(f"Stage cache holds {total} bytes, more than "
+                           f"its limit of {self.maximum_bytes}")
+
+    @staticmethod
+    def _write_atomic(path, contents):
+        partial = path.with_name(f"{path.name}.{token_hex(4)}.partial")
+        partial.write_bytes(contents)
+        partial.replace(path)
@@ -0,0 +1,217 @@
+"""
+Runs the gravity model and segmentation for a grid of parameters in one job.
+
+City populations and pfpr are aggregated once for each radius, from
+PfPR regridded once when it is weighted by population, and
+distances between cities are found once, at the largest cutoff.
+Every combination of radius, cutoff and exponent then filters and
+reweights those arrays, splits the resulting flow graph, and writes
+it to its own HDF5 file. A summary table has one row per combination.
+"""
+import csv
+import logging
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import namedtuple
+from inspect import getmodule
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal
+
+from .communities import save_pandas, split_disconnected_graph
+from .flux import (
+    candidate_pairs, city_long_lats, city_pop_pfpr, flows_from_pairs,
+    peak_pixels, pfpr_region, PFPR_WEIGHTINGS, regrid_pfpr,
+)
+from .input_data import load_cities, load_lspop, load_pfpr
+from .instrument import StageRecorder
+from .partition import PARTITIONS
+from .split_cities import parser as split_parser
+
+LOGGER = logging.getLogger(__name__)
+Parameters = namedtuple("Parameters", "radius cutoff exponent")
+"""Radius and cutoff in meters, and the exponent of distance."""
+
+
+def parameter_grid(radii, cutoffs, exponents):
+    """Every combination, in a fixed order."""
+    return [Parameters(*values) for values
+            in product(sorted(radii), sorted(cutoffs), sorted(exponents))]
+
+
+def sweep_flow_graphs(tables, grid, distance_method="exact"):
+    """
+    Flow graphs for each set of parameters, measuring distances once.
+
+    Each graph is the same as :func:`segment.flux.calculate_flows` makes
+    for that radius's table, cutoff and exponent.
+
+    Args:
+        tables (Dict[float,np.array]): For each radius, the table from
+            :func:`segment.flux.assign_pop_and_pfpr_to_points`. Cities are
+            the same in every table, so their locations are too.
+        grid (List[Parameters]): Combinations to make.
+        distance_method (str): "exact" or "fast".
+
+    Returns:
+        Iterator[(Parameters, FlowGraph)]: One graph per combination.
+    """
+    long_lat = next(iter(tables.values()))[:, 2:4]
+    largest_cutoff = max(parameters.cutoff for parameters in grid)
+    first, second, r = candidate_pairs(long_lat, largest_cutoff, distance_method)
+    LOGGER.info(f"{len(first)} pairs within {largest_cutoff} m")
+    for parameters in grid:
+        LOGGER.info(f"Flows for {parameters}")
+        yield parameters, flows_from_pairs(
+            tables[parameters.radius], first, second, r,
+            parameters.cutoff, parameters.exponent,
+        )
+
+
+def summarize(parameters, graph, hierarchy):
+    """One row of the summary table."""
+    group_sizes = np.bincount(graph.group)
+    grouped = group_sizes[2:]
+    return dict(
+        radius_km=parameters.radius / 1000,
+        cutoff_km=parameters.cutoff / 1000,
+        exponent=parameters.exponent,
+        cities=len(graph),
+        edges=graph.edge_cnt,
+        total_flux=float(graph.capacity.sum() / 2),
+        components=len(graph.components()),
+        loners=int(group_sizes[1]) if len(group_sizes) > 1 else 0,
+        groups=len(hierarchy),
+        largest_group=int(grouped.max()) if len(grouped) else 0,
+    )
+
+
+def output_name(parameters):
+    return (f"r{parameters.radius / 1000:g}-c{parameters.cutoff / 1000:g}"
+            f"-e{parameters.exponent:g}.h5")
+
+
+def parser():
+    defaults = split_parser().parse_args([])
+    parse_obj = ArgumentParser(
+        description=getmodule(parser).__doc__,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parse_obj.add_argument("--lspop", type=Path, default=defaults.lspop,
+                           help=("Path to directory containing LandSat "
+                                 "population raster"))
+    parse_obj.add_argument("--peaks", type=Path, default=defaults.peaks,
+                           help="Path to peaks from citypeaks, .npy or .csv")
+    parse_obj.add_argument("--pfpr", type=Path, default=defaults.pfpr,
+                           help="Path to PfPR data from MAP project.")
+    parse_obj.add_argument("--radius", type=float, nargs="+",
+                           default=[defaults.peak_radius],
+                           help="Distances in km to gather population")
+    parse_obj.add_argument("--cutoff", type=float, nargs="+", default=[200],
+                           help="Distances in km beyond which there is no flow")
+    parse_obj.add_argument("--exponent", type=float, nargs="+", default=[1.0],
+                           help="Powers of distance in the gravity model")
+    parse_obj.add_argument("--output-dir", type=Path, default="sweep",
+                           help=("Directory for one HDF5 file per combination "
+                                 "and summary.csv"))
+    parse_obj.add_argument("--largest-component", type=int,
+                           default=defaults.largest_component,
+                           help=("The largest number of cities that could "
+                                 "be together in a single component."))
+    parse_obj.add_argument("--window-gap", type=float, default=None,
+                           help=("Degrees between clusters of cities beyond "
+                                 "which each cluster reads its own window."))
+    parse_obj.add_argument("--pfpr-weighting", choices=PFPR_WEIGHTINGS,
+                           default=defaults.pfpr_weighting,
+                           help="How a city's pfpr comes from nearby pixels")
+    parse_obj.add_argument("--regrid-factor", type=int,
+                           default=defaults.regrid_factor,
+                           help="LandScan pixels per side of regridded PfPR")
+    parse_obj.add_argument("--distance", choices=["exact", "fast"],
+                           default="exact",
+                           help="Distance method between cities")
+    parse_obj.add_argument("--partition", choices=sorted(PARTITIONS.keys()),
+                           default="min-cut",
+                           help="How to split large components")
+    parse_obj.add_argument("--workers", type=int, default=1,
+                           help="Number of processes for splitting")
+    parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
+                           default=0)
+    parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
+                           default=0)
+    return parse_obj
+
+
+def entry():
+    args = parser().parse_args()
+    logging_level = logging.INFO - 10 * args.verbose + 10 * args.quiet
+    logging.basicConfig(level=logging_level)
+    gdal.AllRegister()
+
+    for expand in ["peaks", "lspop", "pfpr"]:
+        arg_path = getattr(args, expand).expanduser()
+        if not arg_path.exists():
+            LOGGER.error(f"Path to {expand} not found: {arg_path}")
+            exit(1)
+        setattr(args, expand, arg_path)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    grid = parameter_grid(
+        [1000 * radius for radius in args.radius],
+        [1000 * cutoff for cutoff in args.cutoff],
+        args.exponent,
+    )
+    LOGGER.info(f"Sweeping {len(grid)} combinations")
+
+    recorder = StageRecorder()
+    cities = load_cities(args.peaks)
+    lspop = load_lspop(args.lspop)
+    pfpr = load_pfpr(args.pfpr)
+    radii = sorted({parameters.radius for parameters in grid})
+    regridded = None
+    if args.pfpr_weighting == "population":
+        with recorder.stage("regrid"):
+            # The largest radius covers the boxes of every smaller one.
+            long_lats = city_long_lats(
+                peak_pixels(cities), lspop.dataset.GetGeoTransform())
+            regridded = regrid_pfpr(
+                lspop, pfpr, pfpr_region(long_lats, radii[-1], lspop),
+                args.regrid_factor,
+            )
+    tables = dict()
+    for radius in radii:
+        with recorder.stage(f"aggregate-r{radius / 1000:g}"):
+            tables[radius] = city_pop_pfpr(
+                cities, lspop, pfpr, radius, args.window_gap,
+                args.pfpr_weighting, regridded,
+            )
+
+    rows = list()
+    with recorder.stage("sweep"):
+        for parameters, graph in sweep_flow_graphs(tables, grid, args.distance):
+            graph, hierarchy = split_disconnected_graph(
+                graph, args.largest_component, args.partition, args.workers)
+            output_file = args.output_dir / output_name(parameters)
+            if output_file.exists():
+                output_file.unlink()
+            save_pandas(graph, hierarchy, output_file,
+                        args.largest_component, args.partition)
+            row = summarize(parameters, graph, hierarchy)
+            row["file"] = output_file.name
+            rows.append(row)
+
+    summary_path = args.output_dir / "summary.csv"
+    with summary_path.open("w") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    LOGGER.info(f"Wrote {summary_path}")
+    recorder.write(Path("record.jsonl"), "citysweep", dict(
+        peaks=args.peaks, radius=args.radius, cutoff=args.cutoff,
+        exponent=args.exponent, distance=args.distance,
+        pfpr_weighting=args.pfpr_weighting,
+    ))
+
+
+if __name__ == "__main__":
+    entry()
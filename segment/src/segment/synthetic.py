@@ -0,0 +1,153 @@
+"""
+Synthetic LandScan-like population and MAP-like PfPR rasters, for
+tests and benchmarks that shouldn't need the real data.
+
+Population is a sparse rural background plus cities, whose sizes follow a
+Pareto distribution and whose centers cluster into regions, with a strip of
+nodata ocean along the west edge. PfPR is a smooth field on a coarser grid,
+five population pixels to one PfPR pixel, like the 1 km and 5 km originals.
+"""
+import logging
+
+import numpy as np
+from osgeo import gdal, osr
+
+LOGGER = logging.getLogger(__name__)
+LSPOP_NODATA = -2147483647
+PFPR_NODATA = -9999.0
+PIXEL_DEGREES = 1 / 120
+"""LandScan pixels are 30 arc-seconds."""
+PFPR_FACTOR = 5
+"""Population pixels across one PfPR pixel."""
+ORIGIN = (30.0, 4.0)
+"""Longitude and latitude of the upper-left corner, near Uganda."""
+
+
+def synthetic_population(x_size, y_size, city_cnt, seed=0):
+    """
+    Clustered population counts.
+
+    Args:
+        x_size (int): Columns.
+        y_size (int): Rows.
+        city_cnt (int): Number of cities to place.
+        seed (int): Seed for the random state.
+
+    Returns:
+        np.array: Int32 with shape (y_size, x_size), as GDAL writes it,
+        where ocean is :data:`LSPOP_NODATA`.
+    """
+    rng = np.random.RandomState(seed)
+    rural = rng.gamma(0.3, 3.0, size=(y_size, x_size))
+    population = rng.poisson(rural).astype(np.float64)
+
+    region_cnt = max(1, city_cnt // 20)
+    regions = rng.uniform((0, 0), (x_size, y_size), size=(region_cnt, 2))
+    spread = 0.08 * min(x_size, y_size)
+    centers = (regions[rng.randint(region_cnt, size=city_cnt)]
+               + rng.normal(scale=spread, size=(city_cnt, 2)))
+    peak_density = 200 * (rng.pareto(1.2, size=city_cnt) + 1)
+    for (cx, cy), density in zip(centers.tolist(), peak_density.tolist()):
+        sigma = min(30.0, 1 + np.sqrt(density) / 20)
+        reach = int(4 * sigma) + 1
+        x0, x1 = max(0, int(cx) - reach), min(x_size, int(cx) + reach + 1)
+        y0, y1 = max(0, int(cy) - reach), min(y_size, int(cy) + reach + 1)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        dy, dx = np.ogrid[y0 - cy:y1 - cy, x0 - cx:x1 - cx]
+        population[y0:y1, x0:x1] += density * np.exp(
+            -(dx**2 + dy**2) / (2 * sigma**2))
+
+    counts = np.minimum(population, 2**31 - 2).astype(np.int32)
+    counts[:, :max(1, x_size // 16)] = LSPOP_NODATA
+    return counts
+
+
+def synthetic_pfpr(x_size, y_size, seed=0):
+    """
+    Smooth prevalence between 0 and about 0.6.
+
+    Args:
+        x_size (int): Columns of the PfPR grid.
+        y_size (int): Rows of the PfPR grid.
+        seed (int): Seed for the random state.
+
+    Returns:
+        np.array: Float64 with shape (y_size, x_size), where ocean is
+        :data:`PFPR_NODATA`.
+    """
+    rng = np.random.RandomState(seed + 1)
+    y, x = np.mgrid[0:y_size, 0:x_size]
+    pfpr = np.zeros((y_size, x_size), dtype=np.float64)
+    for _ in range(8):
+        cx, cy = rng.uniform(0, x_size), rng.uniform(0, y_size)
+        width = rng.uniform(0.1, 0.4) * max(x_size, y_size)
+        pfpr += rng.uniform(0.1, 0.4) * np.exp(
+            -((x - cx)**2 + (y - cy)**2) / (2 * width**2))
+    pfpr = np.clip(pfpr, 0, 0.6)
+    ocean = max(1, (x_size * PFPR_FACTOR) // 16) // PFPR_FACTOR
+    pfpr[:, :ocean] = PFPR_NODATA
+    return pfpr
+
+
+def write_geotiff(path, values, geo_transform, nodata):
+    """
+    Write a tiled, compressed, single-band WGS84 GeoTIFF with statistics.
+
+    Args:
+        path (Path): File to write.
+        values (np.array): Int32 or Float64, with shape (y, x).
+        geo_transform (tuple): GDAL geotransform.
+        nodata (float): Nodata value.
+    """
+    gdal_type = {
+        np.dtype(np.int32): gdal.GDT_Int32,
+        np.dtype(np.float64): gdal.GDT_Float64,
+    }[values.dtype]
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(
+        str(path), values.shape[1], values.shape[0], 1, gdal_type,
+        options=["TILED=YES", "COMPRESS=DEFLATE"],
+    )
+    dataset.SetGeoTransform(geo_transform)
+    spatial_ref = osr.SpatialReference()
+    spatial_ref.ImportFromEPSG(4326)
+    dataset.SetProjection(spatial_ref.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(values)
+    band.ComputeStatistics(False)
+    dataset.FlushCache()
+    dataset = None
+
+
+def write_synthetic_rasters(directory, x_size, y_size, city_cnt, seed=0):
+    """
+    Write a population GeoTIFF and a PfPR GeoTIFF that covers it.
+
+    Args:
+        directory (Path): Where to write ``lspop.tif`` and ``pfpr.tif``.
+        x_size (int): Population columns.
+        y_size (int): Population rows.
+        city_cnt (int): Number of cities.
+        seed (int): Seed for the random state.
+
+    Returns:
+        (Path, Path): Population and PfPR files.
+    """
+    long0, lat0 = ORIGIN
+    lspop_path = directory / "lspop.tif"
+    write_geotiff(
+        lspop_path, synthetic_population(x_size, y_size, city_cnt, seed),
+        (long0, PIXEL_DEGREES, 0, lat0, 0, -PIXEL_DEGREES), LSPOP_NODATA,
+    )
+    pfpr_size = (-(-x_size // PFPR_FACTOR), -(-y_size // PFPR_FACTOR))
+    pfpr_degrees = PIXEL_DEGREES * PFPR_FACTOR
+    pfpr_path = directory / "pfpr.tif"
+    write_geotiff(
+        pfpr_path, synthetic_pfpr(pfpr_size[0], pfpr_size[1], seed),
+        (long0, pfpr_degrees, 0, lat0, 0, -pfpr_degrees), PFPR_NODATA,
+    )
+    LOGGER.info(f"Wrote synthetic rasters x={x_size} y={y_size} "
+                f"with {city_cnt} cities to {directory}")
+    return lspop_path, pfpr_path
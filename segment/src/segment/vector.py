@@ -1,10 +1,21 @@
 import logging
 import shutil
 
-import networkx as nx
+import numpy as np
 from osgeo import gdal, ogr, osr
 
+from .communities import group_levels
+from .flow_graph import as_flow_graph
+
 LOGGER = logging.getLogger(__name__)
+VECTOR_FORMATS = {
+    "shapefile": "ESRI Shapefile",
+    "gpkg": "GPKG",
+    "flatgeobuf": "FlatGeobuf",
+}
+"""Command-line names of the OGR drivers that can hold the output."""
+TRANSACTION_SIZE = 100_000
+"""Features written between commits."""
 
 
 def create_wgs84_spatial_reference():
@@ -13,38 +24,97 @@ def create_wgs84_spatial_reference():
     return spatial_ref
 
 
-def write_points_file(graph, hierarchy, out_path):
+def _create_layer(dataset, name, geometry_type, fields):
+    layer = dataset.CreateLayer(
+        name, create_wgs84_spatial_reference(), geometry_type)
+    if layer is None:
+        raise RuntimeError(f"Could not create layer {name}")
+    for field_name, field_type in fields:
+        layer.CreateField(ogr.FieldDefn(field_name, field_type))
+    return layer
+
+
+def _write_features(layer, rows, make_geometry):
+    """
+    Write one feature per row, committing every :data:`TRANSACTION_SIZE`
+    features. Each row is the field values in layer order, then the
+    coordinates that ``make_geometry`` turns into a geometry.
+    """
+    definition = layer.GetLayerDefn()
+    feature = ogr.Feature(definition)
+    layer.StartTransaction()
+    for row_idx, row in enumerate(rows):
+        if row_idx and row_idx % TRANSACTION_SIZE == 0:
+            layer.CommitTransaction()
+            layer.StartTransaction()
+        for field_idx, value in enumerate(row[:-1]):
+            feature.SetField(field_idx, value)
+        feature.SetGeometry(make_geometry(row[-1]))
+        feature.SetFID(-1)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+
+
+def _point(coordinates):
+    point = ogr.Geometry(ogr.wkbPoint)
+    point.SetPoint_2D(0, *coordinates)
+    return point
+
+
+def _line(coordinates):
+    line = ogr.Geometry(ogr.wkbLineString)
+    line.AddPoint_2D(coordinates[0], coordinates[1])
+    line.AddPoint_2D(coordinates[2], coordinates[3])
+    return line
+
+
+def write_points_file(graph, hierarchy, out_path, driver_name="ESRI Shapefile",
+                      flows=True):
+    """
+    Write cities as points with their group and its level, and flows
+    between cities as lines with their capacity.
+
+    Args:
+        graph (FlowGraph|nx.Graph): Groups set by splitting.
+        hierarchy (nx.DiGraph): Edges from child group to parent group.
+        out_path (Path): File or directory to write. It is replaced.
+        driver_name (str): An OGR driver, one of :data:`VECTOR_FORMATS`.
+            Shapefile and FlatGeobuf write a directory with a file per layer.
+        flows (bool): Whether to add the ``flows`` layer.
+    """
+    graph = as_flow_graph(graph)
     if out_path.exists():
         LOGGER.info(f"Deleting {out_path} to write another.")
-        shutil.rmtree(out_path)
-    driver_name = "ESRI Shapefile"
+        if out_path.is_dir():
+            shutil.rmtree(out_path)
+        else:
+            out_path.unlink()
     driver = gdal.GetDriverByName(driver_name)
     dataset = driver.Create(
         str(out_path), 0, 0, 0, gdal.GDT_Unknown
     )
-    layer = dataset.CreateLayer("cities", None, ogr.wkbPoint)
-    if layer is None:
-        raise RuntimeError(f"Could not create layer")
-
-    group_defn = ogr.FieldDefn("group", ogr.OFTInteger)
-    group_defn.SetWidth(1)
-    layer.CreateField(group_defn)
-
-    group_defn = ogr.FieldDefn("level", ogr.OFTInteger)
-    group_defn.SetWidth(1)
-    field = layer.CreateField(group_defn)
-
-    for city in graph.nodes:
-        group = graph.nodes[city]["group"]
-        feature = ogr.Feature(layer.GetLayerDefn())
-        feature.SetField("group", group)
-        feature.SetField("level", len(nx.ancestors(hierarchy, group)))
-
-        x, y = graph.nodes[city]["longlat"]
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.SetPoint_2D(0, x, y)  # set the first point of the point.
-        feature.SetGeometry(point)
-        layer.CreateFeature(feature)
-        feature.Destroy()
 
+    levels = group_levels(hierarchy)
+    groups, group_index = np.unique(graph.group, return_inverse=True)
+    level = np.array([levels.get(g, 0) for g in groups.tolist()], dtype=np.int64)
+    cities = _create_layer(
+        dataset, "cities", ogr.wkbPoint,
+        [("group", ogr.OFTInteger), ("level", ogr.OFTInteger)],
+    )
+    _write_features(
+        cities,
+        zip(graph.group.tolist(), level[group_index].tolist(),
+            graph.longlat.tolist()),
+        _point,
+    )
+    LOGGER.info(f"Wrote {len(graph)} cities to {out_path}")
+
+    if flows:
+        first, second, capacity = graph.edges()
+        ends = np.hstack([graph.longlat[first], graph.longlat[second]])
+        flow_layer = _create_layer(
+            dataset, "flows", ogr.wkbLineString, [("capacity", ogr.OFTReal)])
+        _write_features(
+            flow_layer, zip(capacity.tolist(), ends.tolist()), _line)
+        LOGGER.info(f"Wrote {len(capacity)} flows to {out_path}")
     dataset = None
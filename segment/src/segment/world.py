@@ -0,0 +1,410 @@
+"""
+Runs peaks, populations, flows and splitting over the whole world,
+or any box too large for citypeaks and citysplit, one tile at a time.
+
+The box is cut into tiles of ``--tile-degrees``. Each tile finds its own
+peaks, reading a halo of the peak radius, and aggregates population and
+pfpr around them. Flows for a tile come from its cities and the cities
+of every tile within the gravity cutoff of it. Each edge is kept by the
+tile that owns its end with the smaller key, so edges that cross tile
+borders are written exactly once. Cities are keyed by their pixel in the
+population raster, ``y * x_size + x``, so keys agree across tiles.
+
+Flows don't cross the antimeridian, where there are few cities.
+
+Every tile's result is a file in the work directory, written whole or
+not at all, so a run that stops picks up at the next unfinished tile.
+Memory holds one tile per worker until the last two stages, which
+stitch the tiles into ``graph.h5`` a tile at a time and then split that
+graph into ``segmented.h5``.
+"""
+import json
+import logging
+import os
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from inspect import getmodule
+from pathlib import Path
+from secrets import token_hex
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+
+from .city_find import largest_within_distance, tile_boxes
+from .communities import (
+    HDF_COMPRESSION, load_flow_graph, save_pandas, split_disconnected_graph,
+)
+from .flux import (
+    candidate_pairs_from, city_pop_pfpr, pair_flux, GRAVITY_CUTOFF,
+    GRAVITY_EXPONENT,
+)
+from .input_data import load_cities, load_lspop, load_pfpr, PEAK_DTYPE
+from .instrument import add_counts, run_counted, StageRecorder
+from .partition import PARTITIONS
+from .raster_transform import (
+    LongLat, pixel_coord, pixel_corners_of_longlat_box, pixels_range_near_point,
+)
+from .split_cities import parser as split_parser
+
+LOGGER = logging.getLogger(__name__)
+TILE_DEGREES = 10
+HALO_MARGIN = 1.1
+"""Tiles search for neighbors this much farther than the cutoff."""
+PFPR_FLOOR = 1e-3
+"""Cities with less pfpr than this have no flows, as in calculate_flows."""
+
+
+def world_tiles(band, geo_transform, long_range, lat_range,
+                tile_degrees=TILE_DEGREES):
+    """
+    Cut a box of longitude and latitude into tiles of pixels.
+
+    Returns:
+        List[LongLat]: Pixel ranges of each tile, ordered by y and then x,
+        which cover the box, clipped to the raster, without overlap.
+    """
+    box = pixel_corners_of_longlat_box(
+        [LongLat(long_range[0], lat_range[0]),
+         LongLat(long_range[1], lat_range[1])],
+        geo_transform,
+    )
+    clipped = LongLat(
+        [max(0, box.long[0]), min(band.XSize, box.long[1])],
+        [max(0, box.lat[0]), min(band.YSize, box.lat[1])],
+    )
+    tile_pixels = max(1, int(round(tile_degrees / abs(geo_transform[1]))))
+    return tile_boxes(clipped, tile_pixels)
+
+
+def tile_name(tile):
+    return f"y{tile.lat[0]}-x{tile.long[0]}"
+
+
+def halo_box(tile, cutoff, geo_transform):
+    """
+    Pixels that hold every point within the cutoff of the tile, found
+    from the circle around each corner, since a circle is widest in
+    longitude on the side toward the pole.
+    """
+    corners = [pixel_coord((x, y), geo_transform)
+               for x in tile.long for y in tile.lat]
+    boxes = [pixels_range_near_point(corner, HALO_MARGIN * cutoff, geo_transform)
+             for corner in corners]
+    return LongLat(
+        [min(tile.long[0], *[b.long[0] for b in boxes]),
+         max(tile.long[1], *[b.long[1] for b in boxes])],
+        [min(tile.lat[0], *[b.lat[0] for b in boxes]),
+         max(tile.lat[1], *[b.lat[1] for b in boxes])],
+    )
+
+
+def neighbor_tiles(tiles, cutoff, geo_transform):
+    """For each tile, the indices of tiles that overlap its halo, itself first."""
+    x0, x1, y0, y1 = np.array(
+        [[t.long[0], t.long[1], t.lat[0], t.lat[1]] for t in tiles]).T
+    neighbors = list()
+    for tile_idx, tile in enumerate(tiles):
+        halo = halo_box(tile, cutoff, geo_transform)
+        overlaps = ((x0 < halo.long[1]) & (halo.long[0] < x1)
+                    & (y0 < halo.lat[1]) & (halo.lat[0] < y1))
+        overlaps[tile_idx] = False
+        neighbors.append([tile_idx] + np.flatnonzero(overlaps).tolist())
+    return neighbors
+
+
+def _save_arrays(path, **arrays):
+    """Write an .npz so that the file appears only when it is complete."""
+    partial = path.with_name(f"{path.name}.{token_hex(4)}.partial")
+    with partial.open("wb") as out:
+        np.savez(out, **arrays)
+    partial.replace(path)
+
+
+def tile_peaks(task):
+    """Runs in a worker process. Writes a tile's peaks as records."""
+    lspop_path, tile, peak_radius, out_path = task
+    gdal.AllRegister()
+    lspop = load_lspop(lspop_path)
+    peaks = largest_within_distance(lspop.band, peak_radius, tile, progress=False)
+    partial = out_path.with_name(f"{out_path.name}.{token_hex(4)}.partial")
+    with partial.open("wb") as out:
+        np.lib.format.write_array(
+            out, np.array([tuple(p) for p in peaks], dtype=PEAK_DTYPE),
+            allow_pickle=False,
+        )
+    partial.replace(out_path)
+    return len(peaks)
+
+
+def tile_table(task):
+    """
+    Runs in a worker process. Writes the keys of a tile's cities and
+    their table of population, pfpr, longitude and latitude.
+    """
+    lspop_path, pfpr_path, peaks_path, radius, window_gap, out_path = task
+    gdal.AllRegister()
+    cities = load_cities(peaks_path)
+    lspop = load_lspop(lspop_path)
+    if len(cities) > 0:
+        pop_pfpr = city_pop_pfpr(
+            cities, lspop, load_pfpr(pfpr_path), radius, window_gap)
+    else:
+        pop_pfpr = np.zeros((0, 4), dtype=np.float64)
+    keys = (cities["y"].astype(np.int64) * lspop.band.XSize
+            + cities["x"].astype(np.int64))
+    _save_arrays(out_path, keys=keys, pop_pfpr=pop_pfpr)
+    return len(keys)
+
+
+def tile_edges(task):
+    """
+    Runs in a worker process. Writes flows from a tile's cities that
+    this tile owns, as pairs of city keys with their capacity.
+
+    Args:
+        task (tuple): Table files, this tile's first, then the cutoff,
+            exponent, distance method, and file to write.
+    """
+    table_paths, cutoff, exponent, distance_method, out_path = task
+    keys, tables, owned = list(), list(), list()
+    for table_idx, table_path in enumerate(table_paths):
+        with np.load(str(table_path)) as table:
+            keys.append(table["keys"])
+            tables.append(table["pop_pfpr"])
+            owned.append(np.full(len(table["keys"]), table_idx == 0))
+    keys, pop_pfpr, owned = [np.concatenate(a) for a in (keys, tables, owned)]
+    has_pfpr = pop_pfpr[:, 1] > PFPR_FLOOR
+    keys, pop_pfpr, owned = keys[has_pfpr], pop_pfpr[has_pfpr], owned[has_pfpr]
+    if not owned.any():
+        empty = np.zeros(0, dtype=np.int64)
+        _save_arrays(out_path, first=empty, second=empty,
+                     capacity=np.zeros(0, dtype=np.float64))
+        return 0
+    # Search only around owned cities. A pair belongs to the tile that
+    # owns its end with the smaller key.
+    first, second, r = candidate_pairs_from(
+        pop_pfpr[:, 2:4], np.flatnonzero(owned), cutoff, distance_method, keys)
+    flux = pair_flux(pop_pfpr, first, second, r, cutoff, exponent)
+    positive = flux > 0
+    _save_arrays(out_path, first=keys[first[positive]],
+                 second=keys[second[positive]], capacity=flux[positive])
+    return int(positive.sum())
+
+
+def stitch(table_paths, edge_paths, out_path):
+    """
+    Append every tile's cities and edges to one HDF5 file in the format
+    of :func:`segment.communities.save_pandas`, one tile at a time.
+    Cities without pfpr are left out, as they have no flows.
+    """
+    partial = out_path.with_name(f"{out_path.name}.{token_hex(4)}.partial")
+    with pd.HDFStore(str(partial), mode="w", **HDF_COMPRESSION) as store:
+        for table_path, edge_path in zip(table_paths, edge_paths):
+            with np.load(str(table_path)) as table:
+                keys, pop_pfpr = table["keys"], table["pop_pfpr"]
+            kept = pop_pfpr[:, 1] > PFPR_FLOOR
+            if kept.any():
+                store.append("nodes", pd.DataFrame(
+                    dict(long=pop_pfpr[kept, 2], lat=pop_pfpr[kept, 3],
+                         group=np.zeros(kept.sum(), dtype=np.int64),
+                         level=np.zeros(kept.sum(), dtype=np.int64),
+                         pop=pop_pfpr[kept, 0], pfpr=pop_pfpr[kept, 1]),
+                    index=pd.Index(keys[kept], name="node"),
+                ), data_columns=["group"], index=False)
+            with np.load(str(edge_path)) as edges:
+                if len(edges["first"]) == 0:
+                    continue
+                zeros = np.zeros(len(edges["first"]), dtype=np.int64)
+                store.append("edges", pd.DataFrame(dict(
+                    first=edges["first"], second=edges["second"],
+                    capacity=edges["capacity"],
+                    first_group=zeros, second_group=zeros,
+                )), data_columns=["first_group", "second_group"], index=False)
+        # Indexing once is much faster than updating it with every tile.
+        if "nodes" in store:
+            store.create_table_index("nodes", columns=["group"])
+        if "edges" in store:
+            store.create_table_index(
+                "edges", columns=["first_group", "second_group"])
+    partial.replace(out_path)
+
+
+def _run_tiles(function, tasks, workers):
+    """Call a tile function on each task, in a pool if there are workers."""
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            counted = pool.map(run_counted, [function] * len(tasks), tasks)
+            return list(map(add_counts, counted))
+    return [function(task) for task in tasks]
+
+
+def check_parameters(work_dir, parameters):
+    """
+    Remember the parameters of a run in its work directory, and refuse
+    to resume a run with different ones, which would mix tiles.
+    """
+    parameters_file = work_dir / "parameters.json"
+    described = json.loads(json.dumps(parameters, default=str))
+    if parameters_file.exists():
+        previous = json.loads(parameters_file.read_text())
+        if previous != described:
+            raise RuntimeError(
+                f"{work_dir} holds a run with parameters {previous}, "
+                f"not {described}. Use another work directory.")
+    else:
+        parameters_file.write_text(json.dumps(described, indent=1))
+
+
+def run_world(args, recorder):
+    """
+    Run every stage, skipping tiles whose files already exist.
+
+    Returns:
+        List[LongLat]: The tiles.
+    """
+    lspop = load_lspop(args.lspop)
+    geo_transform = lspop.dataset.GetGeoTransform()
+    tiles = world_tiles(lspop.band, geo_transform, args.long, args.lat,
+                        args.tile_degrees)
+    radius = args.city_radius * 1000
+    work = args.work_dir
+    LOGGER.info(f"{len(tiles)} tiles in {work}")
+    for subdirectory in ["peaks", "tables", "edges"]:
+        (work / subdirectory).mkdir(parents=True, exist_ok=True)
+    names = [tile_name(tile) for tile in tiles]
+    peak_paths = [work / "peaks" / f"{name}.npy" for name in names]
+    table_paths = [work / "tables" / f"{name}.npz" for name in names]
+    edge_paths = [work / "edges" / f"{name}.npz" for name in names]
+
+    with recorder.stage("peaks") as counts:
+        tasks = [(args.lspop, tile, args.peak_radius, path)
+                 for (tile, path) in zip(tiles, peak_paths) if not path.exists()]
+        counts["tiles"] = len(tasks)
+        counts["peaks"] = sum(_run_tiles(tile_peaks, tasks, args.workers))
+
+    with recorder.stage("aggregate") as counts:
+        tasks = [(args.lspop, args.pfpr, peaks_path, radius, args.window_gap,
+                  path)
+                 for (peaks_path, path) in zip(peak_paths, table_paths)
+                 if not path.exists()]
+        counts["tiles"] = len(tasks)
+        counts["cities"] = sum(_run_tiles(tile_table, tasks, args.workers))
+
+    with recorder.stage("flows") as counts:
+        neighbors = neighbor_tiles(tiles, GRAVITY_CUTOFF, geo_transform)
+        tasks = [([table_paths[n] for n in near], GRAVITY_CUTOFF,
+                  GRAVITY_EXPONENT, args.distance, path)
+                 for (near, path) in zip(neighbors, edge_paths)
+                 if not path.exists()]
+        counts["tiles"] = len(tasks)
+        counts["edges"] = sum(_run_tiles(tile_edges, tasks, args.workers))
+
+    graph_path = work / "graph.h5"
+    with recorder.stage("stitch"):
+        if not graph_path.exists():
+            stitch(table_paths, edge_paths, graph_path)
+
+    with recorder.stage("split") as counts:
+        if not args.segmented.exists():
+            graph, hierarchy = split_disconnected_graph(
+                load_flow_graph(graph_path), args.largest_component,
+                args.partition, args.workers,
+            )
+            counts["groups"] = len(hierarchy)
+            partial = args.segmented.with_name(
+                f"{args.segmented.name}.{token_hex(4)}.partial")
+            save_pandas(graph, hierarchy, partial,
+                        args.largest_component, args.partition)
+            partial.replace(args.segmented)
+    return tiles
+
+
+def parser():
+    defaults = split_parser().parse_args([])
+    parse_obj = ArgumentParser(
+        description=getmodule(parser).__doc__,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parse_obj.add_argument("--lspop", type=Path, default=defaults.lspop,
+                           help=("Path to directory containing LandSat "
+                                 "population raster"))
+    parse_obj.add_argument("--pfpr", type=Path, default=defaults.pfpr,
+                           help="Path to PfPR data from MAP project.")
+    parse_obj.add_argument("--work-dir", type=Path, default="world",
+                           help=("Directory for each tile's files. Run again "
+                                 "with the same directory to resume."))
+    parse_obj.add_argument("--segmented", type=Path, default=None,
+                           help=("Path to output file. Defaults to "
+                                 "segmented.h5 in the work directory."))
+    parse_obj.add_argument("--long", type=float, nargs=2, default=[-180, 180],
+                           help="Min and max longitude")
+    parse_obj.add_argument("--lat", type=float, nargs=2, default=[-90, 90],
+                           help="Min and max latitude")
+    parse_obj.add_argument("--tile-degrees", type=float, default=TILE_DEGREES,
+                           help="Width and height of a tile in degrees")
+    parse_obj.add_argument("--peak-radius", type=float, default=20,
+                           help=("How many LandSat pixels around a peak must "
+                                 "be less than that peak"))
+    parse_obj.add_argument("--city-radius", type=float,
+                           default=defaults.peak_radius,
+                           help="Distance in km to gather population")
+    parse_obj.add_argument("--largest-component", type=int,
+                           default=defaults.largest_component,
+                           help=("The largest number of cities that could "
+                                 "be together in a single component."))
+    parse_obj.add_argument("--window-gap", type=float, default=1.0,
+                           help=("Degrees between clusters of cities beyond "
+                                 "which each cluster reads its own window."))
+    parse_obj.add_argument("--distance", choices=["exact", "fast"],
+                           default="exact",
+                           help="Distance method between cities")
+    parse_obj.add_argument("--partition", choices=sorted(PARTITIONS.keys()),
+                           default="min-cut",
+                           help="How to split large components")
+    parse_obj.add_argument("--workers", type=int, default=1,
+                           help="Number of processes, each with one tile")
+    parse_obj.add_argument("--gdal-cache", type=int, default=512,
+                           help="GDAL block cache in MB for each process")
+    parse_obj.add_argument("--verbose", "-v", action="count", help="verbose",
+                           default=0)
+    parse_obj.add_argument("--quiet", "-q", action="count", help="quiet",
+                           default=0)
+    return parse_obj
+
+
+def entry():
+    args = parser().parse_args()
+    logging_level = logging.INFO - 10 * args.verbose + 10 * args.quiet
+    logging.basicConfig(level=logging_level)
+    gdal.AllRegister()
+
+    for expand in ["lspop", "pfpr"]:
+        arg_path = getattr(args, expand).expanduser()
+        if not arg_path.exists():
+            LOGGER.error(f"Path to {expand} not found: {arg_path}")
+            exit(1)
+        setattr(args, expand, arg_path)
+    args.work_dir = args.work_dir.expanduser()
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    if args.segmented is None:
+        args.segmented = args.work_dir / "segmented.h5"
+    # Worker processes read this when GDAL starts.
+    os.environ["GDAL_CACHEMAX"] = str(args.gdal_cache)
+    gdal.SetCacheMax(args.gdal_cache * 2**20)
+    parameters = dict(
+        lspop=args.lspop, pfpr=args.pfpr, long=args.long, lat=args.lat,
+        tile_degrees=args.tile_degrees, peak_radius=args.peak_radius,
+        city_radius=args.city_radius, distance=args.distance,
+        largest_component=args.largest_component, partition=args.partition,
+    )
+    check_parameters(args.work_dir, parameters)
+
+    recorder = StageRecorder()
+    tiles = run_world(args, recorder)
+    recorder.write(Path("record.jsonl"), "cityglobal",
+                   dict(parameters, tiles=len(tiles), work_dir=args.work_dir))
+
+
+if __name__ == "__main__":
+    entry()
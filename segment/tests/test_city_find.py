@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from osgeo import gdal, osr
+
+from segment.city_find import (
+    largest_within_distance, disk_footprint, parallel_largest_within_distance,
+    tile_boxes, isolation_map, load_isolation, peaks_from_isolation,
+    save_isolation,
+)
+from segment.input_data import load_lspop
+from segment.raster_transform import LongLat
+
+
+def population_raster(x_size, y_size, seed=9234):
+    rng = np.random.RandomState(seed)
+    population = (1000 * rng.uniform(size=(y_size, x_size))**6).astype(np.int32)
+    population[rng.uniform(size=population.shape) < 0.3] = 0
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", x_size, y_size, 1, gdal.GDT_Int32)
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(population)
+    band.ComputeStatistics(False)
+    return dataset, band
+
+
+def test_disk_footprint_includes_edge():
+    footprint = disk_footprint(2)
+    assert footprint.shape == (5, 5)
+    assert footprint[2, 0] and footprint[0, 2]
+    assert not footprint[0, 0]
+
+
+@pytest.mark.parametrize("distance", [1, 3, 4.5])
+def test_array_engine_matches_reference(distance):
+    dataset, band = population_raster(37, 29)
+    box = LongLat([3, 30], [5, 27])
+    reference = largest_within_distance(band, distance, box, "reference")
+    array = largest_within_distance(band, distance, box, "array")
+    assert len(reference) > 0
+    assert array == reference
+
+
+def test_tile_boxes_cover_box():
+    box = LongLat([3, 30], [5, 27])
+    tiles = tile_boxes(box, 10)
+    assert len(tiles) == 9
+    assert sum((t.long[1] - t.long[0]) * (t.lat[1] - t.lat[0]) for t in tiles) == 27 * 22
+    assert tiles[-1] == LongLat([23, 30], [25, 27])
+
+
+def test_parallel_matches_serial(tmp_path):
+    dataset, band = population_raster(61, 45)
+    spatial_ref = osr.SpatialReference()
+    spatial_ref.SetWellKnownGeogCS("WGS84")
+    dataset.SetProjection(spatial_ref.ExportToWkt())
+    dataset.SetGeoTransform((30, 0.01, 0, 2, 0, -0.01))
+    raster_file = tmp_path / "population.tif"
+    gdal.GetDriverByName("GTiff").CreateCopy(str(raster_file), dataset)
+
+    box = LongLat([0, 61], [0, 45])
+    lspop = load_lspop(raster_file)
+    serial = largest_within_distance(lspop.band, 4, box)
+    parallel = parallel_largest_within_distance(raster_file, 4, box, 2, 16)
+    assert parallel == serial
+
+
+def test_isolation_map_thresholds_to_peaks(tmp_path):
+    dataset, band = population_raster(41, 33)
+    box = LongLat([4, 36], [3, 30])
+    isolation = isolation_map(band, 6, box, progress=False)
+    save_isolation(tmp_path / "isolation.npz", isolation)
+    loaded = load_isolation(tmp_path / "isolation.npz")
+    for distance in [1, 2.5, 6]:
+        direct = largest_within_distance(band, distance, box, progress=False)
+        from_map = peaks_from_isolation(loaded, distance)
+        assert [peak[1:] for peak in from_map] == [peak[1:] for peak in direct]
+    with pytest.raises(ValueError):
+        peaks_from_isolation(loaded, 7)
@@ -1,8 +1,14 @@
 import networkx as nx
+import numpy as np
 import pandas as pd
 import pytest
 
-from segment.communities import split_graph, save_pandas
+from segment.communities import (
+    split_graph, split_disconnected_graph, save_pandas, group_levels,
+    load_group, load_previous, load_segmented, load_split_parameters,
+)
+from segment.flow_graph import FlowGraph
+from segment.instrument import StageRecorder
 
 
 def test_happy_path():
@@ -27,16 +33,138 @@ def test_larger():
     print(nx.to_edgelist(hierarchy))
 
 
-@pytest.mark.skip("not working yet")
 def test_save(tmp_path):
     g = nx.barbell_graph(6, 1)
     for add_capacity in g.nodes:
         g.nodes[add_capacity]["capacity"] = 1
-    labeled, hierarchy = split_graph(g, 8)
+    labeled, hierarchy = split_disconnected_graph(g, 8)
+    filename = tmp_path / "example.h5"
+    save_pandas(labeled, hierarchy, filename)
+
+    flow_graph, h2 = load_segmented(filename)
+    g2 = flow_graph.to_networkx()
+    assert g2.nodes[3]["group"] == labeled.nodes[3]["group"]
+    assert sorted(g2.edges) == sorted(g.edges)
+    assert sorted(h2.edges) == sorted(hierarchy.edges)
+
+
+def test_save_replaces_file_and_needs_integer_keys(tmp_path):
     filename = tmp_path / "example.h5"
+    pd.DataFrame(dict(a=[1])).to_hdf(str(filename), key="graph")
+    labeled, hierarchy = split_disconnected_graph(nx.path_graph(4), 8)
     save_pandas(labeled, hierarchy, filename)
+    with pd.HDFStore(str(filename), mode="r") as store:
+        assert sorted(store.keys()) == ["/edges", "/hierarchy", "/nodes"]
+    grid, grid_hierarchy = split_disconnected_graph(nx.grid_2d_graph(3, 3), 8)
+    with pytest.raises(ValueError, match="integers"):
+        save_pandas(grid, grid_hierarchy, filename)
+
+
+def test_load_one_group(tmp_path):
+    g = nx.disjoint_union(nx.barbell_graph(6, 1), nx.path_graph(4))
+    labeled, hierarchy = split_disconnected_graph(g, 8)
+    filename = tmp_path / "example.h5"
+    save_pandas(labeled, hierarchy, filename)
+    small = labeled.nodes[13]["group"]
+    path = load_group(filename, small)
+    assert path.nodes.tolist() == [13, 14, 15, 16]
+    assert path.edge_cnt == 3
+    barbell = load_group(filename, 2)
+    assert barbell.nodes.tolist() == list(range(13))
+    assert barbell.edge_cnt == 32
+
+
+def test_load_group_with_many_subgroups(tmp_path):
+    g = nx.convert_node_labels_to_integers(nx.grid_2d_graph(8, 8))
+    for a, b in g.edges:
+        g.edges[a, b]["capacity"] = 1.0 + (a * b) % 3
+    graph, hierarchy = split_disconnected_graph(FlowGraph.from_networkx(g), 2)
+    filename = tmp_path / "grid.h5"
+    save_pandas(graph, hierarchy, filename)
+    # More subgroups than PyTables takes in an "in" condition.
+    assert len(nx.ancestors(hierarchy, 2)) > 31
+    # Some groups that were split, whose subgroups needn't be numbered
+    # right after them, and one that wasn't.
+    split = [group for group in hierarchy.nodes if hierarchy.in_degree(group)]
+    for group in split[::8] + [graph.group[0]]:
+        members = nx.ancestors(hierarchy, group) | {group}
+        inside = np.flatnonzero(np.isin(graph.group, list(members)))
+        loaded = load_group(filename, group)
+        assert loaded.nodes.tolist() == graph.nodes[inside].tolist()
+        assert loaded.edge_cnt == graph.sub_capacity(inside).nnz // 2
+
+
+def test_group_levels_count_groups_inside():
+    g = nx.DiGraph()
+    g.add_edges_from([(0, 1), (1, 2), (2, 3), (3, 4), (5, 3)])
+    assert group_levels(g) == {n: len(nx.ancestors(g, n)) for n in g}
+
+
+def test_spectral_splits_barbell():
+    g = nx.barbell_graph(6, 0)
+    labeled, hierarchy = split_disconnected_graph(g, 8, "spectral")
+    assert sorted(hierarchy.edges) == [(3, 2), (4, 2)]
+    groups = [labeled.nodes[n]["group"] for n in g]
+    assert groups == [3] * 6 + [4] * 6
+
+
+@pytest.mark.parametrize("partition", ["min-cut", "spectral"])
+def test_parallel_split_matches_serial(partition):
+    pieces = [nx.grid_2d_graph(6, 7), nx.barbell_graph(6, 1),
+              nx.path_graph(3), nx.empty_graph(2), nx.grid_2d_graph(4, 9)]
+    g = nx.convert_node_labels_to_integers(nx.disjoint_union_all(pieces))
+    recorder = StageRecorder()
+    with recorder.stage("serial") as serial_counts:
+        serial, serial_hierarchy = split_disconnected_graph(
+            g.copy(), 5, partition)
+    with recorder.stage("parallel") as parallel_counts:
+        parallel, parallel_hierarchy = split_disconnected_graph(
+            g.copy(), 5, partition, workers=2)
+    # Cuts made in worker processes are counted too.
+    assert parallel_counts["cuts"] == serial_counts["cuts"] > 0
+    assert sorted(serial_hierarchy.edges) == sorted(parallel_hierarchy.edges)
+    assert sorted(serial_hierarchy.nodes) == sorted(parallel_hierarchy.nodes)
+    for n in g:
+        assert serial.nodes[n]["group"] == parallel.nodes[n]["group"]
+
+
+def test_previous_split_reused_for_unchanged_components(tmp_path):
+    pieces = [nx.grid_2d_graph(6, 7), nx.barbell_graph(6, 1),
+              nx.path_graph(3), nx.grid_2d_graph(4, 9)]
+    g = nx.convert_node_labels_to_integers(nx.disjoint_union_all(pieces))
+    for a, b in g.edges:
+        g.edges[a, b]["capacity"] = 1.0 + (a * b) % 5
+    before, before_hierarchy = split_disconnected_graph(
+        FlowGraph.from_networkx(g), 5)
+    save_pandas(before, before_hierarchy, tmp_path / "before.h5", 5, "min-cut")
+    previous = load_previous(tmp_path / "before.h5", 5, "min-cut")
+
+    # Change flows in the barbell only.
+    g.edges[43, 44]["capacity"] = 0.01
+    recorder = StageRecorder()
+    with recorder.stage("split") as counts:
+        reused, reused_hierarchy = split_disconnected_graph(
+            FlowGraph.from_networkx(g), 5, previous=previous)
+    assert counts["reused_components"] == 2
+    assert counts["changed_components"] == 1
+    fresh, fresh_hierarchy = split_disconnected_graph(
+        FlowGraph.from_networkx(g), 5)
+    assert reused.group.tolist() == fresh.group.tolist()
+    assert sorted(reused_hierarchy.edges) == sorted(fresh_hierarchy.edges)
+    assert sorted(reused_hierarchy.nodes) == sorted(fresh_hierarchy.nodes)
+
 
-    g2 = nx.from_pandas_adjacency(pd.read_hdf(str(filename), key="graph"))
-    assert g2.nodes[3]["group"] in {2, 3}
-    h2 = nx.from_pandas_adjacency(pd.read_hdf(str(filename), key="belonging"))
-    assert len(h2) == 3
+def test_previous_split_needs_same_parameters(tmp_path):
+    g = nx.convert_node_labels_to_integers(nx.grid_2d_graph(6, 7))
+    for a, b in g.edges:
+        g.edges[a, b]["capacity"] = 1.0
+    graph, hierarchy = split_disconnected_graph(FlowGraph.from_networkx(g), 5)
+    save_pandas(graph, hierarchy, tmp_path / "split.h5", 5, "min-cut")
+    assert load_split_parameters(tmp_path / "split.h5") == (5, "min-cut")
+    with pytest.raises(ValueError):
+        load_previous(tmp_path / "split.h5", 6, "min-cut")
+    with pytest.raises(ValueError):
+        load_previous(tmp_path / "split.h5", 5, "spectral")
+    save_pandas(graph, hierarchy, tmp_path / "unknown.h5")
+    with pytest.raises(ValueError):
+        load_previous(tmp_path / "unknown.h5", 5, "min-cut")
@@ -1,8 +1,14 @@
+from hashlib import sha256
 from pathlib import Path
+from types import SimpleNamespace
 
+import numpy as np
 import pytest
 
 from segment import find_cities
+from segment.city_find import IsolationMap, save_isolation
+from segment.input_data import load_cities
+from segment.raster_transform import LongLat
 
 
 @pytest.mark.parametrize("arglist,result", [
@@ -14,3 +20,29 @@ def test_parser_happy(arglist, result):
     print(args)
     for k, v in result.items():
         assert getattr(args, k) == v
+
+
+@pytest.mark.parametrize("name", ["peaks.npy", "peaks.csv"])
+def test_write_peaks_hashes_while_writing(tmp_path, name):
+    peaks = [(2_000_000_000 * 4, 42, 307), (333, 1, 17)]
+    out_path = tmp_path / name
+    peaks_hash = find_cities.write_peaks(peaks, out_path)
+    assert peaks_hash == sha256(out_path.read_bytes()).hexdigest()
+    loaded = load_cities(out_path)
+    assert loaded["squared_distance"].tolist() == [8_000_000_000, 333]
+    assert loaded["x"].tolist() == [42, 1]
+    assert loaded["y"].tolist() == [307, 17]
+
+
+def test_isolation_map_must_match_raster(tmp_path):
+    map_path = tmp_path / "isolation.npz"
+    empty = np.zeros(0, dtype=np.int32)
+    save_isolation(map_path, IsolationMap(
+        empty, empty, empty.astype(np.int64), 5.0, 1.0,
+        LongLat([0, 10], [0, 10]), (10, 10)))
+    args = SimpleNamespace(isolation_map=map_path, peak_radius=3)
+    lspop = SimpleNamespace(band=SimpleNamespace(XSize=10, YSize=10))
+    assert find_cities.find_peaks(args, lspop, LongLat([0, 10], [0, 10])) == []
+    lspop.band.YSize = 12
+    with pytest.raises(ValueError, match="raster"):
+        find_cities.find_peaks(args, lspop, LongLat([0, 10], [0, 10]))
@@ -0,0 +1,41 @@
+import networkx as nx
+import numpy as np
+
+from segment.communities import split_disconnected_graph
+from segment.flow_graph import FlowGraph
+
+
+def two_triangles():
+    first = np.array([0, 1, 0, 3, 4, 3])
+    second = np.array([1, 2, 2, 4, 5, 5])
+    capacity = np.arange(1, 7, dtype=np.float64)
+    longlat = np.arange(12, dtype=np.float64).reshape(6, 2)
+    return FlowGraph.from_edges(6, first, second, capacity, longlat)
+
+
+def test_components_are_index_arrays():
+    graph = two_triangles()
+    components = graph.components()
+    assert [c.tolist() for c in components] == [[0, 1, 2], [3, 4, 5]]
+    sub = graph.components(np.array([0, 1, 3, 4]))
+    assert [c.tolist() for c in sub] == [[0, 1], [3, 4]]
+
+
+def test_networkx_round_trip():
+    graph = two_triangles()
+    graph.group[:] = [2, 2, 2, 3, 3, 3]
+    as_nx = graph.to_networkx()
+    assert as_nx.edges[3, 5]["capacity"] == 6
+    assert as_nx.nodes[4]["longlat"] == [8, 9]
+    back = FlowGraph.from_networkx(as_nx)
+    assert (back.capacity != graph.capacity).nnz == 0
+    assert back.group.tolist() == graph.group.tolist()
+
+
+def test_split_matches_for_networkx():
+    g = nx.barbell_graph(6, 1)
+    labeled, hierarchy = split_disconnected_graph(g, 8)
+    flow_graph, flow_hierarchy = split_disconnected_graph(
+        FlowGraph.from_networkx(nx.barbell_graph(6, 1)), 8)
+    assert sorted(hierarchy.edges) == sorted(flow_hierarchy.edges)
+    assert [labeled.nodes[n]["group"] for n in g] == flow_graph.group.tolist()
@@ -1,6 +1,12 @@
 import numpy as np
 
-from segment.flux import calculate_gravity_constant, sum_within_box
+from segment.flux import (
+    calculate_gravity_constant, sum_within_box, average_within_box,
+    pop_within_boxes, pfpr_within_boxes, window_clusters, calculate_flows,
+    pop_and_pfpr_within_boxes, Regridded, regridded_window, candidate_pairs,
+    candidate_pairs_from,
+)
+from segment.raster_transform import distance, WGS84
 
 
 def test_calculate_gravity_constant_happy():
@@ -12,6 +18,131 @@ def test_calculate_gravity_constant_happy():
 
 def test_sum_within_box_out_of_bounds():
     """Sum ignores values outside bounds."""
-    a = np.array([[0, 1, 3], [-99999, 2, -99999]], dtype=np.float)
+    a = np.array([[0, 1, 3], [-99999, 2, -99999]], dtype=np.float64)
     total = sum_within_box(a, [[0, 4], [0, 4]])
     assert total == 6
+
+
+def test_boxes_match_single_box():
+    rng = np.random.RandomState(2349)
+    pop = rng.randint(-5, 10, size=(20, 15)).astype(np.int32)
+    pfpr = rng.uniform(size=(20, 15))
+    pfpr[rng.uniform(size=pfpr.shape) < 0.3] = -9999
+    bounds = rng.randint(-25, 25, size=(100, 2, 2))
+    bounds[:, :, 1] = np.abs(bounds[:, :, 1])
+    bounds[0] = [[3, 3], [0, 4]]  # Empty box
+    sums = pop_within_boxes(pop, bounds)
+    means = pfpr_within_boxes(pfpr, bounds)
+    assert np.isnan(means[0])
+    for idx in range(1, len(bounds)):
+        assert sums[idx] == sum_within_box(pop, bounds[idx])
+        expected = pfpr[bounds[idx, 0, 0]:bounds[idx, 0, 1],
+                        bounds[idx, 1, 0]:bounds[idx, 1, 1]]
+        if (expected >= 0).any():
+            assert np.isclose(means[idx], average_within_box(pfpr, bounds[idx]))
+        else:
+            assert np.isnan(means[idx])
+
+
+def test_population_weighted_pfpr_matches_single_box():
+    rng = np.random.RandomState(8761)
+    pop = rng.randint(-5, 10, size=(20, 15)).astype(np.int32)
+    pfpr = rng.uniform(size=(20, 15))
+    pfpr[rng.uniform(size=pfpr.shape) < 0.3] = np.nan
+    bounds = rng.randint(0, 20, size=(100, 2, 2))
+    bounds[:, :, 1] = bounds[:, :, 0] + rng.randint(1, 6, size=(100, 2))
+    found = pop_and_pfpr_within_boxes(pop, pfpr, bounds)
+    assert (found[:, 0] == pop_within_boxes(pop, bounds)).all()
+    for idx, ((x0, x1), (y0, y1)) in enumerate(bounds):
+        weight = np.clip(pop[x0:x1, y0:y1], 0, None)
+        value = pfpr[x0:x1, y0:y1]
+        valid = np.isfinite(value)
+        if weight[valid].sum() > 0:
+            expected = (weight * value)[valid].sum() / weight[valid].sum()
+            assert np.isclose(found[idx, 1], expected)
+        elif valid.any():
+            assert np.isclose(found[idx, 1], value[valid].mean())
+        else:
+            assert np.isnan(found[idx, 1])
+
+
+def test_regridded_window_repeats_cells():
+    values = np.arange(12, dtype=np.float64).reshape(4, 3)
+    regridded = Regridded(values, (10, 22), (3, 12), 3)
+    window = regridded_window(regridded, (14, 17), (4, 6))
+    assert window.shape == (3, 2)
+    assert (window[:, 0] == [values[1, 0], values[1, 0], values[2, 0]]).all()
+    assert (window[0] == values[1, 0]).all()
+
+
+def test_window_clusters_separates_far_boxes():
+    bounds = np.array([
+        [[0, 2], [0, 2]],
+        [[3, 5], [0, 2]],
+        [[100, 102], [100, 102]],
+    ])
+    clusters = window_clusters(bounds, 1)
+    assert sorted(sorted(c.tolist()) for c in clusters) == [[0, 1], [2]]
+    assert len(window_clusters(bounds, None)) == 1
+
+
+def test_calculate_flows_pairs_within_cutoff():
+    rng = np.random.RandomState(4123)
+    city_cnt = 60
+    pop_pfpr = np.stack([
+        rng.randint(1, 1000, size=city_cnt).astype(np.float64),
+        rng.uniform(size=city_cnt),
+        rng.uniform(30, 33, size=city_cnt),
+        rng.uniform(0, 3, size=city_cnt),
+    ], axis=1)
+    pop_pfpr[0, 1] = 0  # Dropped for having no pfpr.
+    cutoff = 100_000
+    cities = calculate_flows(pop_pfpr, cutoff, 1.0)
+    kept = pop_pfpr[pop_pfpr[:, 1] > 1e-3]
+    assert len(cities) == len(kept)
+    assert np.allclose(cities.longlat, kept[:, 2:4])
+    assert cities.nodes.tolist() == list(range(1, city_cnt))
+    for a in range(len(kept)):
+        for b in range(a + 1, len(kept)):
+            within = distance(kept[a, 2:4], kept[b, 2:4]) < cutoff
+            assert (cities.capacity[a, b] > 0) == within
+            assert cities.capacity[a, b] == cities.capacity[b, a]
+
+
+def test_exact_pairs_match_geographiclib_at_cutoff():
+    rng = np.random.RandomState(9027)
+    cutoff = 100_000
+    long_lat = [np.stack([rng.uniform(30, 33, size=40),
+                          rng.uniform(-60, 60, size=40)], axis=1)]
+    # Partners a centimeter either side of the cutoff.
+    for offset in [-0.01, 0.01]:
+        for long, lat in long_lat[0][:10].tolist():
+            far = WGS84.Direct(lat, long, rng.uniform(0, 360), cutoff + offset)
+            long_lat.append(np.array([[far["lon2"], far["lat2"]]]))
+    long_lat = np.concatenate(long_lat)
+    first, second, r = candidate_pairs(long_lat, cutoff, "exact")
+    expected = [(a, b) for a in range(len(long_lat))
+                for b in range(a + 1, len(long_lat))
+                if distance(long_lat[a], long_lat[b]) < cutoff]
+    assert list(zip(first.tolist(), second.tolist())) == expected
+    for idx in range(10):
+        assert (idx, 40 + idx) in expected
+        assert (idx, 50 + idx) not in expected
+
+
+def test_pairs_from_sources_match_all_pairs():
+    rng = np.random.RandomState(552)
+    long_lat = np.stack([rng.uniform(30, 33, size=60),
+                         rng.uniform(0, 2, size=60)], axis=1)
+    keys = rng.permutation(60) * 7
+    sources = np.flatnonzero(long_lat[:, 0] < 31.5)
+    first, second, r = candidate_pairs_from(
+        long_lat, sources, 100_000, "fast", keys)
+    assert np.isin(first, sources).all()
+    assert (keys[first] < keys[second]).all()
+    all_first, all_second, all_r = candidate_pairs(long_lat, 100_000, "fast")
+    smaller = np.where(keys[all_first] < keys[all_second], all_first, all_second)
+    larger = all_first + all_second - smaller
+    owned = np.isin(smaller, sources)
+    assert (sorted(zip(first.tolist(), second.tolist()))
+            == sorted(zip(smaller[owned].tolist(), larger[owned].tolist())))
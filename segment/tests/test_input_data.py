@@ -17,9 +17,10 @@ def test_load_cities(tmp_path):
         print("333,1,17", file=out)
 
     result = input_data.load_cities(f)
-    assert result.shape == (2, 3)
-    assert result[0, 1] == 42
-    assert result[1, 2] == 17
+    assert result.shape == (2,)
+    assert result[0]["x"] == 42
+    assert result[1]["y"] == 17
+    assert result[0]["squared_distance"] == 243
 
 
 def test_load_pfpr():
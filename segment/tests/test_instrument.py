@@ -0,0 +1,53 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from segment.instrument import StageRecorder, add_counts, count, run_counted
+from segment.raster_access import RASTER_READS
+
+
+def test_counts_go_to_running_stages():
+    recorder = StageRecorder()
+    count("ignored")
+    with recorder.stage("outer") as counts:
+        count("cuts")
+        with recorder.stage("inner"):
+            count("cuts", 2)
+        counts["cities"] = 7
+    inner, outer = recorder.stages
+    assert inner["stage"] == "inner" and inner["counts"] == {"cuts": 2}
+    assert outer["counts"] == {"cuts": 3, "cities": 7}
+    assert outer["wall_seconds"] >= inner["wall_seconds"]
+    assert outer["max_rss_bytes"] > 0
+
+
+def _counting_task(amount):
+    count("pixels", amount)
+    RASTER_READS["reads"] += 1
+    return amount
+
+
+def test_counts_from_workers_add_to_stages():
+    recorder = StageRecorder()
+    with recorder.stage("parallel"):
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            counted = pool.map(run_counted, [_counting_task] * 3, [1, 2, 3])
+            assert list(map(add_counts, counted)) == [1, 2, 3]
+    stage = recorder.stages[0]
+    assert stage["counts"] == {"pixels": 6}
+    assert stage["raster_reads"] == 3
+    assert stage["children_max_rss_bytes"] > 0
+
+
+def test_write_shares_token_and_profiles(tmp_path):
+    recorder = StageRecorder("abc123", profile=["slow"], profile_dir=tmp_path)
+    with recorder.stage("slow"):
+        sum(range(1000))
+    out_path = tmp_path / "record.jsonl"
+    recorder.write(out_path, "citypeaks", dict(peaks="city_peaks.csv"))
+    recorder.write(out_path, "citypeaks")
+    lines = out_path.read_text().splitlines()
+    assert len(lines) == 2
+    entry = json.loads(lines[0])
+    assert entry["token"] == "abc123"
+    assert entry["peaks"] == "city_peaks.csv"
+    assert (tmp_path / "abc123-slow.prof").exists()
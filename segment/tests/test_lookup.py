@@ -0,0 +1,75 @@
+import json
+from threading import Thread
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen, Request
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from segment.communities import save_pandas, split_disconnected_graph
+from segment.lookup import CommunityIndex, lookup_handler, MISSING
+
+
+@pytest.fixture
+def index():
+    long_lat = np.array([[32.5, 0.3], [32.6, 0.4], [30.0, -2.0], [179.9, 1.0]])
+    return CommunityIndex(long_lat, [2, 2, 3, 1], [0, 0, 1, 0],
+                          nodes=[10, 11, 12, 13])
+
+
+def test_point_finds_nearest_city(index):
+    found = index.query([[32.51, 0.31], [30.1, -2.1], [32.59, 0.41]])
+    assert found.node.tolist() == [10, 12, 11]
+    assert found.group.tolist() == [2, 3, 2]
+    assert found.level.tolist() == [0, 1, 0]
+    assert np.all(found.distance < 20_000)
+
+
+def test_point_beyond_max_distance_is_missing(index):
+    found = index.query([[32.51, 0.31], [10.0, 10.0]], max_distance=10_000)
+    assert found.node.tolist() == [10, MISSING]
+    assert found.group.tolist() == [2, MISSING]
+    assert np.isnan(found.distance[1])
+
+
+def test_box_includes_edges_and_crosses_antimeridian(index):
+    found = index.query_box(32.5, 0.0, 33.0, 0.35)
+    assert found.node.tolist() == [10]
+    wrapped = index.query_box(170.0, -5.0, -170.0, 5.0)
+    assert wrapped.node.tolist() == [13]
+
+
+def test_index_from_segmented_file(tmp_path):
+    graph = nx.barbell_graph(6, 1)
+    for node in graph.nodes:
+        graph.nodes[node]["capacity"] = 1
+        graph.nodes[node]["longlat"] = (30 + 0.1 * node, 0.05 * node)
+    graph, hierarchy = split_disconnected_graph(graph, 8)
+    save_pandas(graph, hierarchy, tmp_path / "segmented.h5")
+    index = CommunityIndex.from_file(tmp_path / "segmented.h5")
+    found = index.query([[30 + 0.1 * node, 0.05 * node] for node in graph.nodes])
+    assert found.node.tolist() == list(graph.nodes)
+    assert found.group.tolist() == [graph.nodes[n]["group"] for n in graph.nodes]
+
+
+def test_server_answers_points(index):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), lookup_handler(index))
+    Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with urlopen(f"{base}/point?long=30.1&lat=-2.1") as response:
+            assert json.loads(response.read())["group"] == [3]
+        body = json.dumps(dict(long=[32.51, 179.8], lat=[0.31, 1.0])).encode()
+        request = Request(f"{base}/points", data=body, method="POST")
+        with urlopen(request) as response:
+            assert json.loads(response.read())["node"] == [10, 13]
+        for bad_body in [b"[1, 2]", b"not json", b'{"long": [1]}']:
+            request = Request(f"{base}/points", data=bad_body, method="POST")
+            with pytest.raises(HTTPError) as error:
+                urlopen(request)
+            assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
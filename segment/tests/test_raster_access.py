@@ -0,0 +1,54 @@
+import numpy as np
+from osgeo import gdal
+
+from segment.raster_access import RowWindowReader, window_as_numpy
+
+
+def int_raster(x_size, y_size):
+    values = np.arange(x_size * y_size, dtype=np.int32).reshape(y_size, x_size)
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", x_size, y_size, 1, gdal.GDT_Int32)
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(values)
+    return dataset, band, values
+
+
+def test_window_as_numpy_is_x_then_y():
+    dataset, band, values = int_raster(7, 5)
+    window = window_as_numpy(band, (2, 6), (1, 4))
+    assert window.shape == (4, 3)
+    assert window[0, 0] == values[1, 2]
+    assert window[3, 2] == values[3, 5]
+
+
+def test_row_window_reader_reads_each_row_once():
+    dataset, band, values = int_raster(11, 30)
+    reader = RowWindowReader(band, (-2, 8), 5)
+    for j in range(30):
+        y_limits = (max(0, j - 2), min(30, j + 3))
+        rows = reader.rows(y_limits)
+        assert (rows == values[y_limits[0]:y_limits[1], 0:8].T).all()
+    assert reader.bytes_read == 30 * 8 * 4
+
+
+def test_prefetching_reader_matches_and_restarts():
+    dataset, band, values = int_raster(11, 300)
+    plain = RowWindowReader(band, (-2, 8), 5)
+    reader = RowWindowReader(band, (-2, 8), 5, prefetch_depth=2, y_stop=200)
+    for start in [0, 100]:
+        for j in range(start, 260):
+            y_limits = (max(0, j - 2), min(300, j + 3))
+            expected = plain.rows(y_limits).copy()
+            assert (reader.rows(y_limits) == expected).all()
+    reader.close()
+    assert reader.bytes_read == plain.bytes_read
+
+
+def test_prefetching_reader_restarts_before_stop():
+    dataset, band, values = int_raster(11, 300)
+    with RowWindowReader(band, (0, 11), 60, prefetch_depth=2) as reader:
+        assert (reader.rows((0, 50)) == values[0:50].T).all()
+        assert (reader.rows((10, 15)) == values[10:15].T).all()
+        assert (reader.rows((200, 260)) == values[200:260].T).all()
+        assert (reader.rows((5, 7)) == values[5:7].T).all()
+    assert reader.stalls[0] >= 0
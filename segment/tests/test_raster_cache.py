@@ -0,0 +1,56 @@
+import numpy as np
+from osgeo import gdal, osr
+
+from segment.city_find import largest_within_distance
+from segment.input_data import load_lspop
+from segment.raster_access import RowWindowReader, window_as_numpy
+from segment.raster_cache import write_raster_cache
+
+
+def wgs84_population(x_size, y_size):
+    rng = np.random.RandomState(2817)
+    population = (1000 * rng.uniform(size=(y_size, x_size))**6).astype(np.int32)
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", x_size, y_size, 1, gdal.GDT_Int32)
+    dataset.SetGeoTransform((30, 0.01, 0, 2, 0, -0.01))
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(4326)
+    dataset.SetProjection(reference.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(population)
+    band.ComputeStatistics(False)
+    return dataset, band, population
+
+
+def test_cache_serves_views(tmp_path):
+    dataset, band, population = wgs84_population(23, 19)
+    write_raster_cache(band, dataset, tmp_path, chunk_rows=4, smallest=4)
+    cached = load_lspop(tmp_path)
+    assert cached.dataset.GetGeoTransform() == dataset.GetGeoTransform()
+    window = window_as_numpy(cached.band, (3, 20), (2, 11))
+    assert (window == population[2:11, 3:20].T).all()
+    assert np.shares_memory(window, cached.band.mapped)
+    reader = RowWindowReader(cached.band, (0, 23), 5)
+    assert (reader.rows((4, 9)) == population[4:9].T).all()
+
+
+def test_pyramid_sums_population(tmp_path):
+    dataset, band, population = wgs84_population(23, 19)
+    header = write_raster_cache(band, dataset, tmp_path, chunk_rows=3,
+                                smallest=4)
+    assert [level["x_size"] for level in header["levels"]] == [23, 12, 6, 3]
+    cached = load_lspop(tmp_path)
+    level1 = cached.band.GetOverview(0).mapped
+    assert level1.shape == (10, 12)
+    assert level1[0, 0] == population[0:2, 0:2].sum()
+    assert level1[9, 11] == population[18, 22]
+    last = cached.band.GetOverview(cached.band.GetOverviewCount() - 1)
+    assert last.mapped.sum() == population.sum()
+
+
+def test_peaks_match_gdal(tmp_path):
+    dataset, band, population = wgs84_population(31, 27)
+    write_raster_cache(band, dataset, tmp_path)
+    cached = load_lspop(tmp_path)
+    assert (largest_within_distance(cached.band, 3, progress=False)
+            == largest_within_distance(band, 3, progress=False))
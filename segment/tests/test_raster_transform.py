@@ -4,7 +4,7 @@ import pytest
 
 from segment.raster_transform import (
     pixels_range_near_point, pixel_coord, pixel_containing,
-    long_lat_to_xyz,
+    long_lat_to_xyz, distance, distances, chord_radius, xyz_tree,
 )
 
 
@@ -62,7 +62,46 @@ def test_long_lat_to_xyz():
         [30, 1],
         [28, 0],
         [22, 0],
-    ], dtype=np.float)
+    ], dtype=np.float64)
     ans = long_lat_to_xyz(ll)
     assert ans.shape == (4, 3)
-    print(ans)
\ No newline at end of file
+    # Each is on the equator, so it is an equatorial radius from the center.
+    on_equator = ll[:, 1] == 0
+    assert np.allclose(np.linalg.norm(ans[on_equator], axis=1), 6378137)
+    assert np.allclose(ans[0], 6378137 * np.array(
+        [np.cos(np.pi / 6), np.sin(np.pi / 6), 0]))
+    pole = long_lat_to_xyz(np.array([[0, 90], [45, -90]]))
+    assert np.allclose(pole[:, 2], [6356752.314245, -6356752.314245])
+    assert np.allclose(pole[:, :2], 0, atol=1e-6)
+
+
+def test_chord_radius_misses_no_pairs():
+    rng = np.random.RandomState(2319)
+    a = np.stack([rng.uniform(-180, 180, 400), rng.uniform(-85, 85, 400)],
+                 axis=1)
+    b = a + rng.normal(0, 3, size=a.shape)
+    b[:, 1] = np.clip(b[:, 1], -89, 89)
+    geodesic = distances(a, b)
+    chord = np.linalg.norm(long_lat_to_xyz(a) - long_lat_to_xyz(b), axis=1)
+    assert np.all(chord <= chord_radius(geodesic))
+    # At 200 km, a chord is only meters shorter than the geodesic.
+    near = (geodesic > 150_000) & (geodesic < 250_000)
+    assert np.all(geodesic[near] - chord[near] < 20)
+    assert xyz_tree(a).query_ball_point(
+        long_lat_to_xyz(a[:1])[0], chord_radius(1)) == [0]
+
+
+def test_distances_exact_and_fast():
+    rng = np.random.RandomState(8734)
+    a = np.stack([rng.uniform(-20, 55, 50), rng.uniform(-40, 40, 50)], axis=1)
+    b = a + rng.normal(0, 1, size=a.shape)
+    exact = distances(a, b)
+    for idx in range(len(a)):
+        assert exact[idx] == pytest.approx(distance(a[idx], b[idx]))
+    fast = distances(a, b, "fast")
+    assert np.all(np.abs(fast - exact) <= 2e-6 * exact)
+    assert distances(a[:3], a[:3], "fast").tolist() == [0, 0, 0]
+    # Vincenty doesn't converge here, so geographiclib measures it.
+    antipodes = distances([[0, 0], [10, 20]], [[180, 0], [10, 20]])
+    assert antipodes[0] == pytest.approx(distance([0, 0], [180, 0]))
+    assert antipodes[1] == 0
@@ -1,6 +1,8 @@
 from pathlib import Path
+from pickle import dump
 
-from segment.split_cities import parser
+from segment.split_cities import city_graph_keys, load_city_graph, parser
+from segment.stage_cache import stage_key
 
 
 def test_split_cities_parser():
@@ -12,3 +14,21 @@ def test_split_cities_parser():
 def test_split_cities_parser_give_graph():
     p = parser().parse_args(["--peak-radius", "25", "--city-graph", "z.pickle"])
     assert p.city_graph == Path("z.pickle")
+
+
+def test_city_graph_pickle_needs_matching_key(tmp_path):
+    for name in ["peaks", "lspop", "pfpr"]:
+        (tmp_path / name).write_text(name)
+    arguments = [f"--{name}={tmp_path / name}"
+                 for name in ["peaks", "lspop", "pfpr"]]
+    args = parser().parse_args(arguments)
+    graph_key = city_graph_keys(args, stage_key).graph
+    pickle_path = tmp_path / "graph.pickle"
+    with pickle_path.open("wb") as out:
+        dump(dict(key=graph_key, graph="made"), out)
+    assert load_city_graph(pickle_path, graph_key) == "made"
+    wider = parser().parse_args(arguments + ["--peak-radius", "30"])
+    assert city_graph_keys(wider, stage_key).graph != graph_key
+    assert load_city_graph(pickle_path, city_graph_keys(wider, stage_key).graph) is None
+    (tmp_path / "pfpr").write_text("other")
+    assert city_graph_keys(args, stage_key).graph != graph_key
@@ -0,0 +1,43 @@
+import os
+
+from segment.stage_cache import StageCache
+
+
+def test_key_follows_inputs_and_parameters(tmp_path):
+    cache = StageCache(tmp_path / "cache")
+    data = tmp_path / "data.bin"
+    data.write_bytes(b"abc")
+    first = cache.key("peaks", dict(lspop=data), dict(radius=2))
+    assert first.startswith("peaks-")
+    assert cache.key("peaks", dict(lspop=data), dict(radius=2)) == first
+    assert cache.key("peaks", dict(lspop=data), dict(radius=3)) != first
+    data.write_bytes(b"abcd")
+    assert cache.key("peaks", dict(lspop=data), dict(radius=2)) != first
+
+
+def test_store_then_load(tmp_path):
+    cache = StageCache(tmp_path)
+    assert cache.load("table-1") is None
+    assert "table-1" not in cache
+    cache.store("table-1", [1, 2, 3])
+    assert "table-1" in cache
+    assert StageCache(tmp_path).load("table-1") == [1, 2, 3]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = StageCache(tmp_path, maximum_bytes=2**20)
+    cache.store("old-1", b"x" * 600_000)
+    os.utime(tmp_path / "old-1.pickle", (1, 1))
+    cache.store("new-1", b"y" * 600_000)
+    assert cache.load("old-1") is None
+    assert cache.load("new-1") is not None
+
+
+def test_evict_keeps_new_entry_and_drops_stale_partials(tmp_path):
+    cache = StageCache(tmp_path, maximum_bytes=2**20)
+    stale = tmp_path / "old-1.pickle.abcd.partial"
+    stale.write_bytes(b"z" * 100)
+    os.utime(stale, (1, 1))
+    cache.store("big-1", b"x" * 2**21)
+    assert cache.load("big-1") is not None
+    assert not stale.exists()
@@ -0,0 +1,43 @@
+import numpy as np
+
+from segment.communities import split_disconnected_graph
+from segment.flux import calculate_flows
+from segment.sweep import parameter_grid, summarize, sweep_flow_graphs
+
+
+def city_table(seed, city_cnt=60):
+    rng = np.random.RandomState(seed)
+    pop_pfpr = np.zeros((city_cnt, 4), dtype=np.float64)
+    pop_pfpr[:, 0] = rng.randint(100, 10000, size=city_cnt)
+    pop_pfpr[:, 1] = rng.uniform(0, 0.5, size=city_cnt)
+    pop_pfpr[::7, 1] = 0
+    pop_pfpr[:, 2] = rng.uniform(30, 33, size=city_cnt)
+    pop_pfpr[:, 3] = rng.uniform(0, 3, size=city_cnt)
+    return pop_pfpr
+
+
+def test_sweep_matches_calculate_flows():
+    first_table = city_table(1)
+    second_table = first_table.copy()
+    second_table[:, 0:2] = city_table(2)[:, 0:2]
+    tables = {10_000: first_table, 25_000: second_table}
+    grid = parameter_grid([25_000, 10_000], [50_000, 150_000], [1.0, 2.0])
+    assert len(grid) == 8
+    for parameters, graph in sweep_flow_graphs(tables, grid, "fast"):
+        expected = calculate_flows(
+            tables[parameters.radius], parameters.cutoff, parameters.exponent,
+            "fast")
+        assert graph.edge_cnt > 0
+        assert np.allclose(graph.longlat, expected.longlat)
+        assert abs(graph.capacity - expected.capacity).max() < 1e-9
+
+
+def test_summary_counts_groups():
+    table = city_table(3)
+    grid = parameter_grid([10_000], [100_000], [1.0])
+    (parameters, graph), = sweep_flow_graphs({10_000: table}, grid, "fast")
+    graph, hierarchy = split_disconnected_graph(graph, 5)
+    row = summarize(parameters, graph, hierarchy)
+    assert row["cities"] == (table[:, 1] > 1e-3).sum()
+    assert row["largest_group"] <= 5
+    assert row["cutoff_km"] == 100
@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+
+from segment import benchmark
+from segment.input_data import load_lspop, load_pfpr
+from segment.synthetic import (
+    LSPOP_NODATA, synthetic_population, write_synthetic_rasters,
+)
+
+
+def test_population_has_cities_and_ocean():
+    population = synthetic_population(200, 150, 20)
+    assert population.shape == (150, 200)
+    assert (population[:, 0] == LSPOP_NODATA).all()
+    land = population[:, 20:]
+    assert land.min() >= 0
+    assert land.max() > 50 * np.median(land)
+
+
+def test_synthetic_rasters_load(tmp_path):
+    lspop_path, pfpr_path = write_synthetic_rasters(tmp_path, 60, 40, 5)
+    lspop = load_lspop(lspop_path)
+    pfpr = load_pfpr(pfpr_path)
+    assert (lspop.band.XSize, lspop.band.YSize) == (60, 40)
+    assert (pfpr.band.XSize, pfpr.band.YSize) == (12, 8)
+    assert lspop.band.GetMinimum() == 0
+
+
+def test_benchmark_runs_every_stage(tmp_path, monkeypatch):
+    monkeypatch.setitem(benchmark.SCALES, "tiny", benchmark.Scale(120, 90, 8))
+    args = benchmark.parser().parse_args(
+        ["--scales", "tiny", "--distance", "fast", "--no-tracemalloc"])
+    results = benchmark.run_benchmarks(args, tmp_path)
+    assert [record["stage"] for record in results] == [
+        "largest_within_distance", "assign_pop_and_pfpr_to_points",
+        "calculate_flows", "split_disconnected_graph", "save_pandas",
+        "write_points_file",
+    ]
+    assert all(record["wall_seconds"] >= 0 for record in results)
+    json.dumps(results)
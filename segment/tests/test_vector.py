@@ -1,7 +1,33 @@
 import networkx as nx
+import pytest
+from osgeo import ogr
+
+from segment.communities import split_disconnected_graph
+from segment.flow_graph import FlowGraph
+from segment.vector import write_points_file
 
 
 def test_hierarchy_level():
     g = nx.DiGraph()
     g.add_edges_from([(0, 1), (1, 2), (2, 3), (3, 4)])
     assert len(nx.ancestors(g, 3)) == 3
+
+
+@pytest.mark.parametrize("driver_name", ["GPKG", "ESRI Shapefile"])
+def test_write_cities_and_flows(tmp_path, driver_name):
+    graph = FlowGraph.from_networkx(nx.barbell_graph(6, 1))
+    graph.longlat[:, 0] = range(len(graph))
+    graph.longlat[:, 1] = 1.5
+    graph, hierarchy = split_disconnected_graph(graph, 8)
+    out_path = tmp_path / "groups"
+    write_points_file(graph, hierarchy, out_path, driver_name)
+
+    dataset = ogr.Open(str(out_path))
+    cities = dataset.GetLayerByName("cities")
+    assert cities.GetFeatureCount() == 13
+    levels = {f.GetField("group"): f.GetField("level") for f in cities}
+    assert levels == {3: 0, 4: 0}
+    flows = dataset.GetLayerByName("flows")
+    assert flows.GetFeatureCount() == graph.edge_cnt
+    line = flows.GetNextFeature().GetGeometryRef()
+    assert line.GetPointCount() == 2
@@ -0,0 +1,103 @@
+import numpy as np
+
+from segment.city_find import largest_within_distance
+from segment.communities import load_flow_graph
+from segment.flux import (
+    calculate_flows, city_pop_pfpr, GRAVITY_CUTOFF, GRAVITY_EXPONENT,
+)
+from segment.input_data import load_lspop, load_pfpr, PEAK_DTYPE
+from segment.instrument import StageRecorder
+from segment.raster_transform import LongLat
+from segment.synthetic import write_synthetic_rasters
+from segment import world
+
+
+def keyed_edges(graph, keys):
+    """Edges by the sorted pair of their city keys."""
+    first, second, capacity = graph.edges()
+    return {
+        tuple(sorted((keys[graph.nodes[a]], keys[graph.nodes[b]]))): c
+        for (a, b, c) in zip(first.tolist(), second.tolist(), capacity.tolist())
+    }
+
+
+def test_border_edges_written_once(tmp_path):
+    rng = np.random.RandomState(7)
+    city_cnt = 80
+    pop_pfpr = np.stack([
+        rng.randint(100, 10000, size=city_cnt).astype(np.float64),
+        rng.uniform(0, 0.5, size=city_cnt),
+        rng.uniform(30, 33, size=city_cnt),
+        rng.uniform(0, 2, size=city_cnt),
+    ], axis=1)
+    pop_pfpr[::9, 1] = 0
+    keys = np.arange(city_cnt) * 3 + 5
+    west = pop_pfpr[:, 2] < 31.5
+    tables = [tmp_path / "west.npz", tmp_path / "east.npz"]
+    world._save_arrays(tables[0], keys=keys[west], pop_pfpr=pop_pfpr[west])
+    world._save_arrays(tables[1], keys=keys[~west], pop_pfpr=pop_pfpr[~west])
+    edges = list()
+    for near, name in [(tables, "west"), (tables[::-1], "east")]:
+        out_path = tmp_path / f"{name}-edges.npz"
+        world.tile_edges((near, 100_000, 1.0, "fast", out_path))
+        with np.load(str(out_path)) as tile:
+            edges.extend(zip(tile["first"].tolist(), tile["second"].tolist(),
+                             tile["capacity"].tolist()))
+
+    expected = calculate_flows(pop_pfpr, 100_000, 1.0, "fast")
+    expected_edges = keyed_edges(expected, keys)
+    found = {tuple(sorted((a, b))): c for (a, b, c) in edges}
+    assert len(found) == len(edges)
+    assert found.keys() == expected_edges.keys()
+    assert np.allclose([found[k] for k in found],
+                       [expected_edges[k] for k in found])
+
+
+def test_halo_holds_neighbors():
+    geo_transform = (30.0, 1 / 120, 0, 4.0, 0, -1 / 120)
+    tiles = [LongLat([x, x + 120], [y, y + 120])
+             for y in range(0, 480, 120) for x in range(0, 480, 120)]
+    neighbors = world.neighbor_tiles(tiles, 200_000, geo_transform)
+    # 200 km is more than one tile of one degree, but less than two.
+    assert neighbors[0][0] == 0
+    assert sorted(neighbors[0]) == [0, 1, 2, 4, 5, 6, 8, 9, 10]
+    assert len(neighbors[5]) == 16
+
+
+def test_world_run_resumes(tmp_path):
+    lspop_path, pfpr_path = write_synthetic_rasters(tmp_path, 240, 180, 25)
+    work_dir = tmp_path / "world"
+    args = world.parser().parse_args([
+        "--lspop", str(lspop_path), "--pfpr", str(pfpr_path),
+        "--work-dir", str(work_dir), "--tile-degrees", "0.5",
+        "--peak-radius", "5", "--city-radius", "5", "--distance", "fast",
+        "--partition", "spectral",
+    ])
+    args.segmented = work_dir / "segmented.h5"
+    work_dir.mkdir()
+    tiles = world.run_world(args, StageRecorder())
+    lspop = load_lspop(lspop_path)
+    assert tiles == world.world_tiles(
+        lspop.band, lspop.dataset.GetGeoTransform(), args.long, args.lat, 0.5)
+    assert len(tiles) == 12
+    graph = load_flow_graph(args.segmented)
+    assert graph.edge_cnt > 0
+
+    # Tiles make the same graph as one run over the whole raster.
+    peaks = largest_within_distance(lspop.band, 5, None, progress=False)
+    cities = np.array([tuple(peak) for peak in peaks], dtype=PEAK_DTYPE)
+    single = calculate_flows(
+        city_pop_pfpr(cities, lspop, load_pfpr(pfpr_path), 5000),
+        GRAVITY_CUTOFF, GRAVITY_EXPONENT, "fast",
+    )
+    keys = cities["y"].astype(np.int64) * lspop.band.XSize + cities["x"]
+    expected = keyed_edges(single, keys)
+    found = keyed_edges(graph, {key: key for key in graph.nodes.tolist()})
+    assert found.keys() == expected.keys()
+    assert np.allclose([found[k] for k in expected],
+                       [expected[k] for k in expected])
+
+    recorder = StageRecorder()
+    world.run_world(args, recorder)
+    assert all(stage["counts"].get("tiles", 0) == 0
+               for stage in recorder.stages)